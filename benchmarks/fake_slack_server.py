@@ -0,0 +1,131 @@
+"""Local fake of the Slack Web API with configurable rate limits.
+
+Answers the methods used by the bot over HTTP from a FakeSlackClient, so the
+real WebClient and AsyncWebClient can be pointed at it with base_url. Methods
+with a rate limit answer calls above the limit of the current window with 429
+and a Retry-After header, like Slack does.
+
+    with FakeSlackServer(profiles, rate_limits={"users.info": 5}) as server:
+        client = WebClient(token="xoxb-fake", base_url=server.base_url)
+"""
+import json
+import math
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qsl, urlparse
+
+from benchmarks.fakes import FakeSlackClient
+
+
+class FakeSlackServer:
+    def __init__(self, profiles: dict, rate_limits: Optional[dict] = None, window_seconds: float = 1.0):
+        # rate_limits: {method: calls per window}, methods without a limit are never throttled
+        self.client = FakeSlackClient(profiles)
+        self.rate_limits = rate_limits or {}
+        self.window_seconds = window_seconds
+        self.throttled = Counter()
+        self._windows: dict = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._request_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/"
+
+    @property
+    def calls(self) -> Counter:
+        # Answered calls per method, throttled calls are counted in throttled
+        return self.client.calls
+
+    def __enter__(self) -> "FakeSlackServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _retry_after(self, method: str) -> Optional[int]:
+        # Seconds until the window of the method ends if its limit is used up, else None
+        limit = self.rate_limits.get(method)
+        if limit is None:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            window_start, count = self._windows.get(method, (now, 0))
+            if now - window_start >= self.window_seconds:
+                window_start, count = now, 0
+            if count >= limit:
+                self.throttled[method] += 1
+                return max(1, math.ceil(window_start + self.window_seconds - now))
+            self._windows[method] = (window_start, count + 1)
+            return None
+
+    def _call(self, method: str, arguments: dict) -> dict:
+        if method == "users.list":
+            return self.client.users_list(cursor=arguments.get("cursor"), limit=int(arguments.get("limit") or 0) or None)
+        if method == "users.info":
+            return self.client.users_info(user=arguments["user"])
+        if method == "conversations.open":
+            users = arguments["users"]
+            return self.client.conversations_open(users=users.split(",") if isinstance(users, str) else users)
+        if method == "chat.postMessage":
+            return self.client.chat_postMessage(channel=arguments["channel"], text=arguments.get("text", ""))
+        if method == "chat.scheduleMessage":
+            return self.client.chat_scheduleMessage(
+                channel=arguments["channel"], text=arguments.get("text", ""), post_at=arguments["post_at"]
+            )
+        if method == "chat.deleteScheduledMessage":
+            return self.client.chat_deleteScheduledMessage(
+                channel=arguments["channel"], scheduled_message_id=arguments["scheduled_message_id"]
+            )
+        return {"ok": False, "error": "unknown_method"}
+
+    def _request_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                arguments = dict(parse_qsl(url.query))
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+                if body:
+                    if self.headers.get("Content-Type", "").startswith("application/json"):
+                        arguments.update(json.loads(body))
+                    else:
+                        arguments.update(parse_qsl(body))
+
+                retry_after = server._retry_after(method)
+                if retry_after is not None:
+                    self._respond(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": str(retry_after)})
+                    return
+                try:
+                    response = dict(server._call(method, arguments))
+                except KeyError as e:
+                    response = {"ok": False, "error": f"missing_argument {e}"}
+                response.setdefault("ok", True)
+                self._respond(200, response)
+
+            def _respond(self, status: int, data: dict, headers: Optional[dict] = None):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,92 @@
+"""In-process stand-ins and synthetic data for the benchmarks."""
+import itertools
+import random
+from collections import Counter
+from datetime import date, timedelta
+
+from slack_bot.app import ABSENCE_EMOJIS
+
+
+def synthetic_roster(number_of_users: int) -> dict:
+    # Same format as the USERS secret: {username: id}
+    return {f"user{i}": f"U{i:07d}" for i in range(number_of_users)}
+
+
+def synthetic_profiles(user_ids, absence_rate: float = 0.05, rng: random.Random = None) -> dict:
+    rng = rng or random.Random(0)
+    profiles = {}
+    for i, user_id in enumerate(user_ids):
+        absent = rng.random() < absence_rate
+        profiles[user_id] = {
+            "id": user_id,
+            "deleted": False,
+            "tz": "Europe/Berlin",
+            "tz_offset": 3600,
+            "profile": {
+                "real_name": f"First{i} Last{i}",
+                "status_emoji": rng.choice(ABSENCE_EMOJIS) if absent else "",
+                "status_expiration": 0,
+            },
+        }
+    return profiles
+
+
+def synthetic_history(user_ids, weeks: int, end: date, rng: random.Random = None) -> dict:
+    # {date: [runs]} with one weekly run pairing half of the users
+    rng = rng or random.Random(0)
+    user_ids = list(user_ids)
+    history = {}
+    for week in range(weeks, 0, -1):
+        run_date = (end - timedelta(weeks=week)).isoformat()
+        selected = rng.sample(user_ids, len(user_ids) // 4 * 2)
+        history[run_date] = [
+            {"date": run_date, "pair": sorted(selected[i:i + 2])} for i in range(0, len(selected), 2)
+        ]
+    return history
+
+
+class FakeSlackClient:
+    # Answers the Web API methods used by the bot from a profile map and counts the calls per method
+    def __init__(self, profiles: dict, page_size_limit: int = 1000):
+        self.profiles = profiles
+        self.page_size_limit = page_size_limit
+        self.token = "xoxb-fake"
+        self.calls = Counter()
+        self.messages = []
+        self.scheduled_messages = {}
+        self._scheduled_message_ids = itertools.count(1)
+
+    def users_list(self, cursor=None, limit=None, **kwargs) -> dict:
+        self.calls["users.list"] += 1
+        members = list(self.profiles.values())
+        start = int(cursor) if cursor else 0
+        end = start + min(limit or self.page_size_limit, self.page_size_limit)
+        return {
+            "members": members[start:end],
+            "response_metadata": {"next_cursor": str(end) if end < len(members) else ""},
+        }
+
+    def users_info(self, user: str, **kwargs) -> dict:
+        self.calls["users.info"] += 1
+        return {"user": self.profiles[user]}
+
+    def conversations_open(self, users, **kwargs) -> dict:
+        self.calls["conversations.open"] += 1
+        return {"channel": {"id": "D" + "".join(sorted(users))}}
+
+    def chat_postMessage(self, channel: str, text: str, **kwargs) -> dict:
+        self.calls["chat.postMessage"] += 1
+        self.messages.append((channel, text))
+        return {"ok": True, "channel": channel, "ts": f"{len(self.messages)}.000"}
+
+    def chat_scheduleMessage(self, channel: str, text: str, post_at, **kwargs) -> dict:
+        self.calls["chat.scheduleMessage"] += 1
+        scheduled_message_id = f"Q{next(self._scheduled_message_ids)}"
+        self.scheduled_messages[scheduled_message_id] = (channel, text, int(post_at))
+        return {"ok": True, "channel": channel, "scheduled_message_id": scheduled_message_id, "post_at": int(post_at)}
+
+    def chat_deleteScheduledMessage(self, channel: str, scheduled_message_id: str, **kwargs) -> dict:
+        self.calls["chat.deleteScheduledMessage"] += 1
+        if self.scheduled_messages.pop(scheduled_message_id, None) is None:
+            return {"ok": False, "error": "invalid_scheduled_message_id"}
+        return {"ok": True}
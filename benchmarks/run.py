@@ -0,0 +1,162 @@
+"""Benchmark the pairing pipeline on synthetic organisations.
+
+Every stage of a run (roster fetch, history read, selection, dispatch, history
+write) is timed end to end against moto S3 and an in-process fake Slack
+client. Slack and S3 calls are counted per method. The results are compared
+with a stored baseline, call counts have to match exactly and timings may not
+exceed the baseline by more than the tolerance.
+
+Usage:
+    python -m benchmarks.run [--sizes 1000 10000 50000] [--years 1 5]
+                             [--baseline benchmarks/baseline.json] [--update-baseline]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import date
+from unittest import mock
+
+from benchmarks.fakes import FakeSlackClient, synthetic_history, synthetic_profiles, synthetic_roster
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+BUCKET = "benchmark-bucket"
+PREFIX = "user_history"
+# Timings below this difference are noise, whatever the relative change
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def run_case(number_of_users: int, years: int, seed: int = 0) -> dict:
+    import boto3
+    from moto import mock_s3
+
+    from slack_bot import app
+
+    rng = random.Random(seed)
+    random.seed(seed)
+    roster = synthetic_roster(number_of_users)
+    profiles = synthetic_profiles(roster.values(), rng=rng)
+    end = date(2024, 1, 1)
+    history = synthetic_history(roster.values(), weeks=52 * years, end=end, rng=rng)
+
+    slack = FakeSlackClient(profiles)
+    stages = {}
+
+    environment = {"USERS": json.dumps(roster), "DISPATCH_CONCURRENCY": "1"}
+    with mock.patch.dict(os.environ, environment), mock_s3():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=BUCKET)
+        for run_date, runs in history.items():
+            s3.put_object(Bucket=BUCKET, Key=f"{PREFIX}/{run_date}_09-00-00.json", Body=json.dumps(runs))
+
+        s3_calls = Counter()
+        s3.meta.events.register("before-call.s3", lambda model, **kwargs: s3_calls.update([model.name]))
+        file_handler = app.S3FileHandler(BUCKET, PREFIX, s3=s3)
+        client = app.Roster(slack)
+
+        start = time.perf_counter()
+        users = app.get_users(client)
+        stages["roster"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        previous_runs = file_handler.read_history()
+        stages["history_read"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        filtered_users = app.filter_users_based_on_previous_runs(users, previous_runs)
+        user_pairs = app.generate_user_pairs(filtered_users)
+        stages["selection"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = app.dispatch_messages(user_pairs, client)
+        stages["dispatch"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        file_handler.write([{"date": end.isoformat(), "pair": result.pair} for result in results if result.delivered])
+        stages["history_write"] = time.perf_counter() - start
+
+    return {
+        "users": number_of_users,
+        "years": years,
+        "history_runs": sum(len(runs) for runs in history.values()),
+        "pairs": len(user_pairs),
+        "stages": stages,
+        "total": sum(stages.values()),
+        "slack_calls": dict(slack.calls),
+        "s3_calls": dict(s3_calls),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for case, result in results.items():
+        expected = baseline.get(case)
+        if expected is None:
+            continue
+
+        for calls in ["slack_calls", "s3_calls"]:
+            if result[calls] != expected[calls]:
+                regressions.append(f"{case}: {calls} changed from {expected[calls]} to {result[calls]}")
+
+        for stage, seconds in result["stages"].items():
+            baseline_seconds = expected["stages"].get(stage, 0.0)
+            if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > MIN_REGRESSION_SECONDS:
+                regressions.append(f"{case}: {stage} took {seconds:.3f}s, baseline {baseline_seconds:.3f}s")
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    stages = ["roster", "history_read", "selection", "dispatch", "history_write"]
+    print(f"{'case':<16}" + "".join(f"{stage:>15}" for stage in stages) + f"{'total':>10}  calls")
+    for case, result in results.items():
+        calls = sum(result["slack_calls"].values()) + sum(result["s3_calls"].values())
+        print(f"{case:<16}" + "".join(f"{result['stages'][stage]:>14.3f}s" for stage in stages)
+              + f"{result['total']:>9.3f}s  {calls}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the pairing pipeline on synthetic organisations.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--years", type=int, nargs="+", default=[1, 5])
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative slowdown of a stage compared to the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    # Moto needs credentials, and the per pair log lines would dominate the dispatch timing
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {}
+    for number_of_users in args.sizes:
+        for years in args.years:
+            results[f"{number_of_users}u_{years}y"] = run_case(number_of_users, years)
+    print_results(results)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""Simulate weekly coffee break rounds offline.
+
+Every week the roster churns, some users are absent, and the bot selects and
+pairs users from the in-memory history and "sends" the messages through the
+fake Slack client. Per week the latency, the peak memory and the ValueErrors
+and retries of the pairing are reported, at the end the fairness of the
+selection (weeks between a user's breaks, repeated pairs).
+
+Usage:
+    python -m benchmarks.simulate [--users 1000] [--weeks 52] [--absence-rate 0.1] [--churn-rate 0.01]
+                                  [--lookback-days 0] [--seed 0] [--json]
+"""
+import argparse
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+from unittest import mock
+
+from benchmarks.fakes import FakeSlackClient, synthetic_profiles
+from slack_bot import app
+
+START_DATE = date(2024, 1, 1)
+
+
+def simulate(
+    number_of_users: int,
+    weeks: int,
+    absence_rate: float = 0.1,
+    churn_rate: float = 0.01,
+    lookback_days: int = 0,
+    seed: int = 0,
+    measure_memory: bool = True,
+) -> dict:
+    rng = random.Random(seed)
+    random.seed(seed)
+    next_user = number_of_users
+    roster = [f"U{i:07d}" for i in range(number_of_users)]
+    file_handler = app.InMemoryFileHandler()
+
+    week_stats = []
+    breaks: dict[str, list[int]] = {}
+    pair_counts: dict[tuple, int] = {}
+    for week in range(weeks):
+        # Roster churn: users leave and the same number of new users join
+        leaving = set(rng.sample(roster, int(len(roster) * churn_rate)))
+        roster = [user for user in roster if user not in leaving]
+        roster.extend(f"U{i:07d}" for i in range(next_user, next_user + len(leaving)))
+        next_user += len(leaving)
+
+        run_date = START_DATE + timedelta(weeks=week)
+        since = run_date - timedelta(days=lookback_days) if lookback_days > 0 else None
+        slack = FakeSlackClient(synthetic_profiles(roster, absence_rate, rng))
+        client = app.Roster(slack)
+
+        if measure_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        error = None
+        user_pairs = []
+        with mock.patch("slack_bot.app.match_users", wraps=app.match_users) as match_users:
+            try:
+                users = app.get_users(client, users=roster)
+                previous_runs = file_handler.read_history(since)
+                filtered_users = app.filter_users_based_on_previous_runs(users, previous_runs)
+                user_pairs = app.generate_user_pairs(filtered_users)
+                results = app.dispatch_messages(user_pairs, client)
+                file_handler.write(
+                    [{"date": run_date.isoformat(), "pair": result.pair} for result in results if result.delivered]
+                )
+            except ValueError as e:
+                error = str(e)
+        latency = time.perf_counter() - start
+        peak_memory = 0
+        if measure_memory:
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        for pair in user_pairs:
+            pair_counts[pair] = pair_counts.get(pair, 0) + 1
+            for user in pair:
+                breaks.setdefault(user, []).append(week)
+
+        week_stats.append({
+            "week": week,
+            "roster": len(roster),
+            "available": len(users) if error is None else None,
+            "pairs": len(user_pairs),
+            "latency": latency,
+            "peak_memory": peak_memory,
+            # Every match_users call after the first is a retry with swapped in standby users
+            "retries": max(match_users.call_count - 1, 0),
+            "error": error,
+        })
+
+    return {"weeks": week_stats, "fairness": fairness(breaks, pair_counts, roster, weeks)}
+
+
+def fairness(breaks: dict, pair_counts: dict, roster: list, weeks: int) -> dict:
+    gaps = [later - earlier for weeks_with_break in breaks.values()
+            for earlier, later in zip(weeks_with_break, weeks_with_break[1:])]
+    total_pairs = sum(pair_counts.values())
+    return {
+        "mean_weeks_between_breaks": statistics.mean(gaps) if gaps else None,
+        "max_weeks_between_breaks": max(gaps) if gaps else None,
+        "users_without_break": sum(1 for user in roster if user not in breaks),
+        "repeated_pair_rate": sum(count - 1 for count in pair_counts.values()) / total_pairs if total_pairs else 0.0,
+        "max_pair_repeats": max(pair_counts.values(), default=0),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Simulate weekly coffee break rounds offline.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--weeks", type=int, default=52)
+    parser.add_argument("--absence-rate", type=float, default=0.1)
+    parser.add_argument("--churn-rate", type=float, default=0.01)
+    parser.add_argument("--lookback-days", type=int, default=0, help="0 reads the complete history")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows down the run")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    result = simulate(
+        args.users, args.weeks, args.absence_rate, args.churn_rate, args.lookback_days, args.seed,
+        measure_memory=not args.no_memory,
+    )
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return 0
+
+    print(f"{'week':>4} {'roster':>7} {'available':>9} {'pairs':>6} {'latency':>9} {'peak MB':>8} {'retries':>7}  error")
+    for week in result["weeks"]:
+        print(f"{week['week']:>4} {week['roster']:>7} {week['available'] or '-':>9} {week['pairs']:>6} "
+              f"{week['latency'] * 1000:>7.1f}ms {week['peak_memory'] / 2 ** 20:>8.1f} {week['retries']:>7}  "
+              f"{week['error'] or ''}")
+
+    latencies = [week["latency"] for week in result["weeks"]]
+    print(f"\nlatency: median {statistics.median(latencies) * 1000:.1f}ms, max {max(latencies) * 1000:.1f}ms")
+    print(f"ValueErrors: {sum(1 for week in result['weeks'] if week['error'])}, "
+          f"retries: {sum(week['retries'] for week in result['weeks'])}")
+    for name, value in result["fairness"].items():
+        print(f"{name}: {value}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
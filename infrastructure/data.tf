@@ -20,6 +20,16 @@ data "aws_secretsmanager_secret_version" "users" {
   secret_id = data.aws_secretsmanager_secret.users.id
 }
 
+data "aws_secretsmanager_secret" "signing_secret" {
+  count = var.profile_cache ? 1 : 0
+  name  = "coffee-break-slack-bot/signing-secret"
+}
+
+data "aws_secretsmanager_secret_version" "signing_secret" {
+  count     = var.profile_cache ? 1 : 0
+  secret_id = data.aws_secretsmanager_secret.signing_secret[0].id
+}
+
 data "aws_iam_policy_document" "s3" {
   statement {
     effect = "Allow"
@@ -25,7 +25,7 @@ resource "aws_s3_bucket_lifecycle_configuration" "this" {
   bucket = aws_s3_bucket.lambda_bucket.id
 
   rule {
-    id = "keep_user_history_for_30_days"
+    id = "keep_user_history"
 
     filter {
       prefix = "user_history/"
@@ -33,7 +33,7 @@ resource "aws_s3_bucket_lifecycle_configuration" "this" {
     status = "Enabled"
 
     expiration {
-      days = 30
+      days = var.history_retention_days
     }
   }
 }
@@ -47,6 +47,27 @@ resource "aws_s3_object" "lambda_slack_bot" {
   etag = data.archive_file.this.output_md5
 }
 
+locals {
+  # Shared by the run and the plan Lambda
+  slack_bot_environment = {
+    LANGUAGE              = var.language
+    SLACK_TOKEN           = data.aws_secretsmanager_secret_version.slack_token.secret_string
+    USERS                 = data.aws_secretsmanager_secret_version.users.secret_string
+    S3_BUCKET             = aws_s3_bucket.lambda_bucket.bucket
+    S3_PREFIX             = "user_history"
+    DISPATCH_CONCURRENCY  = var.dispatch_concurrency
+    S3_COMPACT_HISTORY    = var.compact_history
+    HISTORY_LOOKBACK_DAYS = var.history_lookback_days
+    S3_CACHE_DIR          = "/tmp/history_cache"
+    PROFILE_CACHE         = var.profile_cache
+    ROSTER_CHANNELS       = var.roster_channels
+    DISPATCH_QUEUE_URL    = var.dispatch_queue ? aws_sqs_queue.dispatch[0].url : ""
+    PIPELINED_RUN         = var.pipelined_run
+    SCHEDULED_DELIVERY    = var.scheduled_delivery
+    DELIVERY_HOUR         = var.delivery_hour
+  }
+}
+
 resource "aws_lambda_function" "slack_bot" {
   function_name = "coffee-break-slack-bot"
 
@@ -61,26 +82,139 @@ resource "aws_lambda_function" "slack_bot" {
 
   role = aws_iam_role.lambda_exec.arn
 
+  environment {
+    variables = local.slack_bot_environment
+  }
+}
+
+resource "aws_lambda_function" "slack_events" {
+  count         = var.profile_cache ? 1 : 0
+  function_name = "coffee-break-slack-bot-events"
+
+  s3_bucket = aws_s3_bucket.lambda_bucket.id
+  s3_key    = aws_s3_object.lambda_slack_bot.key
+
+  runtime = "python3.9"
+  handler = "app.events_handler"
+  timeout = 10 # in seconds
+  # Events update the profile cache one after another, so concurrent updates
+  # don't overwrite each other. Slack retries throttled events.
+  reserved_concurrent_executions = 1
+
+  source_code_hash = data.archive_file.this.output_base64sha256
+
+  role = aws_iam_role.lambda_exec.arn
+
+  environment {
+    variables = {
+      SLACK_SIGNING_SECRET = data.aws_secretsmanager_secret_version.signing_secret[0].secret_string
+      S3_BUCKET            = aws_s3_bucket.lambda_bucket.bucket
+      S3_PREFIX            = "user_history"
+      PROFILE_CACHE        = true
+    }
+  }
+}
+
+resource "aws_lambda_function_url" "slack_events" {
+  count              = var.profile_cache ? 1 : 0
+  function_name      = aws_lambda_function.slack_events[0].function_name
+  authorization_type = "NONE" # requests are verified with the Slack signing secret
+}
+
+output "slack_events_url" {
+  description = "Request URL for the Event Subscriptions of the Slack app"
+  value       = var.profile_cache ? aws_lambda_function_url.slack_events[0].function_url : null
+}
+
+resource "aws_sqs_queue" "dispatch_dead_letters" {
+  count                     = var.dispatch_queue ? 1 : 0
+  name                      = "coffee-break-slack-bot-dispatch-dlq"
+  message_retention_seconds = 1209600 # 14 days
+}
+
+resource "aws_sqs_queue" "dispatch" {
+  count = var.dispatch_queue ? 1 : 0
+  name  = "coffee-break-slack-bot-dispatch"
+  # At least six times the timeout of the worker, as recommended for Lambda event sources
+  visibility_timeout_seconds = 180
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.dispatch_dead_letters[0].arn
+    maxReceiveCount     = 3
+  })
+}
+
+resource "aws_lambda_function" "slack_worker" {
+  count         = var.dispatch_queue ? 1 : 0
+  function_name = "coffee-break-slack-bot-worker"
+
+  s3_bucket = aws_s3_bucket.lambda_bucket.id
+  s3_key    = aws_s3_object.lambda_slack_bot.key
+
+  runtime = "python3.9"
+  handler = "app.worker_handler"
+  timeout = 30 # in seconds
+  # Bounds the parallel calls to Slack
+  reserved_concurrent_executions = var.dispatch_workers
+
+  source_code_hash = data.archive_file.this.output_base64sha256
+
+  role = aws_iam_role.lambda_exec.arn
+
   environment {
     variables = {
       LANGUAGE    = var.language
       SLACK_TOKEN = data.aws_secretsmanager_secret_version.slack_token.secret_string
-      USERS       = data.aws_secretsmanager_secret_version.users.secret_string
-      S3_BUCKET   = aws_s3_bucket.lambda_bucket.bucket
-      S3_PREFIX   = "user_history"
     }
   }
 }
 
+resource "aws_lambda_event_source_mapping" "slack_worker" {
+  count            = var.dispatch_queue ? 1 : 0
+  event_source_arn = aws_sqs_queue.dispatch[0].arn
+  function_name    = aws_lambda_function.slack_worker[0].arn
+  batch_size       = 10
+  # Only the failed jobs of a batch are retried
+  function_response_types = ["ReportBatchItemFailures"]
+}
+
+resource "aws_iam_policy" "sqs_policy" {
+  count = var.dispatch_queue ? 1 : 0
+  name  = "SQSDispatchAccess"
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [{
+      Effect = "Allow"
+      Action = [
+        "sqs:SendMessage",
+        "sqs:ReceiveMessage",
+        "sqs:DeleteMessage",
+        "sqs:GetQueueAttributes",
+      ]
+      Resource = aws_sqs_queue.dispatch[0].arn
+    }]
+  })
+}
+
+resource "aws_iam_role_policy_attachment" "sqs_policy" {
+  count      = var.dispatch_queue ? 1 : 0
+  role       = aws_iam_role.lambda_exec.name
+  policy_arn = aws_iam_policy.sqs_policy[0].arn
+}
+
 resource "aws_lambda_function_event_invoke_config" "this" {
-  function_name          = aws_lambda_function.slack_bot.function_name
-  maximum_retry_attempts = 0
+  function_name = aws_lambda_function.slack_bot.function_name
+  # A run that runs out of time stops with an error after saving its progress,
+  # the retries resume it
+  maximum_retry_attempts = 2
 }
 
 resource "aws_cloudwatch_event_rule" "cloudwatch_scheduled_event" {
   name                = "cloudwatch-scheduled-event"
   description         = "Fires every monday at 11am"
-  schedule_expression = "cron(0 9 ? * MON *)"
+  # Scheduled messages are scheduled at the start of monday, before the delivery time of most time zones
+  schedule_expression = var.scheduled_delivery ? "cron(0 0 ? * MON *)" : "cron(0 9 ? * MON *)"
 }
 
 resource "aws_cloudwatch_event_target" "slack_bot_trigger" {
@@ -89,6 +223,50 @@ resource "aws_cloudwatch_event_target" "slack_bot_trigger" {
   arn       = aws_lambda_function.slack_bot.arn
 }
 
+resource "aws_lambda_function" "slack_bot_plan" {
+  count         = var.plan_pairs ? 1 : 0
+  function_name = "coffee-break-slack-bot-plan"
+
+  s3_bucket = aws_s3_bucket.lambda_bucket.id
+  s3_key    = aws_s3_object.lambda_slack_bot.key
+
+  runtime = "python3.9"
+  handler = "app.plan_handler"
+  # Selecting the pairs of large rosters takes longer than sending them
+  timeout = 300 # in seconds
+
+  source_code_hash = data.archive_file.this.output_base64sha256
+
+  role = aws_iam_role.lambda_exec.arn
+
+  environment {
+    variables = local.slack_bot_environment
+  }
+}
+
+resource "aws_cloudwatch_event_rule" "plan" {
+  count               = var.plan_pairs ? 1 : 0
+  name                = "coffee-break-slack-bot-plan"
+  description         = "Plans the pairs of the next round every sunday night"
+  schedule_expression = "cron(0 20 ? * SUN *)"
+}
+
+resource "aws_cloudwatch_event_target" "plan" {
+  count     = var.plan_pairs ? 1 : 0
+  rule      = aws_cloudwatch_event_rule.plan[0].name
+  target_id = "slack-bot-plan-lambda"
+  arn       = aws_lambda_function.slack_bot_plan[0].arn
+}
+
+resource "aws_lambda_permission" "allow_plan_schedule" {
+  count         = var.plan_pairs ? 1 : 0
+  statement_id  = "AllowExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.slack_bot_plan[0].function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.plan[0].arn
+}
+
 resource "aws_cloudwatch_log_group" "slack_bot" {
   name = "/aws/lambda/${aws_lambda_function.slack_bot.function_name}"
 
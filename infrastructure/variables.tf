@@ -2,4 +2,76 @@ variable "language" {
   type        = string
   description = "ISO 639-1 language code for the language of the message"
   default     = "en"
-}
\ No newline at end of file
+}
+
+variable "dispatch_concurrency" {
+  type        = number
+  description = "Number of coffee break messages sent concurrently. 1 sends them one after another"
+  default     = 1
+}
+
+variable "compact_history" {
+  type        = bool
+  description = "Keep a snapshot of the user history in S3, so that a run only reads the snapshot and the runs written since"
+  default     = false
+}
+
+variable "scheduled_delivery" {
+  type        = bool
+  description = "Schedule the messages for delivery_hour in the time zones of the users instead of posting them at once"
+  default     = false
+}
+
+variable "delivery_hour" {
+  type        = number
+  description = "Local hour at which scheduled messages are delivered"
+  default     = 9
+}
+
+variable "plan_pairs" {
+  type        = bool
+  description = "Plan the pairs of the next round on sunday night, so that the monday run only re-checks absences and sends"
+  default     = false
+}
+
+variable "pipelined_run" {
+  type        = bool
+  description = "Run independent phases of a run concurrently, e.g. the roster fetch and the history read"
+  default     = false
+}
+
+variable "history_retention_days" {
+  type        = number
+  description = "Number of days the user history is kept in the bucket"
+  default     = 30
+}
+
+variable "history_lookback_days" {
+  type        = number
+  description = "Number of days of user history read for a run. 0 reads the complete history"
+  default     = 0
+}
+
+variable "profile_cache" {
+  type        = bool
+  description = "Keep the Slack profiles up to date from user_change events, so the weekly run only looks up users missing from the cache"
+  default     = false
+}
+
+variable "roster_channels" {
+  type        = string
+  description = "Comma separated ids of Slack channels whose members form the roster instead of the users secret"
+  default     = ""
+}
+
+variable "dispatch_queue" {
+  type        = bool
+  description = "Queue a job per pair in SQS and send the messages from worker Lambdas instead of the pairing Lambda"
+  default     = false
+}
+
+variable "dispatch_workers" {
+  type        = number
+  description = "Maximum number of concurrent worker Lambdas when dispatch_queue is enabled"
+  default     = 5
+}
@@ -2,4 +2,7 @@
 
 rm -r ./slack_bot_with_dependencies/
 cp -r slack_bot slack_bot_with_dependencies
-pip install -r requirements.txt -t ./slack_bot_with_dependencies/
+# numpy and aiohttp are compiled packages, install the wheels of the Lambda runtime (python3.9 on x86_64 Linux)
+# instead of the ones of the host
+pip install -r requirements.txt -t ./slack_bot_with_dependencies/ \
+  --platform manylinux2014_x86_64 --python-version 3.9 --implementation cp --only-binary=:all:
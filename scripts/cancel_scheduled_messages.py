@@ -0,0 +1,37 @@
+"""Cancel the scheduled messages of the current round, so that the next invocation pairs the round again.
+
+Usage: SLACK_TOKEN=xoxb-... python scripts/cancel_scheduled_messages.py (--bucket BUCKET | --database history.db) --prefix user_history
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_bot.app import (  # noqa: E402
+    S3FileHandler,
+    SQLiteFileHandler,
+    cancel_scheduled_messages,
+    get_slack_client,
+    get_token,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--prefix", required=True)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--bucket")
+    target.add_argument("--database")
+    args = parser.parse_args()
+
+    if args.database:
+        file_handler = SQLiteFileHandler(args.database, args.prefix)
+    else:
+        file_handler = S3FileHandler(args.bucket, args.prefix)
+    cancelled = cancel_scheduled_messages(file_handler, get_slack_client(get_token()))
+    print(f"Cancelled {cancelled} scheduled messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""Import the JSON user history of an S3 prefix into a SQLite history database.
+
+Usage: python scripts/import_history.py --bucket BUCKET --prefix user_history --database history.db
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_bot.app import S3FileHandler, SQLiteFileHandler  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--prefix", required=True)
+    parser.add_argument("--database", required=True)
+    args = parser.parse_args()
+
+    imported = SQLiteFileHandler(args.database, args.prefix).import_history(S3FileHandler(args.bucket, args.prefix))
+    print(f"Imported {imported} runs from s3://{args.bucket}/{args.prefix} into {args.database}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Measure the import time of the Lambda module and the latency of a cold and a warm invocation.
+
+Slack is replaced by canned responses and S3 by moto, so the numbers only
+contain the bot's own overhead (imports, client creation, parsing, selection).
+
+Usage: python scripts/measure_cold_start.py [--users 200] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SLACK_BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "slack_bot")
+
+# Runs in a fresh interpreter per repetition, so every measurement is a cold start
+INVOCATION_SCRIPT = """
+import json, os, sys, time
+from unittest import mock
+
+start = time.perf_counter()
+import app
+import_seconds = time.perf_counter() - start
+
+from moto import mock_s3
+
+users = json.loads(os.environ["USERS"])
+
+
+def api_call(self, api_method, **kwargs):
+    if api_method == "users.list":
+        members = [
+            {"id": user_id, "deleted": False, "profile": {"real_name": name, "status_emoji": "", "status_expiration": 0}}
+            for name, user_id in users.items()
+        ]
+        return {"members": members, "response_metadata": {"next_cursor": ""}}
+    if api_method == "conversations.open":
+        return {"channel": {"id": "D1"}}
+    return {"ok": True}
+
+
+with mock_s3(), mock.patch("slack_sdk.WebClient.api_call", api_call):
+    import boto3
+    s3 = boto3.client("s3", region_name="us-east-1")
+    s3.create_bucket(Bucket=os.environ["S3_BUCKET"])
+    timings = []
+    for _ in range(2):
+        # Without the checkpoint of the first invocation the warm one runs the round again
+        s3.delete_object(Bucket=os.environ["S3_BUCKET"], Key=f"{os.environ['S3_PREFIX']}/_state/checkpoint.json")
+        start = time.perf_counter()
+        app.handler({}, None)
+        timings.append(time.perf_counter() - start)
+
+print(json.dumps({"import": import_seconds, "cold": timings[0], "warm": timings[1]}))
+"""
+
+
+def measure_import_time() -> list:
+    # Cumulative import time of every module imported by app, in seconds
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=SLACK_BOT_DIR, capture_output=True, text=True, check=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            modules.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(modules, reverse=True)
+
+
+def measure_invocations(users: int, repeat: int) -> list:
+    env = dict(
+        os.environ,
+        AWS_ACCESS_KEY_ID="testing",
+        AWS_SECRET_ACCESS_KEY="testing",
+        AWS_DEFAULT_REGION="us-east-1",
+        S3_BUCKET="cold-start-bucket",
+        S3_PREFIX="user_history",
+        SLACK_TOKEN="xoxb-test",
+        USERS=json.dumps({f"user{i}": f"U{i:05d}" for i in range(users)}),
+    )
+    results = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", INVOCATION_SCRIPT],
+            cwd=SLACK_BOT_DIR, env=env, capture_output=True, text=True, check=True,
+        )
+        results.append(json.loads(output.stdout.splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("Slowest imports of app (cumulative):")
+    for seconds, name in measure_import_time()[:10]:
+        print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+    results = measure_invocations(args.users, args.repeat)
+    print(f"\nMedian of {args.repeat} runs with {args.users} users:")
+    for phase in ["import", "cold", "warm"]:
+        print(f"  {phase:>6}: {statistics.median(result[phase] for result in results) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""Replay recorded Slack user_change events into the profile cache of an S3 prefix or a SQLite database.
+
+Usage: python scripts/replay_user_events.py --events events.jsonl (--bucket BUCKET | --database history.db) --prefix user_history
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from slack_bot.app import S3FileHandler, SQLiteFileHandler, replay_user_events  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", required=True, help="one Events API payload per line")
+    parser.add_argument("--prefix", required=True)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--bucket")
+    target.add_argument("--database")
+    args = parser.parse_args()
+
+    if args.database:
+        file_handler = SQLiteFileHandler(args.database, args.prefix)
+    else:
+        file_handler = S3FileHandler(args.bucket, args.prefix)
+    changed = replay_user_events(file_handler, args.events)
+    print(f"Updated {changed} profiles from {args.events}")
+
+
+if __name__ == "__main__":
+    main()
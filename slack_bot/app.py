@@ -1,19 +1,416 @@
+from __future__ import annotations
+
+import base64
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
 import random
 import math
+import socket
+import threading
+import time
 from abc import ABC, abstractmethod
-from datetime import datetime, timedelta
-from typing import List
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterator, List, Optional
+from urllib.error import URLError
 
-import boto3
-from slack_sdk import WebClient
+# boto3, numpy, slack_sdk and asyncio are imported where they are needed, so entry points
+# that don't use them don't pay for the import on a cold start
+if TYPE_CHECKING:
+    import numpy as np
+    from slack_sdk import WebClient
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 ABSENCE_EMOJIS = [":palm_tree:", ":face_with_thermometer:", ":baby:"]
 
+# Rosters of at least this size are fetched by paging through users.list,
+# smaller ones with individual users.info calls
+USERS_LIST_MIN_USERS = 50
+USERS_LIST_PAGE_SIZE = 200
+USERS_INFO_MAX_WORKERS = 8
+
+# Every previous meeting of two users adds PAIR_REPEAT_COST to the cost of
+# pairing them again, halved every PAIR_COST_HALF_LIFE_DAYS. Pairs of the latest
+# run are forbidden.
+PAIR_REPEAT_COST = 1.0
+PAIR_COST_HALF_LIFE_DAYS = 90
+FORBIDDEN_PAIR_COST = 1e9
+# Pairings are minimum cost perfect matchings (blossom algorithm of networkx),
+# on costs scaled to integers so that the matching is exact. Larger selections
+# are matched in independent blocks to bound time and memory.
+MATCHING_COST_SCALE = 10 ** 6
+MATCHING_BLOCK_SIZE = 500
+
+# Number of history objects fetched concurrently, also the size of the S3 connection pool
+S3_MAX_WORKERS = 16
+# Size of the local cache of parsed history objects, least recently used objects are evicted
+S3_CACHE_MAX_MB = 256
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+@dataclass
+class ReadStats:
+    objects: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    retries: int = 0
+    cache_hits: int = 0
+    # (key, bytes, seconds) per fetched object
+    object_timings: list = field(default_factory=list)
+
+
+# Calls per minute of Slack's rate limit tiers (https://api.slack.com/docs/rate-limits).
+# Slack documents them as minimums and allows bursts above them, so pacing is
+# opt-in (SLACK_RATE_LIMITS=true); 429 responses are honoured either way. Every
+# method gets a token bucket holding a minute of calls, chat.postMessage is
+# limited per channel.
+SLACK_TIER_RATES = {1: 1, 2: 20, 3: 50, 4: 100}
+SLACK_METHOD_TIERS = {
+    "users.list": 2,
+    "users.info": 4,
+    "conversations.open": 3,
+    "conversations.info": 3,
+    "conversations.members": 4,
+}
+SLACK_DEFAULT_TIER = 3
+SLACK_PER_CHANNEL_METHODS = {"chat.postMessage": 60}
+# Throttled (429) calls are retried after Retry-After, failed calls (5xx,
+# connection errors) after an exponential backoff, both with up to
+# SLACK_BACKOFF_SECONDS of jitter. A 5xx of a method that posts may come after
+# Slack accepted the post, so those methods are not retried on 5xx.
+SLACK_MAX_RETRIES = 3
+SLACK_BACKOFF_SECONDS = 1.0
+SLACK_NON_IDEMPOTENT_METHODS = {"chat.postMessage", "chat.scheduleMessage"}
+
+# Number of rosters processed concurrently in multi-roster mode
+ROSTER_MAX_WORKERS = 8
+
+# Dispatch progress is persisted after every batch of pairs, and no new batch is
+# started when less than the safety margin of the Lambda's time is left
+CHECKPOINT_STATE = "checkpoint"
+CHECKPOINT_BATCH_SIZE = 10
+CHECKPOINT_SAFETY_MARGIN_SECONDS = 10
+
+# Profiles kept up to date from Slack user_change events. Entries that no event
+# refreshed within the max age are looked up again, in case events were missed
+PROFILE_CACHE_STATE = "profiles"
+PROFILE_CACHE_MAX_AGE_DAYS = 30
+PROFILE_EVENT_TYPES = ("user_change", "team_join")
+
+# With a dispatch queue the pairing invocation queues a job per pair, and worker
+# invocations send the messages. The checkpoint is saved after every batch of jobs.
+QUEUE_PUBLISH_BATCH_SIZE = 100
+SQS_BATCH_SIZE = 10
+
+# Opt-in profiling of an invocation: a cProfile dump and the top allocation sites
+# of tracemalloc are written as blobs of the profile file handler
+PROFILE_TOP_ALLOCATIONS = 50
+PROFILE_TRACEMALLOC_FRAMES = 5
+
+# Members of roster channels are cached between runs. A cached membership is
+# reused while the member count of the channel is unchanged, and fetched again
+# after the max age, because a join and a leave between two runs keep the count.
+MEMBERSHIP_STATE = "members"
+MEMBERSHIP_CACHE_MAX_AGE_DAYS = 28
+CONVERSATIONS_MEMBERS_PAGE_SIZE = 200
+
+# Scheduled delivery: instead of posting at once, messages are scheduled for
+# DELIVERY_HOUR on the run day in the time zones of both users of a pair,
+# whichever is later. Slack rejects times in the past, so times that are less
+# than the lead ahead are moved to the lead.
+SCHEDULED_DELIVERY_DEFAULT_HOUR = 9
+SCHEDULE_MIN_LEAD_SECONDS = 60
+
+# The pairs of the next round can be planned ahead of the monday run (see
+# plan_handler). A plan is only used for the round it was made for and with
+# the current version of its format, otherwise the pairs are selected inline.
+PLAN_STATE = "plan"
+PLAN_VERSION = 2
+
+
+class DispatchIncomplete(Exception):
+    # results holds the pairs that were dispatched before the deadline
+    def __init__(self, message: str, results: Optional[list] = None):
+        super().__init__(message)
+        self.results = results or []
+
+
+@dataclass
+class RosterResult:
+    name: str
+    pairs: int = 0
+    delivered: int = 0
+    failed_pairs: list = field(default_factory=list)
+    error: Optional[str] = None
+
+
+@dataclass
+class DispatchResult:
+    pair: tuple
+    delivered: bool
+    error: Optional[str] = None
+
+
+METRICS_NAMESPACE = "CoffeeBreakSlackBot"
+
+
+def print_metrics(record: dict) -> None:
+    # Lambda forwards stdout to CloudWatch Logs, which extracts the metrics of EMF records
+    print(json.dumps(record))
+
+
+class Metrics:
+    # Per phase timings and counters of a run, emitted as one CloudWatch
+    # Embedded Metric Format record. The sink receives the record, so tests
+    # can capture it.
+    def __init__(self, sink=print_metrics, dimensions: Optional[dict] = None):
+        self.sink = sink
+        self.dimensions = dimensions or {}
+        self.values: dict[str, float] = {}
+        self.units: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def put(self, name: str, value: float, unit: str = "Count") -> None:
+        with self._lock:
+            self.values[name] = value
+            self.units[name] = unit
+
+    def increment(self, name: str, value: float = 1, unit: str = "Count") -> None:
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.increment(f"{name}Time", (time.perf_counter() - start) * 1000, "Milliseconds")
+
+    def emit(self) -> dict:
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [list(self.dimensions)],
+                    "Metrics": [{"Name": name, "Unit": self.units[name]} for name in self.values],
+                }],
+            },
+            **self.dimensions,
+            **self.values,
+        }
+        if self.sink is not None:
+            self.sink(record)
+        return record
+
+
+class MeteredClient:
+    # Counts the Slack Web API calls per method, e.g. users_info as "SlackCalls.users.info"
+    def __init__(self, client, metrics: Metrics):
+        self.client = client
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name.startswith("_"):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.metrics.increment(f"SlackCalls.{name.replace('_', '.', 1)}")
+            return attribute(*args, **kwargs)
+
+        return call
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # Takes a token and returns the seconds to wait until it is available.
+        # Tokens can be owed, so concurrent callers are queued one after another.
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        # No tokens for the given time, e.g. after a Retry-After
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class RateLimiter:
+    # Buckets per Slack method, shared by all clients of the process because
+    # Slack limits the calls of the app per workspace
+    def __init__(self, method_rates: Optional[dict[str, float]] = None):
+        self.method_rates = method_rates or {}
+        self.buckets: dict[tuple, TokenBucket] = {}
+        self.throttled: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _rate(self, method: str) -> float:
+        if method in self.method_rates:
+            return self.method_rates[method]
+        if method in SLACK_PER_CHANNEL_METHODS:
+            return SLACK_PER_CHANNEL_METHODS[method]
+        return SLACK_TIER_RATES[SLACK_METHOD_TIERS.get(method, SLACK_DEFAULT_TIER)]
+
+    def bucket(self, method: str, channel: Optional[str] = None) -> TokenBucket:
+        key = (method, channel if method in SLACK_PER_CHANNEL_METHODS else None)
+        with self._lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(self._rate(method))
+            return self.buckets[key]
+
+    def count_throttled(self, method: str) -> None:
+        with self._lock:
+            self.throttled[method] = self.throttled.get(method, 0) + 1
+
+
+def _retry_delay(method: str, error: Exception, attempt: int) -> Optional[float]:
+    # Seconds to wait before retrying a failed call, None if it isn't retried
+    if attempt >= SLACK_MAX_RETRIES:
+        return None
+
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code == 429:
+        headers = {key.lower(): value for key, value in (getattr(response, "headers", None) or {}).items()}
+        retry_after = headers.get("retry-after")
+        delay = float(retry_after) if retry_after else SLACK_BACKOFF_SECONDS * 2 ** attempt
+    elif method in SLACK_NON_IDEMPOTENT_METHODS:
+        # A message may have been posted unless the request never reached Slack
+        if not _is_connect_error(error):
+            return None
+        delay = SLACK_BACKOFF_SECONDS * 2 ** attempt
+    elif isinstance(error, OSError) or (status_code is not None and status_code >= 500):
+        delay = SLACK_BACKOFF_SECONDS * 2 ** attempt
+    else:
+        return None
+    return delay + random.uniform(0, SLACK_BACKOFF_SECONDS)
+
+
+def _is_connect_error(error: Exception) -> bool:
+    # Errors of a connection that was never established. Timeouts and errors
+    # after the request was sent don't tell whether Slack received it.
+    if isinstance(error, URLError):
+        error = error.reason
+    if isinstance(error, (ConnectionRefusedError, socket.gaierror)):
+        return True
+    try:
+        from aiohttp import ClientConnectorError
+    except ImportError:
+        return False
+    return isinstance(error, ClientConnectorError)
+
+
+def _is_throttled(error: Exception) -> bool:
+    return getattr(getattr(error, "response", None), "status_code", None) == 429
+
+
+class RateLimitedClient:
+    # Retries throttled and failed calls and, with a limiter, waits for a token
+    # of the method's bucket before every call. Throttled calls and waiting times
+    # are counted in the metrics. A wait that would end after the deadline raises
+    # DispatchIncomplete instead, so the checkpoint is saved in time.
+    def __init__(
+        self,
+        client,
+        limiter: Optional[RateLimiter] = None,
+        metrics: Optional[Metrics] = None,
+        deadline: Optional[float] = None,
+    ):
+        self.client = client
+        self.limiter = limiter
+        self.metrics = metrics or Metrics(sink=None)
+        self.deadline = deadline
+
+    def _check_deadline(self, method: str, wait: float) -> None:
+        if self.deadline is not None and time.monotonic() + wait > self.deadline:
+            raise DispatchIncomplete(f"Waiting {wait:.1f}s for {method} would pass the deadline")
+
+    def _before_call(self, method: str, kwargs: dict) -> float:
+        if self.limiter is None:
+            return 0.0
+        wait = self.limiter.bucket(method, kwargs.get("channel")).reserve()
+        if wait > 0:
+            self._check_deadline(method, wait)
+            self.metrics.increment("SlackRateLimitWaitTime", wait * 1000, "Milliseconds")
+        return wait
+
+    def _after_error(self, method: str, kwargs: dict, error: Exception, attempt: int) -> float:
+        delay = _retry_delay(method, error, attempt)
+        if delay is None:
+            raise error
+        if _is_throttled(error):
+            logger.info(f"Slack throttled {method}, retry in {delay:.1f}s")
+            self.metrics.increment(f"SlackThrottled.{method}")
+            if self.limiter is not None:
+                self.limiter.count_throttled(method)
+                self.limiter.bucket(method, kwargs.get("channel")).pause(delay)
+        self._check_deadline(method, delay)
+        return delay
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name.startswith("_"):
+            return attribute
+        method = name.replace("_", ".", 1)
+
+        def call(*args, **kwargs):
+            for attempt in itertools.count():
+                time.sleep(self._before_call(method, kwargs))
+                try:
+                    return attribute(*args, **kwargs)
+                except Exception as e:
+                    time.sleep(self._after_error(method, kwargs, e, attempt))
+
+        return call
+
+
+class AsyncRateLimitedClient(RateLimitedClient):
+    # Same for the AsyncWebClient, waiting doesn't block the event loop
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name.startswith("_"):
+            return attribute
+        method = name.replace("_", ".", 1)
+
+        async def call(*args, **kwargs):
+            import asyncio
+
+            for attempt in itertools.count():
+                await asyncio.sleep(self._before_call(method, kwargs))
+                try:
+                    return await attribute(*args, **kwargs)
+                except Exception as e:
+                    await asyncio.sleep(self._after_error(method, kwargs, e, attempt))
+
+        return call
+
 
 class FileHandler(ABC):
     @abstractmethod
@@ -24,27 +421,236 @@ class FileHandler(ABC):
     def write(self, data: List[dict]) -> None:
         pass
 
+    def iter_runs(self, since: Optional[date] = None) -> Iterator[dict]:
+        return _runs_since(self.read(), since)
+
+    def read_history(self, since: Optional[date] = None) -> "History":
+        # Runs are interned one at a time, the parsed list of all runs is never held
+        return History.from_runs(self.iter_runs(since))
+
+    def remove_runs(self, runs: List[dict]) -> None:
+        # Removes runs that were written before, e.g. of a cancelled round
+        raise NotImplementedError(f"{type(self).__name__} can't remove runs")
+
+    # Small named documents next to the history (e.g. the dispatch checkpoint).
+    # Handlers that can't store them don't persist anything.
+    def read_state(self, name: str) -> Optional[dict]:
+        return None
+
+    def write_state(self, name: str, data: dict) -> None:
+        pass
+
+    # Binary files next to the history (e.g. profiles of a run), same as state
+    def read_blob(self, name: str) -> Optional[bytes]:
+        return None
+
+    def write_blob(self, name: str, data: bytes) -> None:
+        pass
+
+
+def _run_keys(runs: List[dict]) -> set[tuple]:
+    return {(run["date"], tuple(run["pair"])) for run in runs}
+
+
+def _runs_since(runs: List[dict], since: Optional[date]) -> Iterator[dict]:
+    if since is None:
+        yield from runs
+        return
+
+    since = since.isoformat()
+    for run in runs:
+        if run["date"] >= since:
+            yield run
+
+
+class DiskCache:
+    # Parsed history objects in a local directory (e.g. /tmp of a Lambda, which
+    # survives warm invocations), keyed by object key and ETag. A changed object
+    # gets a new ETag and thereby a new entry, the old one is evicted eventually.
+    def __init__(self, directory: str, max_bytes: int = S3_CACHE_MAX_MB * 2 ** 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+    def _path(self, key: str, etag: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(f"{key}\0{etag}".encode()).hexdigest() + ".json")
+
+    def get(self, key: str, etag: str):
+        path = self._path(key, etag)
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(f.read())
+            # The modification time orders the entries for eviction
+            os.utime(path)
+            return data
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, etag: str, data) -> None:
+        path = self._path(key, etag)
+        body = json.dumps(data).encode("utf-8")
+        if len(body) > self.max_bytes:
+            return
+        try:
+            temporary_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as f:
+                f.write(body)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            logger.warning(f"Error writing {key} to the history cache: {e}")
+            return
+
+        with self._lock:
+            self._size += len(body)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # Down to 90% of the limit, so not every put scans the directory
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.directory) if entry.is_file()
+        )
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+
+def _decode_object(body: bytes):
+    # Objects are written gzip compressed, older ones are plain JSON
+    if body[:2] == GZIP_MAGIC:
+        body = gzip.decompress(body)
+    return json.loads(body.decode("utf-8"))
+
 
 class S3FileHandler(FileHandler):
-    def __init__(self, bucket: str, prefix: str):
-        self.s3 = boto3.client("s3")
+    # With compact=True a snapshot object holds the parsed runs of all run
+    # objects it already includes (keyed by object key), so a read only fetches
+    # the snapshot and the run objects written since. With a cache, run objects
+    # that were already read and didn't change aren't fetched again.
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str,
+        compact: bool = False,
+        max_workers: int = S3_MAX_WORKERS,
+        s3=None,
+        cache: Optional[DiskCache] = None,
+    ):
+        # boto3 clients are thread safe, all fetches share one connection pool
+        self.s3 = s3 or create_s3_client(max_workers)
         self.bucket = bucket
         self.prefix = prefix
+        self.compact = compact
+        self.max_workers = max_workers
+        self.cache = cache
+        self.last_read_stats = ReadStats()
+        self._snapshot: Optional[dict[str, List[dict]]] = None
 
     def _get_object_key(self):
         current_date = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        return f"{self.prefix}/{current_date}.json"
+        return f"{self.prefix}/{current_date}.json.gz"
 
-    def read(self) -> List[dict]:
+    def _get_snapshot_key(self):
+        return f"{self.prefix}/_snapshot.json"
+
+    def _is_run_key(self, key: str) -> bool:
+        # Objects starting with "_" are bookkeeping and not part of the history
+        return not key[len(self.prefix):].lstrip("/").startswith("_")
+
+    def _list_run_objects(self, start_after: Optional[str] = None) -> dict[str, str]:
+        # ETag per key, in key order
+        paginator = self.s3.get_paginator("list_objects_v2")
+        parameters = {"Bucket": self.bucket, "Prefix": self.prefix}
+        if start_after:
+            parameters["StartAfter"] = start_after
+
+        etags = {}
+        for page in paginator.paginate(**parameters):
+            for obj in page.get("Contents", []):
+                if self._is_run_key(obj["Key"]):
+                    etags[obj["Key"]] = obj.get("ETag", "")
+        return dict(sorted(etags.items()))
+
+    def _read_object(self, key: str):
+        start = time.perf_counter()
+        response = self.s3.get_object(Bucket=self.bucket, Key=key)
+        body = response["Body"].read()
+        self.last_read_stats.retries += response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        self.last_read_stats.object_timings.append((key, len(body), time.perf_counter() - start))
+        return _decode_object(body)
+
+    def _read_run_object(self, key: str, etag: str):
+        if self.cache is None:
+            return self._read_object(key)
+
+        data = self.cache.get(key, etag)
+        if data is not None:
+            self.last_read_stats.cache_hits += 1
+            return data
+        data = self._read_object(key)
+        self.cache.put(key, etag, data)
+        return data
+
+    def _read_snapshot(self) -> dict[str, List[dict]]:
         try:
-            object_list = self.s3.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix)
-            file_keys = [obj["Key"] for obj in object_list.get("Contents", [])]
+            return self._read_object(self._get_snapshot_key())["objects"]
+        except self.s3.exceptions.NoSuchKey:
+            return {}
 
+    def _iter_objects(self, since: Optional[date] = None) -> Iterator[tuple]:
+        # Yields (key, runs) in key order. Objects are fetched concurrently a
+        # chunk at a time, so only a chunk of parsed objects is held at once.
+        start = time.perf_counter()
+        self.last_read_stats = ReadStats()
+
+        # Keys carry the time they were written, so objects from before the
+        # lookback window are not even listed
+        start_after = f"{self.prefix}/{since.isoformat()}" if since else None
+        etags = self._list_run_objects(start_after)
+        file_keys = list(etags)
+
+        snapshot = {}
+        if self.compact:
+            # The snapshot is written again with the listed objects only, so
+            # objects removed by the lifecycle rule or before the window are
+            # dropped from it and it doesn't grow with the history
+            snapshot = self._read_snapshot()
+            self._snapshot = {}
+
+        chunk_size = self.max_workers * 4
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chunk_start in range(0, len(file_keys), chunk_size):
+                chunk = file_keys[chunk_start:chunk_start + chunk_size]
+                missing = [key for key in chunk if key not in snapshot]
+                fetched = dict(zip(missing, executor.map(self._read_run_object, missing, map(etags.get, missing))))
+                for key in chunk:
+                    runs = snapshot[key] if key in snapshot else fetched[key]
+                    if self.compact:
+                        self._snapshot[key] = runs
+                    yield key, runs
+
+        stats = self.last_read_stats
+        stats.objects = len(stats.object_timings)
+        stats.bytes = sum(size for _, size, _ in stats.object_timings)
+        stats.seconds = time.perf_counter() - start
+        logger.info(
+            f"Read {stats.objects} objects ({stats.bytes} bytes) from S3 in {stats.seconds:.2f}s, "
+            f"{stats.cache_hits} objects from the cache"
+        )
+
+    def read(self) -> List[dict]:
+        try:
             all_data = []
-            for file_key in sorted(file_keys):
-                response = self.s3.get_object(Bucket=self.bucket, Key=file_key)
-                data = response["Body"].read().decode("utf-8")
-                data_list = json.loads(data)
+            for _, data_list in self._iter_objects():
                 all_data.extend(data_list)
 
             return all_data
@@ -52,47 +658,1496 @@ class S3FileHandler(FileHandler):
             logger.warning(f"Error reading data from S3: {e}")
             return []
 
+    def iter_runs(self, since: Optional[date] = None) -> Iterator[dict]:
+        try:
+            for _, data_list in self._iter_objects(since):
+                yield from _runs_since(data_list, since)
+        except Exception as e:
+            logger.warning(f"Error reading data from S3: {e}")
+
+    def _get_state_key(self, name: str) -> str:
+        return f"{self.prefix}/_state/{name}.json"
+
+    def read_state(self, name: str) -> Optional[dict]:
+        try:
+            return self._read_object(self._get_state_key(name))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        except Exception as e:
+            logger.warning(f"Error reading state {name} from S3: {e}")
+            return None
+
+    def write_state(self, name: str, data: dict) -> None:
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self._get_state_key(name), Body=json.dumps(data))
+        except Exception as e:
+            logger.warning(f"Error writing state {name} to S3: {e}")
+
+    def _get_blob_key(self, name: str) -> str:
+        return f"{self.prefix}/_blobs/{name}"
+
+    def read_blob(self, name: str) -> Optional[bytes]:
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=self._get_blob_key(name))["Body"].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        except Exception as e:
+            logger.warning(f"Error reading blob {name} from S3: {e}")
+            return None
+
+    def write_blob(self, name: str, data: bytes) -> None:
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self._get_blob_key(name), Body=data)
+        except Exception as e:
+            logger.warning(f"Error writing blob {name} to S3: {e}")
+
     def write(self, data: List[dict]) -> None:
         try:
+            key = self._get_object_key()
             self.s3.put_object(
                 Bucket=self.bucket,
-                Key=self._get_object_key(),
-                Body=json.dumps(data),
+                Key=key,
+                Body=gzip.compress(json.dumps(data).encode("utf-8")),
             )
+
+            if self.compact:
+                if self._snapshot is None:
+                    for _ in self._iter_objects(get_history_since()):
+                        pass
+                self._snapshot[key] = data
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self._get_snapshot_key(),
+                    Body=gzip.compress(json.dumps({"objects": self._snapshot}).encode("utf-8")),
+                )
         except Exception as e:
             logger.warning(f"Error writing data to S3: {e}")
 
+    def remove_runs(self, runs: List[dict]) -> None:
+        # Run objects that contain removed runs are written again without them,
+        # objects are named by the time they were written, so only objects
+        # written since the earliest removed run are read
+        if not runs:
+            return
+        removed = _run_keys(runs)
+        try:
+            changed = {}
+            for key, data in self._iter_objects(date.fromisoformat(min(run["date"] for run in runs))):
+                kept = [run for run in data if (run["date"], tuple(run["pair"])) not in removed]
+                if len(kept) < len(data):
+                    changed[key] = kept
+
+            for key, kept in changed.items():
+                if kept:
+                    self.s3.put_object(
+                        Bucket=self.bucket, Key=key, Body=gzip.compress(json.dumps(kept).encode("utf-8"))
+                    )
+                    if self.compact:
+                        self._snapshot[key] = kept
+                else:
+                    self.s3.delete_object(Bucket=self.bucket, Key=key)
+                    if self.compact:
+                        self._snapshot.pop(key, None)
+            if self.compact and changed:
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self._get_snapshot_key(),
+                    Body=gzip.compress(json.dumps({"objects": self._snapshot}).encode("utf-8")),
+                )
+        except Exception as e:
+            logger.warning(f"Error removing runs from S3: {e}")
+
+
+class InMemoryFileHandler(FileHandler):
+    # Keeps runs and state in memory, e.g. for simulations and tests
+    def __init__(self, runs: Optional[List[dict]] = None):
+        self.runs = list(runs or [])
+        self.state: dict[str, str] = {}
+        self.blobs: dict[str, bytes] = {}
+
+    def read(self) -> List[dict]:
+        return list(self.runs)
+
+    def write(self, data: List[dict]) -> None:
+        self.runs.extend(json.loads(json.dumps(data)))
+
+    def remove_runs(self, runs: List[dict]) -> None:
+        removed = _run_keys(runs)
+        self.runs = [run for run in self.runs if (run["date"], tuple(run["pair"])) not in removed]
+
+    def read_state(self, name: str) -> Optional[dict]:
+        return json.loads(self.state[name]) if name in self.state else None
+
+    def write_state(self, name: str, data: dict) -> None:
+        self.state[name] = json.dumps(data)
+
+    def read_blob(self, name: str) -> Optional[bytes]:
+        return self.blobs.get(name)
+
+    def write_blob(self, name: str, data: bytes) -> None:
+        self.blobs[name] = bytes(data)
+
+
+class SQLiteFileHandler(FileHandler):
+    # Runs of all rosters in one indexed table, a handler reads and writes the
+    # runs of its prefix. Besides read/write it answers the queries of the
+    # selection directly, see SQLiteHistoryIndex.
+    def __init__(self, path: str, prefix: str = ""):
+        import sqlite3
+
+        self.path = path
+        self.prefix = prefix
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY,
+                    prefix TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    user_1 TEXT NOT NULL,
+                    user_2 TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS runs_by_date ON runs (prefix, date);
+                CREATE INDEX IF NOT EXISTS runs_by_user_1 ON runs (prefix, user_1, date);
+                CREATE INDEX IF NOT EXISTS runs_by_user_2 ON runs (prefix, user_2, date);
+                CREATE TABLE IF NOT EXISTS state (
+                    prefix TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (prefix, name)
+                );
+                CREATE TABLE IF NOT EXISTS blobs (
+                    prefix TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (prefix, name)
+                );
+            """)
+
+    def _query(self, sql: str, parameters=()) -> list:
+        with self._lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def read(self) -> List[dict]:
+        return list(self.iter_runs())
+
+    def iter_runs(self, since: Optional[date] = None) -> Iterator[dict]:
+        rows = self._query(
+            "SELECT date, user_1, user_2 FROM runs WHERE prefix = ? AND date >= ? ORDER BY id",
+            (self.prefix, since.isoformat() if since else ""),
+        )
+        for run_date, user_1, user_2 in rows:
+            yield {"date": run_date, "pair": [user_1, user_2]}
+
+    def write(self, data: List[dict]) -> None:
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO runs (prefix, date, user_1, user_2) VALUES (?, ?, ?, ?)",
+                [(self.prefix, run["date"], run["pair"][0], run["pair"][1]) for run in data],
+            )
+
+    def remove_runs(self, runs: List[dict]) -> None:
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM runs WHERE prefix = ? AND date = ? AND user_1 = ? AND user_2 = ?",
+                [(self.prefix, run["date"], run["pair"][0], run["pair"][1]) for run in runs],
+            )
+
+    def read_state(self, name: str) -> Optional[dict]:
+        rows = self._query("SELECT data FROM state WHERE prefix = ? AND name = ?", (self.prefix, name))
+        return json.loads(rows[0][0]) if rows else None
+
+    def write_state(self, name: str, data: dict) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO state (prefix, name, data) VALUES (?, ?, ?)",
+                (self.prefix, name, json.dumps(data)),
+            )
+
+    def read_blob(self, name: str) -> Optional[bytes]:
+        rows = self._query("SELECT data FROM blobs WHERE prefix = ? AND name = ?", (self.prefix, name))
+        return bytes(rows[0][0]) if rows else None
+
+    def write_blob(self, name: str, data: bytes) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO blobs (prefix, name, data) VALUES (?, ?, ?)",
+                (self.prefix, name, data),
+            )
+
+    def import_history(self, file_handler: FileHandler, since: Optional[date] = None) -> int:
+        # Copies the runs of another handler, e.g. the JSON history of an S3FileHandler
+        runs = list(file_handler.iter_runs(since))
+        self.write(runs)
+        return len(runs)
+
+    def history_index(self, since: Optional[date] = None) -> "SQLiteHistoryIndex":
+        return SQLiteHistoryIndex(self, since)
+
+    def count_runs(self, since: Optional[date] = None) -> int:
+        return self._query(
+            "SELECT COUNT(*) FROM runs WHERE prefix = ? AND date >= ?",
+            (self.prefix, since.isoformat() if since else ""),
+        )[0][0]
+
+    def last_run_per_user(self, since: Optional[date] = None) -> dict[str, tuple]:
+        # {user: (last run date, number of runs)}
+        rows = self._query(
+            """
+            SELECT user, MAX(date), COUNT(*) FROM (
+                SELECT user_1 AS user, date FROM runs WHERE prefix = :prefix AND date >= :since
+                UNION ALL
+                SELECT user_2 AS user, date FROM runs WHERE prefix = :prefix AND date >= :since
+            ) GROUP BY user
+            """,
+            {"prefix": self.prefix, "since": since.isoformat() if since else ""},
+        )
+        return {user: (last_run_date, run_count) for user, last_run_date, run_count in rows}
+
+    def pairs_on(self, run_date: str) -> set[tuple]:
+        rows = self._query("SELECT user_1, user_2 FROM runs WHERE prefix = ? AND date = ?", (self.prefix, run_date))
+        return {tuple(sorted(pair)) for pair in rows}
+
+    def pair_counts(self, users: list[str], since: Optional[date] = None) -> dict[tuple, int]:
+        counts: dict[tuple, int] = {}
+        for user_1, user_2, _ in self.pair_meetings(users, since):
+            pair = tuple(sorted((user_1, user_2)))
+            counts[pair] = counts.get(pair, 0) + 1
+        return counts
+
+    def pair_meetings(self, users: list[str], since: Optional[date] = None) -> list[tuple]:
+        # (user_1, user_2, date) of all runs in which two of the given users met
+        with self._lock:
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS selected_users (user TEXT PRIMARY KEY)")
+            self.connection.execute("DELETE FROM selected_users")
+            self.connection.executemany("INSERT OR IGNORE INTO selected_users VALUES (?)", ((user,) for user in users))
+            return self.connection.execute(
+                """
+                SELECT user_1, user_2, date FROM runs
+                WHERE prefix = ? AND date >= ?
+                  AND user_1 IN selected_users AND user_2 IN selected_users
+                """,
+                (self.prefix, since.isoformat() if since else ""),
+            ).fetchall()
+
+
+class JSONLFileHandler(FileHandler):
+    # Runs in an append-only JSON lines file below directory/prefix, state and
+    # blobs in files next to it, e.g. for on-prem and CI runs without S3. The
+    # file is read through a memory map. A sidecar index keeps the offset of
+    # the first run of every date, so a read with a lookback starts at the
+    # first run of the window instead of parsing the whole file.
+    def __init__(self, directory: str, prefix: str = ""):
+        self.directory = os.path.join(directory, prefix)
+        self.path = os.path.join(self.directory, "history.jsonl")
+        self.index_path = f"{self.path}.index"
+        os.makedirs(self.directory, exist_ok=True)
+
+    def read(self) -> List[dict]:
+        return list(self.iter_runs())
+
+    def iter_runs(self, since: Optional[date] = None) -> Iterator[dict]:
+        import mmap
+
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        since = since.isoformat() if since else ""
+        offsets = [offset for run_date, offset in self._read_index()["dates"].items() if run_date >= since]
+        if not offsets:
+            return
+
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as history:
+            # Runs are not necessarily appended in date order, the read starts at
+            # the earliest run of the window and still checks every date
+            position = min(offsets)
+            while position < len(history):
+                end = history.find(b"\n", position)
+                end = len(history) if end == -1 else end
+                if end > position:
+                    run = json.loads(history[position:end])
+                    if run["date"] >= since:
+                        yield run
+                position = end + 1
+
+    def write(self, data: List[dict]) -> None:
+        index = self._read_index()
+        with open(self.path, "ab") as file:
+            offset = file.tell()
+            for run in data:
+                line = json.dumps(run).encode("utf-8") + b"\n"
+                index["dates"].setdefault(run["date"], offset)
+                file.write(line)
+                offset += len(line)
+            file.flush()
+            os.fsync(file.fileno())
+        index["size"] = offset
+        self._write_file(self.index_path, json.dumps(index).encode("utf-8"))
+
+    def remove_runs(self, runs: List[dict]) -> None:
+        # The file is written again without the runs, the index is rebuilt by the next read
+        removed = _run_keys(runs)
+        kept = [run for run in self.iter_runs() if (run["date"], tuple(run["pair"])) not in removed]
+        self._write_file(self.path, b"".join(json.dumps(run).encode("utf-8") + b"\n" for run in kept))
+        try:
+            os.remove(self.index_path)
+        except FileNotFoundError:
+            pass
+
+    def _read_index(self) -> dict:
+        # {"size": bytes of the history covered, "dates": {date: offset of its first run}}.
+        # Runs appended after the index was written (e.g. by a write that was
+        # interrupted) are added to it.
+        try:
+            with open(self.index_path, "rb") as file:
+                index = json.loads(file.read())
+        except FileNotFoundError:
+            index = {"size": 0, "dates": {}}
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if index["size"] > size:
+            index = {"size": 0, "dates": {}}
+        if index["size"] < size:
+            with open(self.path, "rb") as file:
+                file.seek(index["size"])
+                offset = index["size"]
+                for line in file:
+                    if line.strip():
+                        index["dates"].setdefault(json.loads(line)["date"], offset)
+                    offset += len(line)
+            index["size"] = offset
+        return index
+
+    @staticmethod
+    def _write_file(path: str, data: bytes) -> None:
+        # Written to a temporary file and renamed, so readers never see a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+    def _get_state_path(self, name: str) -> str:
+        return os.path.join(self.directory, "_state", f"{name}.json")
+
+    def read_state(self, name: str) -> Optional[dict]:
+        try:
+            with open(self._get_state_path(name), "rb") as file:
+                return json.loads(file.read())
+        except FileNotFoundError:
+            return None
+
+    def write_state(self, name: str, data: dict) -> None:
+        self._write_file(self._get_state_path(name), json.dumps(data).encode("utf-8"))
+
+    def _get_blob_path(self, name: str) -> str:
+        return os.path.join(self.directory, "_blobs", name)
+
+    def read_blob(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self._get_blob_path(name), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def write_blob(self, name: str, data: bytes) -> None:
+        self._write_file(self._get_blob_path(name), data)
+
+
+class Roster:
+    # Per-run map of Slack user profiles. It mimics the parts of the WebClient
+    # used by the bot, so absence checks and name resolution read from the same
+    # profiles instead of calling users.info again. With a profile cache only
+    # users missing from the cache are looked up, and they are added to it.
+    def __init__(self, client: WebClient, profiles: Optional[dict] = None,
+                 profile_cache: Optional[ProfileCache] = None):
+        self.client = client
+        self.profile_cache = profile_cache
+        if profiles is None:
+            profiles = profile_cache.read() if profile_cache is not None else {}
+        # Rosters processed in the same invocation can share one profile map
+        self.profiles: dict[str, dict] = profiles
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def load(self, user_ids: list[str]) -> None:
+        missing = {user_id for user_id in user_ids if user_id not in self.profiles}
+        cached = set(user_ids) - missing
+        if len(missing) >= USERS_LIST_MIN_USERS:
+            self._load_from_users_list(missing)
+            missing -= self.profiles.keys()
+
+        # Users that are not part of users.list (e.g. from other workspaces)
+        # or small rosters are fetched one by one
+        if missing:
+            missing = sorted(missing)
+            with ThreadPoolExecutor(max_workers=USERS_INFO_MAX_WORKERS) as executor:
+                for user_id, user in zip(missing, executor.map(self._fetch_user, missing)):
+                    self.profiles[user_id] = user
+
+        if self.profile_cache is not None:
+            fetched = [user_id for user_id in user_ids if user_id not in cached and user_id in self.profiles]
+            self.profile_cache.update([dict(self.profiles[user_id], id=user_id) for user_id in fetched])
+
+    def _load_from_users_list(self, user_ids: set[str]) -> None:
+        remaining = set(user_ids)
+        cursor = None
+        while remaining:
+            response = self.client.users_list(limit=USERS_LIST_PAGE_SIZE, cursor=cursor)
+            for member in response["members"]:
+                if member["id"] in remaining:
+                    self.profiles[member["id"]] = member
+                    remaining.discard(member["id"])
+
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                break
+
+    def _fetch_user(self, user_id: str) -> dict:
+        return self.client.users_info(user=user_id)["user"]
+
+    def users_info(self, user: str) -> dict:
+        if user not in self.profiles:
+            self.profiles[user] = self._fetch_user(user)
+        return {"user": self.profiles[user]}
+
+
+class ProfileCache:
+    # Profiles of the workspace stored as state of a file handler, with only the
+    # fields the bot reads. Every entry remembers when it was updated, so replayed
+    # or late events don't overwrite newer profiles.
+    def __init__(self, file_handler: FileHandler, max_age_days: int = PROFILE_CACHE_MAX_AGE_DAYS):
+        self.file_handler = file_handler
+        self.max_age_days = max_age_days
+
+    def read(self) -> dict[str, dict]:
+        cache = self.file_handler.read_state(PROFILE_CACHE_STATE) or {}
+        oldest = time.time() - self.max_age_days * 24 * 60 * 60
+        return {
+            user_id: _cached_user(entry)
+            for user_id, entry in cache.get("profiles", {}).items()
+            if entry["updated"] >= oldest
+        }
+
+    def update(self, users: list[dict], updated: Optional[float] = None) -> int:
+        if not users:
+            return 0
+        updated = updated if updated is not None else time.time()
+        cache = self.file_handler.read_state(PROFILE_CACHE_STATE) or {"profiles": {}}
+        changed = 0
+        for user in users:
+            entry = cache["profiles"].get(user["id"])
+            if entry is None or entry["updated"] <= updated:
+                cache["profiles"][user["id"]] = _cache_entry(user, updated)
+                changed += 1
+        if changed:
+            self.file_handler.write_state(PROFILE_CACHE_STATE, cache)
+        return changed
+
+    def apply_events(self, payloads: Iterator[dict]) -> int:
+        # Payloads are Events API callbacks or the bare events in them
+        changed = 0
+        for payload in payloads:
+            event = payload.get("event", payload)
+            if event.get("type") not in PROFILE_EVENT_TYPES:
+                continue
+            updated = payload.get("event_time") or float(event.get("event_ts") or time.time())
+            changed += self.update([event["user"]], updated)
+        return changed
+
+
+def _cache_entry(user: dict, updated: float) -> dict:
+    profile = user.get("profile", {})
+    return {
+        "deleted": user.get("deleted", False),
+        "is_bot": user.get("is_bot", False),
+        "real_name": profile.get("real_name", ""),
+        "status_emoji": profile.get("status_emoji", ""),
+        "status_expiration": profile.get("status_expiration", 0),
+        "tz": user.get("tz"),
+        "tz_offset": user.get("tz_offset", 0),
+        "updated": updated,
+    }
+
+
+def _cached_user(entry: dict) -> dict:
+    # Same shape as the users.info response the Roster caches
+    return {
+        "deleted": entry["deleted"],
+        "is_bot": entry.get("is_bot", False),
+        "tz": entry.get("tz"),
+        "tz_offset": entry.get("tz_offset", 0),
+        "profile": {
+            "real_name": entry["real_name"],
+            "status_emoji": entry["status_emoji"],
+            "status_expiration": entry["status_expiration"],
+        },
+    }
+
+
+def replay_user_events(file_handler: FileHandler, path: str) -> int:
+    # Applies recorded events, one JSON payload per line
+    with open(path) as f:
+        payloads = (json.loads(line) for line in f if line.strip())
+        return ProfileCache(file_handler).apply_events(payloads)
+
+
+def create_s3_client(max_workers: int = S3_MAX_WORKERS):
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client("s3", config=Config(max_pool_connections=max_workers))
+
+
+# Clients and parsed configuration are cached at module scope, so warm
+# invocations of the Lambda reuse them
+@lru_cache(maxsize=None)
+def get_s3_client():
+    return create_s3_client()
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter() -> RateLimiter:
+    return RateLimiter()
+
+
+def rate_limited(client, metrics: Optional[Metrics] = None, deadline: Optional[float] = None) -> RateLimitedClient:
+    return RateLimitedClient(client, get_rate_limiter() if is_rate_limited() else None, metrics, deadline)
+
+
+def is_rate_limited() -> bool:
+    return os.environ.get("SLACK_RATE_LIMITS", "false").lower() == "true"
+
+
+@lru_cache(maxsize=None)
+def get_sqs_client():
+    import boto3
+
+    return boto3.client("sqs")
+
+
+@lru_cache(maxsize=None)
+def get_disk_cache(directory: str) -> DiskCache:
+    return DiskCache(directory, int(os.environ.get("S3_CACHE_MAX_MB", S3_CACHE_MAX_MB)) * 2 ** 20)
+
+
+@lru_cache(maxsize=None)
+def get_slack_client(token: str) -> WebClient:
+    from slack_sdk import WebClient
+
+    return WebClient(token=token)
+
+
+@lru_cache(maxsize=None)
+def parse_users(users: str) -> tuple:
+    return tuple(json.loads(users).values())
+
 
-def handler(__event, __context) -> None:
-    file_handler = S3FileHandler(os.environ["S3_BUCKET"], os.environ["S3_PREFIX"])
-    process_users(file_handler)
+def get_profile_cache() -> Optional[ProfileCache]:
+    if os.environ.get("PROFILE_CACHE", "false").lower() != "true":
+        return None
+    prefix = os.environ.get("PROFILE_CACHE_PREFIX") or os.environ.get("S3_PREFIX", "user_history")
+    return ProfileCache(get_file_handler(prefix))
 
 
-def generate_user_pairs(users: list[str]) -> list[tuple[str]]:
+def get_dispatch_queue() -> Optional[DispatchQueue]:
+    if not os.environ.get("DISPATCH_QUEUE_URL"):
+        return None
+    return SQSQueue(os.environ["DISPATCH_QUEUE_URL"])
+
+
+def get_file_handler(prefix: str) -> FileHandler:
+    if os.environ.get("HISTORY_DATABASE"):
+        return SQLiteFileHandler(os.environ["HISTORY_DATABASE"], prefix)
+    if os.environ.get("HISTORY_DIR"):
+        return JSONLFileHandler(os.environ["HISTORY_DIR"], prefix)
+    return S3FileHandler(
+        os.environ["S3_BUCKET"],
+        prefix,
+        compact=os.environ.get("S3_COMPACT_HISTORY", "false").lower() == "true",
+        s3=get_s3_client(),
+        cache=get_disk_cache(os.environ["S3_CACHE_DIR"]) if os.environ.get("S3_CACHE_DIR") else None,
+    )
+
+
+def handler(event, __context) -> Optional[dict]:
+    with profiled(get_profile_file_handler()) if is_profiling_enabled(event) else nullcontext():
+        rosters = get_rosters(event)
+        if rosters:
+            results = process_rosters(rosters, deadline=get_deadline(__context))
+            return {name: asdict(result) for name, result in results.items()}
+
+        file_handler = get_file_handler(os.environ["S3_PREFIX"])
+        process_users(
+            file_handler,
+            Metrics(dimensions={"Roster": os.environ["S3_PREFIX"]}),
+            deadline=get_deadline(__context),
+        )
+
+
+def plan_handler(event, __context) -> dict:
+    # Selects the pairs of the next round ahead of time, e.g. on sunday night,
+    # so the monday run only re-checks absences and sends the messages
+    rosters = get_rosters(event)
+    if rosters:
+        return plan_rosters(rosters)
+
+    plan = plan_users(
+        get_file_handler(os.environ["S3_PREFIX"]),
+        Metrics(dimensions={"Roster": os.environ["S3_PREFIX"]}),
+    )
+    return {"round": plan["round"], "pairs": len(plan["pairs"])}
+
+
+def is_profiling_enabled(event) -> bool:
+    if isinstance(event, dict) and event.get("profile"):
+        return True
+    return os.environ.get("PROFILING", "false").lower() == "true"
+
+
+def get_profile_file_handler() -> FileHandler:
+    return get_file_handler(os.environ.get("PROFILE_PREFIX") or os.environ.get("S3_PREFIX", "user_history"))
+
+
+@contextmanager
+def profiled(file_handler: FileHandler):
+    # cProfile only sees the thread of the handler, work on executor threads
+    # (concurrent rosters, S3 fetches) shows up as waiting. tracemalloc sees all threads.
+    import cProfile
+    import tracemalloc
+
+    name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    profiler = cProfile.Profile()
+    tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        write_profile(file_handler, name, profiler, snapshot, peak)
+
+
+def write_profile(file_handler: FileHandler, name: str, profiler, snapshot, peak: int) -> None:
+    import marshal
+
+    # Same format as Profile.dump_stats, readable with pstats.Stats
+    profiler.create_stats()
+    file_handler.write_blob(f"profiles/{name}.prof", marshal.dumps(profiler.stats))
+
+    allocations = [
+        {"site": str(statistic.traceback[0]), "size": statistic.size, "count": statistic.count}
+        for statistic in snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]
+    ]
+    report = {"peak": peak, "allocations": allocations}
+    file_handler.write_blob(f"profiles/{name}.allocations.json", json.dumps(report, indent=2).encode("utf-8"))
+    logger.info(f"Wrote profile {name}, peak memory {peak / 2 ** 20:.1f} MiB")
+
+
+def events_handler(event, __context) -> dict:
+    # Slack Events API endpoint (Lambda function URL) that keeps the profile cache up to date
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body).decode()
+    headers = {key.lower(): value for key, value in (event.get("headers") or {}).items()}
+    if not is_valid_slack_request(body, headers):
+        return {"statusCode": 401}
+
+    payload = json.loads(body)
+    if payload.get("type") == "url_verification":
+        return {"statusCode": 200, "body": payload["challenge"]}
+
+    profile_cache = get_profile_cache()
+    if profile_cache is not None and payload.get("type") == "event_callback":
+        profile_cache.apply_events([payload])
+    return {"statusCode": 200}
+
+
+def is_valid_slack_request(body: str, headers: dict) -> bool:
+    from slack_sdk.signature import SignatureVerifier
+
+    verifier = SignatureVerifier(os.environ["SLACK_SIGNING_SECRET"])
+    return verifier.is_valid(
+        body,
+        headers.get("x-slack-request-timestamp", ""),
+        headers.get("x-slack-signature", ""),
+    )
+
+
+def get_deadline(context) -> Optional[float]:
+    # time.monotonic() after which no further dispatch batch is started
+    if not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000
+    return time.monotonic() + remaining_seconds - CHECKPOINT_SAFETY_MARGIN_SECONDS
+
+
+def get_rosters(event) -> list[dict]:
+    # Rosters are given in the event or the ROSTERS environment variable as
+    # [{"name": ..., "users": {username: id} or [id], "prefix": ..., "language": ...}],
+    # with "channels": [channel id] instead of "users" the members of the channels form the roster
+    if isinstance(event, dict) and event.get("rosters"):
+        return event["rosters"]
+    return json.loads(os.environ.get("ROSTERS") or "[]")
+
+
+def process_rosters(
+    rosters: list[dict],
+    metrics_sink=print_metrics,
+    deadline: Optional[float] = None,
+) -> dict[str, RosterResult]:
+    client, roster_users, errors = load_rosters(rosters, metrics_sink, deadline)
+    incomplete = []
+
+    def process(roster: dict) -> RosterResult:
+        name = roster["name"]
+        if name in errors:
+            return RosterResult(name, error=errors[name])
+        try:
+            results = process_users(
+                get_file_handler(roster["prefix"]),
+                Metrics(sink=metrics_sink, dimensions={"Roster": name}),
+                users=roster_users[name],
+                language=roster.get("language"),
+                profiles=client.profiles,
+                deadline=deadline,
+            )
+        except DispatchIncomplete as e:
+            logger.warning(f"Roster {name} is not completed: {e}")
+            incomplete.append(name)
+            return RosterResult(name, error=str(e))
+        except Exception as e:
+            logger.warning(f"Error processing roster {name}: {e}")
+            return RosterResult(name, error=str(e))
+
+        failed_pairs = [result.pair for result in results if not result.delivered]
+        return RosterResult(name, len(results), len(results) - len(failed_pairs), failed_pairs)
+
+    with ThreadPoolExecutor(max_workers=ROSTER_MAX_WORKERS) as executor:
+        results = {result.name: result for result in executor.map(process, rosters)}
+
+    # The progress of every roster is saved in its checkpoint. The invocation
+    # fails, so that the retry resumes the incomplete rosters and the completed
+    # ones do nothing.
+    if incomplete:
+        summary = {name: asdict(result) for name, result in results.items()}
+        logger.info(f"Results of the rosters: {json.dumps(summary)}")
+        raise DispatchIncomplete(f"Rosters {', '.join(sorted(incomplete))} are not completed before the deadline")
+    return results
+
+
+def plan_rosters(rosters: list[dict], metrics_sink=print_metrics) -> dict[str, dict]:
+    client, roster_users, errors = load_rosters(rosters, metrics_sink)
+
+    def plan(roster: dict) -> tuple[str, dict]:
+        name = roster["name"]
+        if name in errors:
+            return name, {"error": errors[name]}
+        try:
+            roster_plan = plan_users(
+                get_file_handler(roster["prefix"]),
+                Metrics(sink=metrics_sink, dimensions={"Roster": name}),
+                users=roster_users[name],
+                profiles=client.profiles,
+            )
+        except Exception as e:
+            logger.warning(f"Error planning roster {name}: {e}")
+            return name, {"error": str(e)}
+        return name, {"round": roster_plan["round"], "pairs": len(roster_plan["pairs"])}
+
+    with ThreadPoolExecutor(max_workers=ROSTER_MAX_WORKERS) as executor:
+        return dict(executor.map(plan, rosters))
+
+
+def load_rosters(
+    rosters: list[dict],
+    metrics_sink=print_metrics,
+    deadline: Optional[float] = None,
+) -> tuple[Roster, dict, dict]:
+    # All rosters share the Slack and S3 clients and one profile map, so people
+    # in several rosters are only looked up once. Returns the client, the user
+    # ids per roster and the errors of rosters whose members couldn't be read.
+    metrics = Metrics(sink=metrics_sink, dimensions={"Roster": "all"})
+    client = Roster(
+        rate_limited(MeteredClient(get_slack_client(get_token()), metrics), metrics, deadline),
+        profile_cache=get_profile_cache(),
+    )
+    roster_users = {}
+    errors = {}
+    try:
+        with metrics.phase("ChannelMembers"):
+            for roster in rosters:
+                try:
+                    roster_users[roster["name"]] = get_roster_user_ids(client, roster)
+                except Exception as e:
+                    logger.warning(f"Error reading members of roster {roster['name']}: {e}")
+                    errors[roster["name"]] = str(e)
+        with metrics.phase("RosterFetch"):
+            client.load(list(dict.fromkeys(user for users in roster_users.values() for user in users)))
+    finally:
+        metrics.emit()
+    return client, roster_users, errors
+
+
+def get_roster_user_ids(client: WebClient, roster: dict) -> list[str]:
+    if roster.get("channels"):
+        return get_channel_members(client, roster["channels"], get_file_handler(roster["prefix"]))
+    return _roster_user_ids(roster["users"])
+
+
+def _roster_user_ids(users) -> list[str]:
+    return list(users.values()) if isinstance(users, dict) else list(users)
+
+
+def get_channel_members(client: WebClient, channels: list[str], file_handler: FileHandler) -> list[str]:
+    # Members of all channels in order of appearance, an unchanged membership
+    # only costs a conversations.info call per channel
+    cache = file_handler.read_state(MEMBERSHIP_STATE) or {}
+    oldest = time.time() - MEMBERSHIP_CACHE_MAX_AGE_DAYS * 24 * 60 * 60
+    members = {}
+    changed = False
+    for channel in channels:
+        num_members = client.conversations_info(channel=channel, include_num_members=True)["channel"]["num_members"]
+        cached = cache.get(channel)
+        if cached and cached["num_members"] == num_members and cached["updated"] >= oldest:
+            channel_members = cached["members"]
+        else:
+            channel_members = list(iter_channel_members(client, channel))
+            cache[channel] = {"num_members": num_members, "members": channel_members, "updated": time.time()}
+            changed = True
+        members.update(dict.fromkeys(channel_members))
+
+    if changed:
+        file_handler.write_state(MEMBERSHIP_STATE, cache)
+    return list(members)
+
+
+def iter_channel_members(client: WebClient, channel: str) -> Iterator[str]:
+    cursor = None
+    while True:
+        response = client.conversations_members(channel=channel, limit=CONVERSATIONS_MEMBERS_PAGE_SIZE, cursor=cursor)
+        yield from response["members"]
+
+        cursor = response.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return
+
+
+def generate_user_pairs(users: list[str], previous_runs=None) -> list[tuple[str]]:
+    if previous_runs is not None:
+        users = match_users(users, previous_runs)
     user_pairs = list(zip(users[::2], users[1::2]))
     return [tuple(sorted(pair)) for pair in user_pairs]
 
 
-def process_users(file_handler: FileHandler) -> None:
-    client = WebClient(token=get_token())
-    users = get_users(client)
+def process_users(
+    file_handler: FileHandler,
+    metrics: Optional[Metrics] = None,
+    users: Optional[list[str]] = None,
+    language: Optional[str] = None,
+    profiles: Optional[dict] = None,
+    deadline: Optional[float] = None,
+) -> list[DispatchResult]:
+    metrics = metrics or Metrics(sink=None)
+    writer = BackgroundWriter() if is_pipelined_run() else None
+    try:
+        # Profiles shared by several rosters were already loaded from the cache
+        profile_cache = get_profile_cache() if profiles is None else None
+        client = Roster(
+            rate_limited(MeteredClient(get_slack_client(get_token()), metrics), metrics, deadline),
+            profiles,
+            profile_cache,
+        )
 
-    # Load previous runs from file handler
-    previous_runs = file_handler.read()
+        # A checkpoint of this week's round means an earlier invocation already
+        # chose the pairs, only the pairs it didn't get to are sent
+        checkpoint = file_handler.read_state(CHECKPOINT_STATE)
+        if checkpoint and checkpoint["round"] == get_round() and not checkpoint.get("cancelled"):
+            if checkpoint.get("completed"):
+                logger.info(f"Round {checkpoint['round']} was already completed")
+                return []
+            logger.info(f"Resume round {checkpoint['round']}")
+        else:
+            # A round that ran out of retries before completing: the pairs it
+            # notified are recorded before the checkpoint is replaced
+            if checkpoint and not checkpoint.get("completed") and not checkpoint.get("cancelled"):
+                if checkpoint["delivered"]:
+                    logger.info(f"Record the notified pairs of incomplete round {checkpoint['round']}")
+                    file_handler.write(create_history_runs(checkpoint))
+            plan = read_plan(file_handler)
+            if plan is not None:
+                logger.info(f"Use the plan of round {plan['round']} from {plan['created']}")
+                user_pairs = get_planned_pairs(plan, client, file_handler, metrics, users)
+            else:
+                user_pairs = select_user_pairs(client, file_handler, metrics, users)
+            checkpoint = {
+                "round": get_round(),
+                "date": datetime.now().date().isoformat(),
+                "pairs": [list(pair) for pair in user_pairs],
+                "delivered": [],
+                "failed": [],
+            }
+            file_handler.write_state(CHECKPOINT_STATE, checkpoint)
+        metrics.put("Pairs", len(checkpoint["pairs"]))
+
+        queue = get_dispatch_queue()
+        with metrics.phase("Dispatch"):
+            if queue is not None:
+                results = publish_with_checkpoint(checkpoint, queue, client, file_handler, language, deadline, writer)
+            elif is_scheduled_delivery():
+                results = schedule_with_checkpoint(checkpoint, client, file_handler, metrics, language, deadline, writer)
+            else:
+                results = dispatch_with_checkpoint(
+                    checkpoint, client, file_handler, metrics, language, deadline, writer
+                )
+        metrics.put("DeliveredPairs", len(checkpoint["delivered"]))
+        metrics.put("FailedPairs", len(checkpoint["failed"]))
+
+        # Update runs file, pairs that could not be notified are not recorded
+        with metrics.phase("HistoryWrite"):
+            file_handler.write(create_history_runs(checkpoint))
+            # The round is completed only after all progress of the dispatch is written
+            if writer is not None:
+                writer.wait()
+        checkpoint["completed"] = True
+        file_handler.write_state(CHECKPOINT_STATE, checkpoint)
+        return results
+    finally:
+        # Progress of an incomplete dispatch is written before the invocation ends
+        if writer is not None:
+            writer.close()
+        metrics.emit()
+
+
+def plan_users(
+    file_handler: FileHandler,
+    metrics: Optional[Metrics] = None,
+    users: Optional[list[str]] = None,
+    profiles: Optional[dict] = None,
+) -> dict:
+    metrics = metrics or Metrics(sink=None)
+    try:
+        profile_cache = get_profile_cache() if profiles is None else None
+        client = Roster(
+            rate_limited(MeteredClient(get_slack_client(get_token()), metrics), metrics),
+            profiles,
+            profile_cache,
+        )
+        users, previous_runs = read_roster_and_history(client, file_handler, metrics, users)
+        index = HistoryIndex.from_runs(previous_runs)
+        user_pairs = select_pairs(users, index, metrics)
+        # The pairs of the latest run are kept to pair users whose partner
+        # becomes absent before the round without them
+        plan = {
+            "version": PLAN_VERSION,
+            "round": get_next_round(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "pairs": [list(pair) for pair in user_pairs],
+            "latest_run": {"date": index.latest_run_date, "pairs": sorted(list(pair) for pair in index.latest_pairs)},
+        }
+        file_handler.write_state(PLAN_STATE, plan)
+        metrics.put("PlannedPairs", len(user_pairs))
+        return plan
+    finally:
+        metrics.emit()
+
+
+def read_plan(file_handler: FileHandler) -> Optional[dict]:
+    plan = file_handler.read_state(PLAN_STATE)
+    if not plan or plan.get("version") != PLAN_VERSION or plan.get("round") != get_round():
+        return None
+    return plan
+
+
+def get_planned_pairs(
+    plan: dict,
+    client: WebClient,
+    file_handler: FileHandler,
+    metrics: Metrics,
+    users: Optional[list[str]] = None,
+) -> list[tuple]:
+    # Absences and the roster are checked again at dispatch time. Pairs of two
+    # available users are kept, users whose partner became absent or left the
+    # roster are matched with each other, without pairs of the latest run.
+    roster = set(get_roster(client, file_handler, metrics, users))
+    planned_users = [user for pair in plan["pairs"] for user in pair if user in roster]
+    metrics.put("LeftPlannedUsers", 2 * len(plan["pairs"]) - len(planned_users))
+    with metrics.phase("RosterFetch"):
+        if isinstance(client, Roster):
+            client.load(planned_users)
+    with metrics.phase("AbsenceFiltering"):
+        available_users = set(filter_users(planned_users, client))
+    metrics.put("AbsentPlannedUsers", len(planned_users) - len(available_users))
 
+    user_pairs = []
+    unpaired_users = []
+    for pair in plan["pairs"]:
+        available = [user for user in pair if user in available_users]
+        if len(available) == len(pair):
+            user_pairs.append(tuple(pair))
+        else:
+            unpaired_users.extend(available)
+
+    random.shuffle(unpaired_users)
+    latest_runs = [{"date": plan["latest_run"]["date"], "pair": pair} for pair in plan["latest_run"]["pairs"]]
+    unpaired_users = unpaired_users[:len(unpaired_users) - len(unpaired_users) % 2]
+    matched_users, left_out_users = _match_blocks(unpaired_users, HistoryIndex.from_runs(latest_runs))
+    if left_out_users:
+        logger.info(f"Users {', '.join(left_out_users)} were paired in the latest run and are left out")
+    return user_pairs + generate_user_pairs(matched_users)
+
+
+def get_roster(
+    client: WebClient,
+    file_handler: FileHandler,
+    metrics: Metrics,
+    users: Optional[list[str]] = None,
+) -> list[str]:
+    # Users given by the caller, else the members of the roster channels, else the USERS variable
+    if users is not None:
+        return list(users)
+    roster_channels = get_roster_channels()
+    if roster_channels:
+        with metrics.phase("ChannelMembers"):
+            return get_channel_members(client, roster_channels, file_handler)
+    return list(parse_users(os.environ.get("USERS")))
+
+
+def select_user_pairs(
+    client: WebClient,
+    file_handler: FileHandler,
+    metrics: Metrics,
+    users: Optional[list[str]] = None,
+) -> list[tuple]:
+    users, previous_runs = read_roster_and_history(client, file_handler, metrics, users)
+    return select_pairs(users, previous_runs, metrics)
+
+
+def read_roster_and_history(
+    client: WebClient,
+    file_handler: FileHandler,
+    metrics: Metrics,
+    users: Optional[list[str]] = None,
+) -> tuple:
+    roster_channels = get_roster_channels()
+    if users is None and roster_channels:
+        with metrics.phase("ChannelMembers"):
+            users = get_channel_members(client, roster_channels, file_handler)
+    if is_pipelined_run():
+        # The roster fetch and the history read don't depend on each other, the
+        # history is read on a background thread while the roster is fetched
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            history_read = executor.submit(read_previous_runs, file_handler, metrics)
+            users = get_users(client, metrics, users)
+            previous_runs = history_read.result()
+    else:
+        users = get_users(client, metrics, users)
+        previous_runs = read_previous_runs(file_handler, metrics)
+    return users, previous_runs
+
+
+def select_pairs(users: list[str], previous_runs, metrics: Metrics) -> list[tuple]:
     # Filter users based on previous runs
-    filtered_users = filter_users_based_on_previous_runs(users, previous_runs)
+    with metrics.phase("Selection"):
+        filtered_users = filter_users_based_on_previous_runs(users, previous_runs)
+        return generate_user_pairs(filtered_users)
+
+
+def read_previous_runs(file_handler: FileHandler, metrics: Metrics):
+    # Load previous runs from file handler
+    with metrics.phase("HistoryRead"):
+        # Handlers that can query the history (e.g. SQLite) provide a history
+        # index, the others are read into a History
+        history_index = getattr(file_handler, "history_index", None)
+        if history_index is not None:
+            previous_runs = history_index(get_history_since())
+        else:
+            previous_runs = file_handler.read_history(get_history_since())
+    metrics.put("HistoryRuns", len(previous_runs))
+    read_stats = getattr(file_handler, "last_read_stats", None)
+    if read_stats is not None:
+        metrics.put("S3Objects", read_stats.objects)
+        metrics.put("S3Bytes", read_stats.bytes, "Bytes")
+        metrics.increment("Retries", read_stats.retries)
+        metrics.put("S3CacheHits", read_stats.cache_hits)
+    return previous_runs
+
+
+class BackgroundWriter:
+    # Runs writes one after the other on a background thread, so the run goes
+    # on while they are in flight. A later write of the same state never
+    # overtakes an earlier one.
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
 
-    user_pairs = generate_user_pairs(filtered_users)
+    def submit(self, function, *args) -> None:
+        self._futures.append(self._executor.submit(function, *args))
 
+    def wait(self) -> None:
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+def save_checkpoint(checkpoint: dict, file_handler: FileHandler, writer: Optional[BackgroundWriter] = None) -> None:
+    if writer is None:
+        file_handler.write_state(CHECKPOINT_STATE, checkpoint)
+        return
+    # The checkpoint is still extended while the write is in flight, a copy is written
+    writer.submit(file_handler.write_state, CHECKPOINT_STATE, json.loads(json.dumps(checkpoint)))
+
+
+def dispatch_with_checkpoint(
+    checkpoint: dict,
+    client: WebClient,
+    file_handler: FileHandler,
+    metrics: Optional[Metrics] = None,
+    language: Optional[str] = None,
+    deadline: Optional[float] = None,
+    writer: Optional[BackgroundWriter] = None,
+) -> list[DispatchResult]:
+    # Sends the pending pairs of the checkpoint in batches and persists the
+    # progress after each batch. A pair is sent again only if the invocation
+    # ends in the middle of its batch. With a writer the next batch is sent
+    # while the progress of the previous one is written.
+    done = {tuple(pair) for pair in checkpoint["delivered"] + checkpoint["failed"]}
+    pending = [tuple(pair) for pair in checkpoint["pairs"] if tuple(pair) not in done]
+    batch_size = max(CHECKPOINT_BATCH_SIZE, get_dispatch_concurrency())
+
+    results = []
+    for start in range(0, len(pending), batch_size):
+        if deadline is not None and time.monotonic() > deadline:
+            raise DispatchIncomplete(f"{len(pending) - start} pairs of round {checkpoint['round']} are not sent yet")
+
+        try:
+            batch_results = dispatch_messages(pending[start:start + batch_size], client, metrics, language, deadline)
+        except DispatchIncomplete as e:
+            # Pairs sent before a rate limit wait hit the deadline are saved as well
+            checkpoint["delivered"].extend(list(result.pair) for result in e.results if result.delivered)
+            checkpoint["failed"].extend(list(result.pair) for result in e.results if not result.delivered)
+            save_checkpoint(checkpoint, file_handler, writer)
+            raise
+        checkpoint["delivered"].extend(list(result.pair) for result in batch_results if result.delivered)
+        checkpoint["failed"].extend(list(result.pair) for result in batch_results if not result.delivered)
+        save_checkpoint(checkpoint, file_handler, writer)
+        results.extend(batch_results)
+
+    return results
+
+
+def schedule_with_checkpoint(
+    checkpoint: dict,
+    client: WebClient,
+    file_handler: FileHandler,
+    metrics: Optional[Metrics] = None,
+    language: Optional[str] = None,
+    deadline: Optional[float] = None,
+    writer: Optional[BackgroundWriter] = None,
+) -> list[DispatchResult]:
+    # Schedules the pending pairs of the checkpoint with chat.scheduleMessage,
+    # bucketed by delivery time, and saves the progress after every batch. The
+    # scheduled messages are kept in the checkpoint, so they can be cancelled.
+    done = {tuple(pair) for pair in checkpoint["delivered"] + checkpoint["failed"]}
+    pending = [tuple(pair) for pair in checkpoint["pairs"] if tuple(pair) not in done]
+    scheduled = checkpoint.setdefault("scheduled", [])
+
+    buckets: dict[int, list[tuple]] = {}
+    now = time.time()
+    for pair in pending:
+        buckets.setdefault(get_delivery_time(pair, client, now), []).append(pair)
+    if metrics is not None:
+        metrics.put("DeliveryBuckets", len(buckets))
+
+    results = []
+    for post_at in sorted(buckets):
+        bucket = buckets[post_at]
+        for start in range(0, len(bucket), CHECKPOINT_BATCH_SIZE):
+            if deadline is not None and time.monotonic() > deadline:
+                raise DispatchIncomplete(
+                    f"{len(pending) - len(results)} pairs of round {checkpoint['round']} are not scheduled yet"
+                )
+
+            for user_pair in bucket[start:start + CHECKPOINT_BATCH_SIZE]:
+                try:
+                    message = schedule_message(list(user_pair), client, post_at, language)
+                except DispatchIncomplete as e:
+                    save_checkpoint(checkpoint, file_handler, writer)
+                    raise DispatchIncomplete(str(e), results) from e
+                except Exception as e:
+                    logger.warning(f"Error scheduling coffee break message to {user_pair}: {e}")
+                    checkpoint["failed"].append(list(user_pair))
+                    results.append(DispatchResult(user_pair, False, str(e)))
+                    continue
+                checkpoint["delivered"].append(list(user_pair))
+                scheduled.append({"pair": list(user_pair), **message})
+                results.append(DispatchResult(user_pair, True))
+            save_checkpoint(checkpoint, file_handler, writer)
+
+    return results
+
+
+def get_delivery_time(user_pair: tuple, client: WebClient, now: float) -> int:
+    # DELIVERY_HOUR of the run day in the time zones of both users, the later
+    # one, so neither of them gets the message before that hour
+    hour = get_delivery_hour()
+    run_day = datetime.fromtimestamp(now, tz=timezone.utc).date()
+    local_delivery = datetime(run_day.year, run_day.month, run_day.day, hour, tzinfo=timezone.utc).timestamp()
+    post_at = max(
+        local_delivery - client.users_info(user=user)["user"].get("tz_offset", 0) for user in user_pair
+    )
+    return int(max(post_at, now + SCHEDULE_MIN_LEAD_SECONDS))
+
+
+def create_history_runs(checkpoint: dict) -> list[dict]:
+    # Pairs that could not be notified are not recorded. Scheduled messages are
+    # recorded with their run, so a round can be traced and cancelled.
+    scheduled = {tuple(message["pair"]): message for message in checkpoint.get("scheduled", [])}
+    runs = []
+    for pair in checkpoint["delivered"]:
+        run = {"date": checkpoint["date"], "pair": pair}
+        if tuple(pair) in scheduled:
+            message = scheduled[tuple(pair)]
+            run["scheduled_message"] = {key: message[key] for key in ("channel", "id", "post_at")}
+        runs.append(run)
+    return runs
+
+
+def cancel_scheduled_messages(file_handler: FileHandler, client: WebClient) -> int:
+    # Deletes the messages of the current round that are not posted yet and
+    # marks the round as cancelled, so the next invocation pairs it again.
+    # The runs of the cancelled messages are removed from the history, pairs
+    # whose message was already posted stay recorded.
+    checkpoint = file_handler.read_state(CHECKPOINT_STATE)
+    if not checkpoint or checkpoint["round"] != get_round():
+        return 0
+
+    cancelled_pairs = set()
+    now = time.time()
+    for message in checkpoint.get("scheduled", []):
+        if message["post_at"] <= now:
+            continue
+        try:
+            client.chat_deleteScheduledMessage(channel=message["channel"], scheduled_message_id=message["id"])
+            cancelled_pairs.add(tuple(message["pair"]))
+        except Exception as e:
+            logger.warning(f"Error cancelling scheduled message to {message['pair']}: {e}")
+
+    runs = create_history_runs(checkpoint)
+    if checkpoint.get("completed"):
+        file_handler.remove_runs([run for run in runs if tuple(run["pair"]) in cancelled_pairs])
+    else:
+        # The runs of an incomplete round are not written yet
+        notified_runs = [run for run in runs if tuple(run["pair"]) not in cancelled_pairs]
+        if notified_runs:
+            file_handler.write(notified_runs)
+    checkpoint["cancelled"] = True
+    file_handler.write_state(CHECKPOINT_STATE, checkpoint)
+    return len(cancelled_pairs)
+
+
+class DispatchQueue(ABC):
+    @abstractmethod
+    def send(self, jobs: list[dict]) -> None:
+        pass
+
+
+class SQSQueue(DispatchQueue):
+    def __init__(self, queue_url: str, sqs=None):
+        self.sqs = sqs or get_sqs_client()
+        self.queue_url = queue_url
+
+    def send(self, jobs: list[dict]) -> None:
+        for start in range(0, len(jobs), SQS_BATCH_SIZE):
+            entries = [
+                {"Id": str(i), "MessageBody": json.dumps(job)}
+                for i, job in enumerate(jobs[start:start + SQS_BATCH_SIZE])
+            ]
+            response = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            failed = response.get("Failed", [])
+            if failed:
+                raise RuntimeError(f"{len(failed)} dispatch jobs could not be queued: {failed[0].get('Message')}")
+
+
+class InMemoryQueue(DispatchQueue):
+    # Local stand-in for SQS with a dead letter queue, e.g. for tests. Jobs
+    # that failed max_receive_count times are moved to dead_letters.
+    def __init__(self, max_receive_count: int = 3):
+        self.max_receive_count = max_receive_count
+        self.messages: list[dict] = []
+        self.dead_letters: list[dict] = []
+        self._message_ids = itertools.count(1)
+
+    def send(self, jobs: list[dict]) -> None:
+        for job in jobs:
+            self.messages.append({"messageId": str(next(self._message_ids)), "body": json.dumps(job), "receiveCount": 0})
+
+    def drain(self, worker, batch_size: int = SQS_BATCH_SIZE) -> None:
+        # Delivers the jobs to the worker in batches, like the SQS event source of the worker Lambda
+        while self.messages:
+            batch, self.messages = self.messages[:batch_size], self.messages[batch_size:]
+            response = worker({"Records": [{"messageId": m["messageId"], "body": m["body"]} for m in batch]}, None)
+            failed = {failure["itemIdentifier"] for failure in response.get("batchItemFailures", [])}
+            for message in batch:
+                if message["messageId"] not in failed:
+                    continue
+                message["receiveCount"] += 1
+                if message["receiveCount"] >= self.max_receive_count:
+                    self.dead_letters.append(message)
+                else:
+                    self.messages.append(message)
+
+
+def publish_with_checkpoint(
+    checkpoint: dict,
+    queue: DispatchQueue,
+    client: WebClient,
+    file_handler: FileHandler,
+    language: Optional[str] = None,
+    deadline: Optional[float] = None,
+    writer: Optional[BackgroundWriter] = None,
+) -> list[DispatchResult]:
+    # Queues a job for every pending pair of the checkpoint. Queued pairs count
+    # as delivered and are recorded in the history, jobs the workers fail to
+    # send end up in the dead letter queue.
+    done = {tuple(pair) for pair in checkpoint["delivered"]}
+    pending = [tuple(pair) for pair in checkpoint["pairs"] if tuple(pair) not in done]
+
+    results = []
+    for start in range(0, len(pending), QUEUE_PUBLISH_BATCH_SIZE):
+        if deadline is not None and time.monotonic() > deadline:
+            raise DispatchIncomplete(f"{len(pending) - start} pairs of round {checkpoint['round']} are not queued yet")
+
+        batch = pending[start:start + QUEUE_PUBLISH_BATCH_SIZE]
+        queue.send([create_dispatch_job(pair, client, checkpoint["round"], language) for pair in batch])
+        checkpoint["delivered"].extend(list(pair) for pair in batch)
+        save_checkpoint(checkpoint, file_handler, writer)
+        results.extend(DispatchResult(pair, True) for pair in batch)
+
+    return results
+
+
+def create_dispatch_job(user_pair: tuple, client: WebClient, round_id: str, language: Optional[str] = None) -> dict:
+    # Names are resolved from the loaded roster, so workers only open the conversation and post
+    return {
+        "round": round_id,
+        "pair": list(user_pair),
+        "names": [get_user_name(user, client) for user in user_pair],
+        "language": language,
+    }
+
+
+def worker_handler(event, __context) -> dict:
+    # Sends the messages of a batch of dispatch jobs from SQS. Failed jobs are
+    # reported back, SQS retries them and moves them to the dead letter queue
+    # after the last attempt.
+    records = event.get("Records", [])
+    metrics = Metrics(dimensions={"Roster": "worker"})
+    client = rate_limited(MeteredClient(get_slack_client(get_token()), metrics), metrics)
+    failures = []
+    try:
+        with metrics.phase("Dispatch"):
+            for record in records:
+                job = json.loads(record["body"])
+                try:
+                    send_job(job, client)
+                except Exception as e:
+                    logger.warning(f"Error sending coffee break message to {job['pair']}: {e}")
+                    failures.append({"itemIdentifier": record["messageId"]})
+        metrics.put("DeliveredPairs", len(records) - len(failures))
+        metrics.put("FailedPairs", len(failures))
+    finally:
+        metrics.emit()
+    return {"batchItemFailures": failures}
+
+
+def send_job(job: dict, client: WebClient) -> None:
+    response = client.conversations_open(users=job["pair"])
+    logger.info(f"Send coffee break message to {job['names'][0]} and {job['names'][1]}")
+    client.chat_postMessage(
+        channel=response["channel"]["id"],
+        text=get_message(job["names"][0], job["names"][1], job.get("language")),
+    )
+
+
+def dispatch_messages(
+    user_pairs: list[tuple],
+    client: WebClient,
+    metrics: Optional[Metrics] = None,
+    language: Optional[str] = None,
+    deadline: Optional[float] = None,
+) -> list[DispatchResult]:
+    concurrency = get_dispatch_concurrency()
+    if concurrency > 1:
+        import asyncio
+
+        return asyncio.run(dispatch_messages_async(user_pairs, client, concurrency, metrics, language, deadline))
+
+    results = []
     for user_pair in user_pairs:
-        send_message(list(user_pair), client)
+        try:
+            send_message(list(user_pair), client, language)
+            results.append(DispatchResult(user_pair, True))
+        except DispatchIncomplete as e:
+            raise DispatchIncomplete(str(e), results) from e
+        except Exception as e:
+            logger.warning(f"Error sending coffee break message to {user_pair}: {e}")
+            results.append(DispatchResult(user_pair, False, str(e)))
+    return results
+
 
-    # Update runs file
-    file_handler.write([{"date": datetime.now().date().isoformat(), "pair": pair} for pair in user_pairs])
+async def dispatch_messages_async(
+    user_pairs: list[tuple],
+    client: WebClient,
+    concurrency: int,
+    metrics: Optional[Metrics] = None,
+    language: Optional[str] = None,
+    deadline: Optional[float] = None,
+) -> list[DispatchResult]:
+    import asyncio
 
+    import aiohttp
+    from slack_sdk.web.async_client import AsyncWebClient
 
-def send_message(users: list[str], client: WebClient) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def dispatch(user_pair: tuple, async_client: AsyncWebClient) -> Optional[DispatchResult]:
+        async with semaphore:
+            try:
+                await send_message_async(list(user_pair), client, async_client, language)
+                return DispatchResult(user_pair, True)
+            except DispatchIncomplete:
+                return None
+            except Exception as e:
+                logger.warning(f"Error sending coffee break message to {user_pair}: {e}")
+                return DispatchResult(user_pair, False, str(e))
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async_client = AsyncWebClient(token=client.token, session=session)
+        if metrics is not None:
+            async_client = MeteredClient(async_client, metrics)
+        async_client = AsyncRateLimitedClient(
+            async_client,
+            get_rate_limiter() if is_rate_limited() else None,
+            metrics,
+            deadline,
+        )
+        results = await asyncio.gather(*(dispatch(user_pair, async_client) for user_pair in user_pairs))
+
+    if None in results:
+        sent = [result for result in results if result is not None]
+        raise DispatchIncomplete(f"{len(results) - len(sent)} pairs were not sent before the deadline", sent)
+    return list(results)
+
+
+def send_message(users: list[str], client: WebClient, language: Optional[str] = None) -> None:
     response = client.conversations_open(users=users)
     user_name_1 = get_user_name(users[0], client)
     user_name_2 = get_user_name(users[1], client)
@@ -100,12 +2155,39 @@ def send_message(users: list[str], client: WebClient) -> None:
 
     client.chat_postMessage(
         channel=response["channel"]["id"],
-        text=get_message(user_name_1, user_name_2)
+        text=get_message(user_name_1, user_name_2, language)
     )
 
 
-def get_message(user_name_1: str, user_name_2: str) -> str:
-    language = os.environ.get("LANGUAGE", "en")
+def schedule_message(users: list[str], client: WebClient, post_at: int, language: Optional[str] = None) -> dict:
+    response = client.conversations_open(users=users)
+    user_name_1 = get_user_name(users[0], client)
+    user_name_2 = get_user_name(users[1], client)
+    logger.info(f"Schedule coffee break message to {user_name_1} and {user_name_2} at {post_at}")
+
+    scheduled = client.chat_scheduleMessage(
+        channel=response["channel"]["id"],
+        text=get_message(user_name_1, user_name_2, language),
+        post_at=post_at,
+    )
+    return {"channel": scheduled["channel"], "id": scheduled["scheduled_message_id"], "post_at": scheduled["post_at"]}
+
+
+async def send_message_async(users: list[str], client: WebClient, async_client, language: Optional[str] = None) -> None:
+    # Names are read from the (already loaded) roster, only the messaging calls are async
+    user_name_1 = get_user_name(users[0], client)
+    user_name_2 = get_user_name(users[1], client)
+    response = await async_client.conversations_open(users=users)
+    logger.info(f"Send coffee break message to {user_name_1} and {user_name_2}")
+
+    await async_client.chat_postMessage(
+        channel=response["channel"]["id"],
+        text=get_message(user_name_1, user_name_2, language)
+    )
+
+
+def get_message(user_name_1: str, user_name_2: str, language: Optional[str] = None) -> str:
+    language = language or os.environ.get("LANGUAGE", "en")
 
     if language == "de":
         return f"{user_name_1} und {user_name_2}, ihr wurdet für einen gemeinsamen Kaffeeklatsch ausgelost.\n" \
@@ -122,9 +2204,60 @@ def get_token() -> str:
     return os.environ["SLACK_TOKEN"]
 
 
-def get_users(client: WebClient) -> list:
-    users = list(json.loads(os.environ.get("USERS")).values())
-    return filter_users(users, client)
+def get_roster_channels() -> list[str]:
+    # Comma separated ids of the channels whose members form the roster, instead of USERS
+    return [channel.strip() for channel in os.environ.get("ROSTER_CHANNELS", "").split(",") if channel.strip()]
+
+
+def get_dispatch_concurrency() -> int:
+    return int(os.environ.get("DISPATCH_CONCURRENCY", "1"))
+
+
+def is_pipelined_run() -> bool:
+    # Runs independent phases of a run concurrently, see select_user_pairs and BackgroundWriter
+    return os.environ.get("PIPELINED_RUN", "false").lower() == "true"
+
+
+def is_scheduled_delivery() -> bool:
+    return os.environ.get("SCHEDULED_DELIVERY", "false").lower() == "true"
+
+
+def get_delivery_hour() -> int:
+    return int(os.environ.get("DELIVERY_HOUR") or SCHEDULED_DELIVERY_DEFAULT_HOUR)
+
+
+def get_round(day: Optional[date] = None) -> str:
+    # One round of coffee breaks per ISO week
+    year, week, _ = (day or datetime.now().date()).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def get_next_round() -> str:
+    # Round of the next monday
+    today = datetime.now().date()
+    return get_round(today + timedelta(days=7 - today.weekday()))
+
+
+def get_history_since() -> Optional[date]:
+    lookback_days = int(os.environ.get("HISTORY_LOOKBACK_DAYS") or 0)
+    if lookback_days <= 0:
+        return None
+    return datetime.now().date() - timedelta(days=lookback_days)
+
+
+def get_users(client: WebClient, metrics: Optional[Metrics] = None, users: Optional[list[str]] = None) -> list:
+    metrics = metrics or Metrics(sink=None)
+    users = list(users if users is not None else parse_users(os.environ.get("USERS")))
+    metrics.put("RosterSize", len(users))
+
+    with metrics.phase("RosterFetch"):
+        if isinstance(client, Roster):
+            client.load(users)
+
+    with metrics.phase("AbsenceFiltering"):
+        users = filter_users(users, client)
+    metrics.put("AvailableUsers", len(users))
+    return users
 
 
 def filter_users(users: list[str], client: WebClient) -> list[str]:
@@ -134,7 +2267,8 @@ def filter_users(users: list[str], client: WebClient) -> list[str]:
 
 def is_included_user(user: str, client: WebClient) -> bool:
     user_info = client.users_info(user=user)["user"]
-    if user_info["deleted"]:
+    # Channel rosters also contain bots, e.g. this app
+    if user_info["deleted"] or user_info.get("is_bot"):
         return False
     if user_info["profile"]["status_emoji"] not in ABSENCE_EMOJIS:
         return True
@@ -153,25 +2287,246 @@ def get_user_name(user_id: str, client: WebClient) -> str:
     return user_name.split()[0]
 
 
+class History:
+    # Previous runs in columns: user ids are interned to small integers and
+    # dates are stored as day ordinals
+    __slots__ = ("user_ids", "users", "days", "users_1", "users_2", "_days")
+
+    def __init__(self):
+        self.user_ids: dict[str, int] = {}
+        self.users: list[str] = []
+        self.days = array("i")
+        self.users_1 = array("i")
+        self.users_2 = array("i")
+        self._days: dict[str, int] = {}
+
+    @classmethod
+    def from_runs(cls, previous_runs) -> "History":
+        history = cls()
+        history.extend(previous_runs)
+        return history
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def intern(self, user: str) -> int:
+        user_id = self.user_ids.get(user)
+        if user_id is None:
+            user_id = self.user_ids[user] = len(self.users)
+            self.users.append(user)
+        return user_id
+
+    def append(self, run_date: str, pair: list[str]) -> None:
+        day = self._days.get(run_date)
+        if day is None:
+            day = self._days[run_date] = date.fromisoformat(run_date).toordinal()
+        self.days.append(day)
+        self.users_1.append(self.intern(pair[0]))
+        self.users_2.append(self.intern(pair[1]))
+
+    def extend(self, runs) -> None:
+        for run in runs:
+            self.append(run["date"], run["pair"])
+
+    def to_runs(self) -> List[dict]:
+        return [
+            {"date": date.fromordinal(day).isoformat(), "pair": [self.users[user_1], self.users[user_2]]}
+            for day, user_1, user_2 in zip(self.days, self.users_1, self.users_2)
+        ]
+
+
+class HistoryIndex:
+    # Aggregates of the previous runs that the selection needs, computed on the columns of a History
+    def __init__(self, history: History):
+        import numpy as np
+
+        self.history = history
+        days = np.array(history.days, dtype=np.int64)
+        users_1 = np.array(history.users_1, dtype=np.int64)
+        users_2 = np.array(history.users_2, dtype=np.int64)
+        self._days, self._users_1, self._users_2 = days, users_1, users_2
+
+        number_of_users = len(history.users)
+        self.last_days = np.zeros(number_of_users, dtype=np.int64)
+        np.maximum.at(self.last_days, users_1, days)
+        np.maximum.at(self.last_days, users_2, days)
+        self.run_counts = (np.bincount(users_1, minlength=number_of_users)
+                           + np.bincount(users_2, minlength=number_of_users))
+
+        self.latest_day = int(days.max()) if len(days) else date(1970, 1, 1).toordinal()
+        latest = days == self.latest_day
+        self.latest_pairs: set[tuple] = {
+            tuple(sorted((history.users[user_1], history.users[user_2])))
+            for user_1, user_2 in zip(users_1[latest], users_2[latest])
+        }
+
+    @classmethod
+    def from_runs(cls, previous_runs) -> "HistoryIndex":
+        if isinstance(previous_runs, HistoryIndex):
+            return previous_runs
+        if not isinstance(previous_runs, History):
+            previous_runs = History.from_runs(previous_runs)
+        return cls(previous_runs)
+
+    @property
+    def latest_run_date(self) -> str:
+        return date.fromordinal(self.latest_day).isoformat()
+
+    def has_history(self, user: str) -> bool:
+        user_id = self.history.user_ids.get(user)
+        return user_id is not None and self.run_counts[user_id] > 0
+
+    def priority(self, user: str) -> tuple:
+        # Users without history first, then oldest last run and fewest runs
+        user_id = self.history.user_ids.get(user)
+        if user_id is None:
+            return 0, 0
+        return int(self.last_days[user_id]), int(self.run_counts[user_id])
+
+    def cost_matrix(self, users: list[str]) -> np.ndarray:
+        import numpy as np
+
+        position = np.full(len(self.history.users), -1, dtype=np.int64)
+        for i, user in enumerate(users):
+            user_id = self.history.user_ids.get(user)
+            if user_id is not None:
+                position[user_id] = i
+
+        positions_1, positions_2 = position[self._users_1], position[self._users_2]
+        in_block = (positions_1 >= 0) & (positions_2 >= 0)
+        ages = self.latest_day - self._days[in_block]
+        return _pair_cost_matrix(len(users), positions_1[in_block], positions_2[in_block], ages)
+
+
+class SQLiteHistoryIndex(HistoryIndex):
+    # Same interface as HistoryIndex, answered by the queries of a SQLiteFileHandler
+    # instead of loading all runs
+    def __init__(self, file_handler: "SQLiteFileHandler", since: Optional[date] = None):
+        self.file_handler = file_handler
+        self.since = since
+        self.last_runs = {
+            user: (date.fromisoformat(last_run_date).toordinal(), run_count)
+            for user, (last_run_date, run_count) in file_handler.last_run_per_user(since).items()
+        }
+        self.latest_day = max((day for day, _ in self.last_runs.values()), default=date(1970, 1, 1).toordinal())
+        self.latest_pairs = file_handler.pairs_on(self.latest_run_date)
+        self.runs = file_handler.count_runs(since)
+
+    def __len__(self) -> int:
+        return self.runs
+
+    def has_history(self, user: str) -> bool:
+        return user in self.last_runs
+
+    def priority(self, user: str) -> tuple:
+        return self.last_runs.get(user, (0, 0))
+
+    def cost_matrix(self, users: list[str]) -> np.ndarray:
+        import numpy as np
+
+        position = {user: i for i, user in enumerate(users)}
+        meetings = self.file_handler.pair_meetings(users, self.since)
+        positions_1 = np.array([position[user_1] for user_1, _, _ in meetings], dtype=np.int64)
+        positions_2 = np.array([position[user_2] for _, user_2, _ in meetings], dtype=np.int64)
+        ages = self.latest_day - np.array(
+            [date.fromisoformat(meeting_date).toordinal() for _, _, meeting_date in meetings], dtype=np.int64
+        )
+        return _pair_cost_matrix(len(users), positions_1, positions_2, ages)
+
+
+def _pair_cost_matrix(size: int, positions_1: np.ndarray, positions_2: np.ndarray, ages: np.ndarray) -> np.ndarray:
+    # Cost matrix of the meetings between the users at positions_1 and
+    # positions_2, ages in days relative to the latest run
+    import numpy as np
+
+    weights = PAIR_REPEAT_COST * 0.5 ** (ages / PAIR_COST_HALF_LIFE_DAYS)
+    cost = np.zeros((size, size))
+    np.add.at(cost, (positions_1, positions_2), weights)
+    np.add.at(cost, (positions_2, positions_1), weights)
+
+    latest = ages == 0
+    cost[positions_1[latest], positions_2[latest]] = FORBIDDEN_PAIR_COST
+    cost[positions_2[latest], positions_1[latest]] = FORBIDDEN_PAIR_COST
+    np.fill_diagonal(cost, np.inf)
+    return cost
+
+
+def match_users(users: list[str], previous_runs) -> list[str]:
+    # Returns the users ordered so that neighbours form a minimum cost pairing.
+    # An odd last user is left out, just like in generate_user_pairs.
+    users = users[:len(users) - len(users) % 2]
+    matched_users, unpaired_users = _match_blocks(users, HistoryIndex.from_runs(previous_runs))
+    if unpaired_users:
+        raise ValueError("Given users and previous runs do not produce valid pairs.")
+    return matched_users
+
+
+def _match_blocks(users: list[str], index: HistoryIndex) -> tuple[list[str], list[str]]:
+    # Matches every block, returns the matched users in pair order and the
+    # users that no valid pairing of their block includes
+    matched_users = []
+    unpaired_users = []
+    for start in range(0, len(users), MATCHING_BLOCK_SIZE):
+        block = users[start:start + MATCHING_BLOCK_SIZE]
+        pairs = _minimum_cost_matching(index.cost_matrix(block))
+        matched_users.extend(block[i] for i in pairs.flatten())
+        paired = set(pairs.flatten().tolist())
+        unpaired_users.extend(user for i, user in enumerate(block) if i not in paired)
+    return matched_users, unpaired_users
+
+
+def _minimum_cost_matching(cost: np.ndarray) -> np.ndarray:
+    # Pairs as many users as possible without forbidden pairs, at the lowest
+    # total cost. Costs are never negative, so a pairing of users who never
+    # met is optimal and the exact matching is only needed without one.
+    import numpy as np
+
+    pairs = _zero_cost_matching(cost)
+    if 2 * len(pairs) == len(cost):
+        return pairs
+
+    import networkx
+
+    allowed = np.argwhere(np.triu(cost < FORBIDDEN_PAIR_COST, 1))
+    scaled = np.rint(cost[allowed[:, 0], allowed[:, 1]] * MATCHING_COST_SCALE).astype(np.int64)
+    # With the maximum number of pairs, the highest total weight is the lowest total cost
+    weights = (int(scaled.max()) + 1 if len(scaled) else 1) - scaled
+    graph = networkx.Graph()
+    graph.add_nodes_from(range(len(cost)))
+    graph.add_weighted_edges_from(zip(allowed[:, 0].tolist(), allowed[:, 1].tolist(), weights.tolist()))
+    matching = networkx.max_weight_matching(graph, maxcardinality=True)
+    return np.array(sorted(tuple(sorted(pair)) for pair in matching), dtype=int).reshape(-1, 2)
+
+
+def _zero_cost_matching(cost: np.ndarray) -> np.ndarray:
+    # Match every user with the first free user they never met, may leave users unpaired
+    import numpy as np
+
+    available = np.ones(len(cost), dtype=bool)
+    pairs = []
+    for i in range(len(cost)):
+        if not available[i]:
+            continue
+        partners = np.flatnonzero(available & (cost[i] == 0))
+        if len(partners) == 0:
+            continue
+        j = int(partners[0])
+        available[i] = available[j] = False
+        pairs.append((i, j))
+    return np.array(pairs, dtype=int).reshape(-1, 2)
+
+
 def filter_users_based_on_previous_runs(users, previous_runs) -> list[str]:
     if len(users) < 2:
         return []
 
-    # Find the last run date of each user
-    last_run_dates = {user: max(run["date"] for run in previous_runs if user in run["pair"]) for user in users if
-                      any(user in run["pair"] for run in previous_runs)}
+    index = HistoryIndex.from_runs(previous_runs)
 
     # Users who need a coffee break as they had none in the last 30 days
-    need_break_users = [user for user in users if user not in last_run_dates]
+    need_break_users = [user for user in users if not index.has_history(user)]
     random.shuffle(need_break_users)
-    other_users = [user for user in users if user not in need_break_users]
-
-    # Users from the latest run date (those who took a break in the last round)
-    latest_run_date = max(run["date"] for run in previous_runs) if previous_runs else "1970-01-01"
-    last_run_pairs = [tuple(sorted(pair)) for pair in
-                      [run['pair'] for run in previous_runs if run['date'] == latest_run_date]]
 
-    # If we haven't met the 50% rule, add random users to fill incomplete user pairs
+    # If we haven't met the 50% rule, add the most overdue users to fill incomplete user pairs
     number_of_coffee_break_users = math.ceil(len(users) / 4) * 2
     required_users_count = number_of_coffee_break_users - len(need_break_users)
 
@@ -179,19 +2534,35 @@ def filter_users_based_on_previous_runs(users, previous_runs) -> list[str]:
     if required_users_count < 0:
         del coffee_break_users[required_users_count:]
     elif required_users_count > 0:
-        coffee_break_users.extend(random.sample(other_users, required_users_count))
+        other_users = [user for user in users if index.has_history(user)]
+        coffee_break_users.extend(heapq.nsmallest(
+            required_users_count,
+            other_users,
+            # Oldest last run first, fewer runs and then chance break ties
+            key=lambda user: (*index.priority(user), random.random()),
+        ))
 
-    # Keep shuffling until a suitable arrangement (no combination from last run) is found
+    # Pair the users with the least (recent) shared history, pairs from the last run are not allowed
     random.shuffle(coffee_break_users)
-    user_pairs = generate_user_pairs(coffee_break_users)
-    num_tries = 0
-    max_tries = 1000
-    while any(pair in last_run_pairs for pair in user_pairs):
-        random.shuffle(coffee_break_users)
-        user_pairs = generate_user_pairs(coffee_break_users)
-        num_tries += 1
-        print(coffee_break_users)
-        if num_tries > max_tries:
-            raise ValueError("Given users and previous runs do not produce valid pairs.")
-
-    return coffee_break_users
+    try:
+        return match_users(coffee_break_users, index)
+    except ValueError:
+        pass
+
+    # No valid pairing among the selected users. The users that the largest
+    # valid matching leaves unpaired are swapped for the next most overdue
+    # users, every standby user is tried once.
+    selected = set(coffee_break_users)
+    standby_users = sorted((user for user in users if user not in selected), key=index.priority)
+    _, unpaired_users = _match_blocks(coffee_break_users, index)
+    for standby_user in standby_users:
+        if not unpaired_users:
+            break
+        candidate_users = [standby_user if user == unpaired_users[-1] else user for user in coffee_break_users]
+        _, candidate_unpaired_users = _match_blocks(candidate_users, index)
+        if len(candidate_unpaired_users) < len(unpaired_users):
+            coffee_break_users, unpaired_users = candidate_users, candidate_unpaired_users
+
+    if unpaired_users:
+        raise ValueError("Given users and previous runs do not produce valid pairs.")
+    return match_users(coffee_break_users, index)
@@ -0,0 +1,10 @@
+import pytest
+
+from slack_bot.app import get_rate_limiter
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limiter():
+    # The token buckets are shared by the process, every test starts with full buckets
+    get_rate_limiter.cache_clear()
+    yield
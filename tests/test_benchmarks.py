@@ -0,0 +1,54 @@
+from benchmarks.run import compare, run_case
+from benchmarks.simulate import simulate
+
+
+def test_run_case_counts_calls():
+    # when
+    result = run_case(number_of_users=100, years=1)
+
+    # then
+    assert result["history_runs"] == 52 * 25
+    assert result["s3_calls"] == {"ListObjectsV2": 1, "GetObject": 52, "PutObject": 1}
+    assert result["slack_calls"]["users.list"] == 1
+    assert result["slack_calls"]["conversations.open"] == result["pairs"]
+    assert result["slack_calls"]["chat.postMessage"] == result["pairs"]
+    assert set(result["stages"]) == {"roster", "history_read", "selection", "dispatch", "history_write"}
+
+
+def test_compare_reports_regressions():
+    # given
+    baseline = {
+        "case": {
+            "stages": {"selection": 1.0, "dispatch": 0.01},
+            "slack_calls": {"users.list": 1},
+            "s3_calls": {"GetObject": 52},
+        }
+    }
+    results = {
+        "case": {
+            "stages": {"selection": 2.0, "dispatch": 0.03},
+            "slack_calls": {"users.list": 1, "users.info": 100},
+            "s3_calls": {"GetObject": 52},
+        }
+    }
+
+    # when
+    regressions = compare(results, baseline, tolerance=0.5)
+
+    # then
+    assert regressions == [
+        "case: slack_calls changed from {'users.list': 1} to {'users.list': 1, 'users.info': 100}",
+        "case: selection took 2.000s, baseline 1.000s",
+    ]
+
+
+def test_simulate_reports_weeks_and_fairness():
+    # when
+    result = simulate(number_of_users=40, weeks=6, absence_rate=0.1, churn_rate=0.05, measure_memory=False)
+
+    # then
+    assert [week["week"] for week in result["weeks"]] == list(range(6))
+    assert all(week["error"] is None for week in result["weeks"])
+    assert all(week["pairs"] > 0 for week in result["weeks"])
+    assert result["fairness"]["max_pair_repeats"] == 1
+    assert result["fairness"]["max_weeks_between_breaks"] >= 1
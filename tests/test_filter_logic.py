@@ -1,11 +1,13 @@
 import random
+from datetime import date
+
 import pytest
 
 from contextlib import nullcontext as does_not_raise
 from freezegun import freeze_time
 
 # Assuming the filter_users_based_on_previous_runs function is in the 'main' module
-from slack_bot.app import filter_users_based_on_previous_runs, generate_user_pairs
+from slack_bot.app import History, HistoryIndex, filter_users_based_on_previous_runs, generate_user_pairs, match_users
 
 
 @freeze_time("2023-08-01")
@@ -40,6 +42,70 @@ def test_filter_users_correct_number_without_history():
     assert len(taking_break) == 6
 
 
+def test_filter_users_prefers_most_overdue_users():
+    # given
+    sample_runs = [
+        {'date': '2023-06-04', 'pair': ['user1', 'user2']},
+        {'date': '2023-06-11', 'pair': ['user3', 'user4']},
+        {'date': '2023-06-11', 'pair': ['user5', 'user6']},
+        {'date': '2023-06-18', 'pair': ['user7', 'user8']},
+        {'date': '2023-06-25', 'pair': ['user3', 'user5']},
+        {'date': '2023-07-02', 'pair': ['user1', 'user7']},
+    ]
+    users = [f"user{i}" for i in range(1, 9)]
+
+    # when
+    taking_break = filter_users_based_on_previous_runs(users, sample_runs)
+
+    # then
+    # user2 (2023-06-04), user4 and user6 (2023-06-11, one run each) and user8 (2023-06-18)
+    assert sorted(taking_break) == ["user2", "user4", "user6", "user8"]
+
+
+def test_history_index():
+    # given
+    sample_runs = [
+        {'date': '2023-06-25', 'pair': ['user2', 'user1']},
+        {'date': '2023-07-02', 'pair': ['user3', 'user1']},
+        {'date': '2023-07-02', 'pair': ['user4', 'user5']},
+    ]
+
+    # when
+    index = HistoryIndex.from_runs(sample_runs)
+
+    # then
+    assert index.priority("user1") == (date(2023, 7, 2).toordinal(), 2)
+    assert index.priority("user2") == (date(2023, 6, 25).toordinal(), 1)
+    assert index.priority("user6") == (0, 0)
+    assert index.has_history("user5")
+    assert not index.has_history("user6")
+    assert index.latest_run_date == "2023-07-02"
+    assert index.latest_pairs == {("user1", "user3"), ("user4", "user5")}
+
+
+def test_history_interns_users_and_dates():
+    # given
+    sample_runs = [
+        {'date': '2023-06-25', 'pair': ['user2', 'user1']},
+        {'date': '2023-07-02', 'pair': ['user3', 'user1']},
+    ]
+
+    # when
+    history = History.from_runs(sample_runs)
+
+    # then
+    assert history.users == ["user2", "user1", "user3"]
+    assert list(history.users_1) == [0, 2]
+    assert list(history.users_2) == [1, 1]
+    assert list(history.days) == [date(2023, 6, 25).toordinal(), date(2023, 7, 2).toordinal()]
+    assert history.to_runs() == sample_runs
+    random.seed(0)
+    from_history = filter_users_based_on_previous_runs(["user1", "user2", "user3"], history)
+    random.seed(0)
+    from_runs = filter_users_based_on_previous_runs(["user1", "user2", "user3"], sample_runs)
+    assert from_history == from_runs
+
+
 def test_filter_users_correct_number_with_all_have_history():
     # given
     sample_runs = [
@@ -80,6 +146,98 @@ def test_generate_user_pairs(users, expected_user_pairs):
     assert user_pairs == expected_user_pairs
 
 
+def test_generate_user_pairs_avoids_last_run_and_frequent_pairs():
+    # given
+    previous_runs = [
+        {"date": "2023-06-04", "pair": ["a", "c"]},
+        {"date": "2023-06-18", "pair": ["a", "c"]},
+        {"date": "2023-07-02", "pair": ["a", "b"]},
+        {"date": "2023-07-02", "pair": ["c", "d"]},
+    ]
+
+    # when
+    user_pairs = generate_user_pairs(["a", "b", "c", "d"], previous_runs)
+
+    # then
+    assert sorted(user_pairs) == [("a", "d"), ("b", "c")]
+
+
+def test_match_users_finds_valid_pairing_of_dense_latest_run():
+    # given
+    previous_runs = [
+        {"date": "2023-07-02", "pair": list(pair)} for pair in ["ab", "ac", "bc", "be", "bf", "cd", "de"]
+    ]
+
+    # when
+    matched_users = match_users(["a", "b", "c", "d", "e", "f"], previous_runs)
+
+    # then
+    user_pairs = {tuple(sorted(matched_users[i:i + 2])) for i in range(0, 6, 2)}
+    assert len(user_pairs) == 3
+    assert not user_pairs & {tuple(run["pair"]) for run in previous_runs}
+
+
+def _all_pairings(users):
+    if not users:
+        yield []
+        return
+    for i in range(1, len(users)):
+        for pairing in _all_pairings(users[1:i] + users[i + 1:]):
+            yield [(users[0], users[i])] + pairing
+
+
+def test_match_users_returns_minimum_cost_pairing():
+    # given
+    rng = random.Random(0)
+    for _ in range(200):
+        users = [f"user{i}" for i in range(rng.choice([4, 6, 8]))]
+        previous_runs = [
+            {"date": run_date, "pair": [user_1, user_2]}
+            for run_date, probability in [("2023-06-04", 0.3), ("2023-06-18", 0.3), ("2023-07-02", 0.4)]
+            for i, user_1 in enumerate(users) for user_2 in users[i + 1:]
+            if rng.random() < probability
+        ]
+        index = HistoryIndex.from_runs(previous_runs)
+        cost = index.cost_matrix(users)
+
+        def pairing_cost(pairing):
+            return sum(cost[users.index(user_1), users.index(user_2)] for user_1, user_2 in pairing)
+
+        best_cost = min(pairing_cost(pairing) for pairing in _all_pairings(users))
+
+        # when
+        if best_cost >= 1e9:
+            with pytest.raises(ValueError):
+                match_users(users, index)
+            continue
+        matched_users = match_users(users, index)
+
+        # then
+        assert pairing_cost(zip(matched_users[::2], matched_users[1::2])) == pytest.approx(best_cost)
+
+
+def test_generate_user_pairs_finds_valid_pairing_for_large_rosters():
+    # given
+    random.seed(0)
+    users = [f"user{i}" for i in range(600)]
+    previous_runs = []
+    for week in range(1, 13):
+        random.shuffle(users)
+        previous_runs.extend(
+            {"date": f"2023-{week:02d}-01", "pair": [users[i], users[i + 1]]} for i in range(0, len(users), 2)
+        )
+    last_run_pairs = {tuple(sorted(run["pair"])) for run in previous_runs if run["date"] == "2023-12-01"}
+
+    # when
+    random.shuffle(users)
+    user_pairs = generate_user_pairs(users, previous_runs)
+
+    # then
+    assert len(user_pairs) == 300
+    assert len({user for pair in user_pairs for user in pair}) == 600
+    assert not last_run_pairs & set(user_pairs)
+
+
 @pytest.mark.parametrize(
     "users,previous_runs,expected_raises,expected_filtered_users",
     [
@@ -152,9 +310,9 @@ def test_generate_user_pairs(users, expected_user_pairs):
             does_not_raise(),
             ["g", "e", "h", "f"],
         ],
-        # "b" is the only needed user, "a", "c" and "e" are filled randomly to
-        # reach 50%. The only valid pair for "a" is (a, b) and therefore the
-        # other pair is (c, e).
+        # "b" is the only needed user, "d", "e" (one run each) and "c" (tie with
+        # "a") are the most overdue users to reach 50%. (c, d) was used last
+        # time, so the pairs are (b, d) and (c, e).
         [
             ["a", "b", "c", "d", "e"],
             [
@@ -163,7 +321,7 @@ def test_generate_user_pairs(users, expected_user_pairs):
                 {"date": "2023-07-02", "pair": ["c", "d"]},
             ],
             does_not_raise(),
-            ["b", "a", "e", "c"],
+            ["b", "d", "e", "c"],
         ],
         # No valid pair, as only (a, b) is possible but was used last time
         [
@@ -174,18 +332,17 @@ def test_generate_user_pairs(users, expected_user_pairs):
             pytest.raises(ValueError),
             [],
         ],
-        # Gets stuck in a loop shuffling (b, c), valid would be (a, c). This is
-        # the result of all users being present in the list of previous runs,
-        # which is a valid edge case, but not relevant given that we only
-        # select pairs for 50% of the users every time.
+        # All users are present in the list of previous runs. "b" had two
+        # breaks, so the most overdue users "a" and "c" are selected, which is
+        # the only valid pair.
         [
             ["a", "b", "c"],
             [
                 {"date": "2023-07-02", "pair": ["a", "b"]},
                 {"date": "2023-07-02", "pair": ["b", "c"]},
             ],
-            pytest.raises(ValueError),
-            [],
+            does_not_raise(),
+            ["c", "a"],
         ],
     ],
 )
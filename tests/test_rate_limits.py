@@ -0,0 +1,201 @@
+import asyncio
+import socket
+import time
+from urllib.error import URLError
+
+import aiohttp
+import pytest
+
+from benchmarks.fake_slack_server import FakeSlackServer
+from benchmarks.fakes import synthetic_profiles
+from slack_bot import app
+from slack_bot.app import (
+    AsyncRateLimitedClient,
+    DispatchIncomplete,
+    Metrics,
+    RateLimitedClient,
+    RateLimiter,
+    TokenBucket,
+    _retry_delay,
+)
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+
+USER_IDS = [f"U{i}" for i in range(6)]
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def _slack_api_error(status_code: int, headers: dict = None) -> SlackApiError:
+    return SlackApiError("error", FakeResponse(status_code, headers))
+
+
+def test_token_bucket_allows_a_burst_then_spreads_calls():
+    # given
+    bucket = TokenBucket(rate_per_minute=60, capacity=2)
+
+    # when
+    waits = [bucket.reserve() for _ in range(4)]
+    bucket.pause(10)
+    paused_wait = bucket.reserve()
+
+    # then
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(1.0, abs=0.05)
+    assert waits[3] == pytest.approx(2.0, abs=0.05)
+    assert paused_wait == pytest.approx(11.0, abs=0.05)
+
+
+def test_rate_limiter_buckets_per_tier_and_channel():
+    # given
+    limiter = RateLimiter({"users.info": 600})
+
+    # then
+    assert limiter.bucket("users.info").rate == 10
+    assert limiter.bucket("users.list").rate == pytest.approx(20 / 60)
+    assert limiter.bucket("conversations.open").rate == pytest.approx(50 / 60)
+    assert limiter.bucket("chat.postMessage", "D1") is not limiter.bucket("chat.postMessage", "D2")
+    assert limiter.bucket("users.info") is limiter.bucket("users.info")
+
+
+@pytest.mark.parametrize(
+    "method,error,attempt,expected_delay",
+    [
+        ("users.info", _slack_api_error(429, {"Retry-After": "7"}), 0, 7),
+        ("chat.postMessage", _slack_api_error(429, {"retry-after": "3"}), 0, 3),
+        ("users.info", _slack_api_error(429), 2, 4),
+        ("users.info", _slack_api_error(503), 1, 2),
+        ("chat.postMessage", _slack_api_error(503), 0, None),
+        ("users.info", ConnectionResetError(), 0, 1),
+        ("users.info", socket.timeout(), 1, 2),
+        ("chat.postMessage", URLError(ConnectionRefusedError()), 0, 1),
+        ("chat.scheduleMessage", URLError(socket.gaierror()), 1, 2),
+        ("chat.postMessage", ConnectionRefusedError(), 0, 1),
+        ("chat.postMessage", aiohttp.ClientConnectorError(None, ConnectionRefusedError()), 0, 1),
+        # the message may have been posted before these errors
+        ("chat.postMessage", ConnectionResetError(), 0, None),
+        ("chat.postMessage", socket.timeout(), 0, None),
+        ("chat.scheduleMessage", URLError(socket.timeout()), 0, None),
+        ("chat.postMessage", aiohttp.ServerDisconnectedError(), 0, None),
+        ("users.info", _slack_api_error(400), 0, None),
+        ("users.info", _slack_api_error(429, {"Retry-After": "1"}), 3, None),
+        ("users.info", ValueError(), 0, None),
+    ],
+)
+def test_retry_delay(mocker, method, error, attempt, expected_delay):
+    # given
+    mocker.patch("slack_bot.app.random.uniform", return_value=0.0)
+
+    # when
+    delay = _retry_delay(method, error, attempt)
+
+    # then
+    assert delay == expected_delay
+
+
+def test_rate_limited_client_retries_throttled_calls_against_fake_server(mocker):
+    # given
+    mocker.patch("slack_bot.app.SLACK_BACKOFF_SECONDS", 0.01)
+    limiter = RateLimiter()
+    records = []
+    metrics = Metrics(sink=records.append)
+
+    with FakeSlackServer(synthetic_profiles(USER_IDS, absence_rate=0), rate_limits={"users.info": 3}) as server:
+        client = RateLimitedClient(WebClient(token="xoxb-fake", base_url=server.base_url), limiter, metrics)
+
+        # when
+        start = time.monotonic()
+        names = [client.users_info(user=user)["user"]["profile"]["real_name"] for user in USER_IDS]
+        seconds = time.monotonic() - start
+    metrics.emit()
+
+    # then
+    assert names == [f"First{i} Last{i}" for i in range(6)]
+    assert server.calls["users.info"] == 6
+    assert server.throttled["users.info"] == 1
+    assert limiter.throttled == {"users.info": 1}
+    assert records[0]["SlackThrottled.users.info"] == 1
+    # the three calls above the limit waited for the next window instead of failing
+    assert 0.9 < seconds < 3
+
+
+def test_rate_limited_client_stops_at_deadline_instead_of_waiting(mocker):
+    # given
+    limiter = RateLimiter({"conversations.open": 1})
+    client = RateLimitedClient(mocker.Mock(), limiter, deadline=time.monotonic() + 5)
+
+    # when
+    client.conversations_open(users=["U1", "U2"])
+    with pytest.raises(DispatchIncomplete):
+        client.conversations_open(users=["U3", "U4"])
+
+    # then
+    assert client.client.conversations_open.call_count == 1
+
+
+def test_rate_limited_client_does_not_retry_post_on_server_error(mocker):
+    # given
+    mocker.patch("slack_bot.app.SLACK_BACKOFF_SECONDS", 0.01)
+    slack = mocker.Mock()
+    slack.chat_postMessage.side_effect = _slack_api_error(500)
+    slack.users_info.side_effect = [_slack_api_error(500), {"user": {"id": "U1"}}]
+    client = RateLimitedClient(slack)
+
+    # when
+    with pytest.raises(SlackApiError):
+        client.chat_postMessage(channel="D1", text="hi")
+    user = client.users_info(user="U1")
+
+    # then
+    assert slack.chat_postMessage.call_count == 1
+    assert slack.users_info.call_count == 2
+    assert user == {"user": {"id": "U1"}}
+
+
+def test_async_rate_limited_client_retries_throttled_calls_against_fake_server(mocker):
+    # given
+    from slack_sdk.web.async_client import AsyncWebClient
+
+    mocker.patch("slack_bot.app.SLACK_BACKOFF_SECONDS", 0.01)
+    limiter = RateLimiter()
+
+    async def post_messages(base_url: str) -> list:
+        client = AsyncRateLimitedClient(AsyncWebClient(token="xoxb-fake", base_url=base_url), limiter)
+        return await asyncio.gather(*(client.chat_postMessage(channel=f"D{i}", text="hi") for i in range(4)))
+
+    with FakeSlackServer(synthetic_profiles(USER_IDS), rate_limits={"chat.postMessage": 2}) as server:
+        # when
+        responses = asyncio.run(post_messages(server.base_url))
+
+    # then
+    assert all(response["ok"] for response in responses)
+    assert server.calls["chat.postMessage"] == 4
+    assert limiter.throttled["chat.postMessage"] >= 1
+
+
+def test_dispatch_saves_pairs_sent_before_a_rate_limit_wait_hits_the_deadline(mocker):
+    # given
+    mocker.patch("slack_bot.app.CHECKPOINT_BATCH_SIZE", 10)
+    mocker.patch("slack_bot.app.get_rate_limiter", return_value=RateLimiter({"conversations.open": 2}))
+    mocker.patch.dict("os.environ", {"SLACK_RATE_LIMITS": "true"})
+    profiles = synthetic_profiles(USER_IDS, absence_rate=0)
+    with FakeSlackServer(profiles) as server:
+        deadline = time.monotonic() + 5
+        client = app.Roster(
+            app.rate_limited(WebClient(token="xoxb-fake", base_url=server.base_url), deadline=deadline), profiles
+        )
+        file_handler = app.InMemoryFileHandler()
+        checkpoint = {"round": "2021-W01", "date": "2021-01-04", "pairs": [["U0", "U1"], ["U2", "U3"], ["U4", "U5"]],
+                      "delivered": [], "failed": []}
+
+        # when
+        with pytest.raises(DispatchIncomplete):
+            app.dispatch_with_checkpoint(checkpoint, client, file_handler, deadline=deadline)
+
+    # then
+    assert file_handler.read_state("checkpoint")["delivered"] == [["U0", "U1"], ["U2", "U3"]]
+    assert server.calls["chat.postMessage"] == 2
@@ -0,0 +1,160 @@
+import os
+from datetime import datetime, timezone
+
+import pytest
+from freezegun import freeze_time
+
+from benchmarks.fake_slack_server import FakeSlackServer
+from benchmarks.fakes import FakeSlackClient, synthetic_profiles
+from slack_bot.app import (
+    InMemoryFileHandler,
+    cancel_scheduled_messages,
+    create_history_runs,
+    get_delivery_time,
+    process_users,
+    schedule_message,
+)
+from slack_sdk import WebClient
+
+# Berlin, New York and Tokyo
+TZ_OFFSETS = {"U0": 3600, "U1": 3600, "U2": -18000, "U3": -18000, "U4": 32400, "U5": 32400}
+RUN_TIME = "2021-01-04 00:00:00"
+
+
+def _timestamp(value: str) -> int:
+    return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+
+
+def _profiles(user_ids) -> dict:
+    profiles = synthetic_profiles(user_ids, absence_rate=0)
+    for user_id, profile in profiles.items():
+        profile["tz_offset"] = TZ_OFFSETS.get(user_id, 0)
+    return profiles
+
+
+@freeze_time(RUN_TIME)
+@pytest.mark.parametrize(
+    "user_pair,expected_post_at",
+    [
+        (("U0", "U1"), "2021-01-04 08:00:00"),
+        # 9:00 in New York is 15:00 in Berlin, nobody gets the message before 9:00
+        (("U0", "U2"), "2021-01-04 14:00:00"),
+        # 9:00 in Tokyo has just passed, the message is scheduled right away
+        (("U4", "U5"), "2021-01-04 00:01:00"),
+        (("U4", "U1"), "2021-01-04 08:00:00"),
+    ],
+)
+def test_get_delivery_time(user_pair, expected_post_at):
+    # given
+    client = FakeSlackClient(_profiles(TZ_OFFSETS))
+
+    # when
+    post_at = get_delivery_time(user_pair, client, datetime.now(timezone.utc).timestamp())
+
+    # then
+    assert post_at == _timestamp(expected_post_at)
+
+
+@freeze_time(RUN_TIME)
+def test_process_users_schedules_messages_by_time_zone(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"SLACK_TOKEN": "xxx", "SCHEDULED_DELIVERY": "true"})
+    mocker.patch("slack_bot.app.generate_user_pairs", return_value=[("U0", "U2"), ("U4", "U5"), ("U1", "U3")])
+    mocker.patch("slack_bot.app.get_users", return_value=list(TZ_OFFSETS))
+    slack = FakeSlackClient(_profiles(TZ_OFFSETS))
+    mocker.patch("slack_bot.app.get_slack_client", return_value=slack)
+    file_handler = InMemoryFileHandler()
+
+    # when
+    results = process_users(file_handler)
+
+    # then
+    checkpoint = file_handler.read_state("checkpoint")
+    assert all(result.delivered for result in results)
+    assert slack.calls["chat.scheduleMessage"] == 3
+    assert slack.calls["chat.postMessage"] == 0
+    # the earliest bucket is scheduled first
+    assert [message["pair"] for message in checkpoint["scheduled"]] == [["U4", "U5"], ["U0", "U2"], ["U1", "U3"]]
+    assert [message["post_at"] for message in checkpoint["scheduled"]] == [
+        _timestamp("2021-01-04 00:01:00"), _timestamp("2021-01-04 14:00:00"), _timestamp("2021-01-04 14:00:00"),
+    ]
+    assert file_handler.read() == create_history_runs(checkpoint)
+    assert file_handler.read()[0] == {
+        "date": "2021-01-04",
+        "pair": ["U4", "U5"],
+        "scheduled_message": {"channel": "DU4U5", "id": "Q1", "post_at": _timestamp("2021-01-04 00:01:00")},
+    }
+
+
+@freeze_time(RUN_TIME)
+def test_cancel_scheduled_messages_lets_the_round_run_again(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"SLACK_TOKEN": "xxx", "SCHEDULED_DELIVERY": "true"})
+    mocker.patch("slack_bot.app.get_users", return_value=[f"U{i}" for i in range(8)])
+    slack = FakeSlackClient(_profiles([f"U{i}" for i in range(8)]))
+    mocker.patch("slack_bot.app.get_slack_client", return_value=slack)
+    previous_runs = [{"date": "2020-12-28", "pair": ["U0", "U1"]}, {"date": "2020-12-28", "pair": ["U4", "U6"]}]
+    file_handler = InMemoryFileHandler(previous_runs)
+    process_users(file_handler)
+    first_round_runs = file_handler.read()[2:]
+
+    # when
+    cancelled = cancel_scheduled_messages(file_handler, slack)
+    history_after_cancel = file_handler.read()
+    process_users(file_handler)
+
+    # then
+    second_round_runs = file_handler.read()[2:]
+    assert cancelled == 2
+    assert slack.calls["chat.deleteScheduledMessage"] == 2
+    assert history_after_cancel == previous_runs
+    # the users of the cancelled round are still the ones who need a break
+    assert sorted(user for run in first_round_runs for user in run["pair"]) == ["U2", "U3", "U5", "U7"]
+    assert sorted(user for run in second_round_runs for user in run["pair"]) == ["U2", "U3", "U5", "U7"]
+    assert sorted(slack.scheduled_messages) == ["Q3", "Q4"]
+    assert file_handler.read_state("checkpoint")["completed"] is True
+
+
+@freeze_time(RUN_TIME)
+def test_cancel_scheduled_messages_records_posted_pairs_of_incomplete_round(mocker):
+    # given
+    slack = FakeSlackClient(_profiles(TZ_OFFSETS))
+    file_handler = InMemoryFileHandler()
+    file_handler.write_state("checkpoint", {
+        "round": "2020-W53",
+        "date": "2021-01-03",
+        "pairs": [["U0", "U2"], ["U4", "U5"]],
+        "delivered": [["U0", "U2"], ["U4", "U5"]],
+        "failed": [],
+        "scheduled": [
+            {"pair": ["U4", "U5"], "channel": "DU4U5", "id": "Q1", "post_at": _timestamp("2021-01-03 23:00:00")},
+            {"pair": ["U0", "U2"], "channel": "DU0U2", "id": "Q2", "post_at": _timestamp("2021-01-04 14:00:00")},
+        ],
+    })
+    slack.scheduled_messages["Q2"] = ("DU0U2", "text", _timestamp("2021-01-04 14:00:00"))
+    mocker.patch("slack_bot.app.get_round", return_value="2020-W53")
+
+    # when
+    cancelled = cancel_scheduled_messages(file_handler, slack)
+
+    # then
+    assert cancelled == 1
+    assert [run["pair"] for run in file_handler.read()] == [["U4", "U5"]]
+    assert file_handler.read_state("checkpoint")["cancelled"] is True
+
+
+def test_schedule_message_against_fake_server():
+    # given
+    profiles = _profiles(["U0", "U1"])
+    post_at = _timestamp("2021-01-04 08:00:00")
+
+    with FakeSlackServer(profiles) as server:
+        client = WebClient(token="xoxb-fake", base_url=server.base_url)
+
+        # when
+        message = schedule_message(["U0", "U1"], client, post_at, "en")
+
+        # then
+        assert message == {"channel": "DU0U1", "id": "Q1", "post_at": post_at}
+        assert server.client.scheduled_messages["Q1"][0] == "DU0U1"
+        assert server.client.scheduled_messages["Q1"][1].startswith("First0 and First1")
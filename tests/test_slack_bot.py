@@ -1,20 +1,45 @@
+import asyncio
 import copy
+import gzip
 import json
 import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import date
 
 import pytest
 from freezegun import freeze_time
-from moto import mock_s3
+from moto import mock_s3, mock_sqs
 import boto3
 
-from slack_bot import __version__
+from slack_bot import __version__, app
 from slack_bot.app import (
+    DispatchIncomplete,
+    InMemoryFileHandler,
+    InMemoryQueue,
+    JSONLFileHandler,
+    Metrics,
+    ProfileCache,
+    Roster,
+    events_handler,
+    get_channel_members,
+    replay_user_events,
+    process_rosters,
+    process_users,
+    dispatch_messages,
+    get_s3_client,
+    get_slack_client,
     get_message,
+    get_user_name,
     is_included_user,
     handler,
     send_message,
+    worker_handler,
 )
-from slack_bot.app import S3FileHandler
+from slack_bot.app import DiskCache, History, ReadStats, select_user_pairs, S3FileHandler, SQLiteFileHandler, SQSQueue, filter_users_based_on_previous_runs
 from slack_sdk import WebClient
 
 TEST_USERS = [
@@ -44,8 +69,10 @@ def test_handler(mocker):
     )
     mock_token = mocker.patch("slack_bot.app.get_token", return_value="xxx")
     mock_send_message = mocker.patch("slack_bot.app.send_message")
-    mock_file_handler_read = mocker.patch("slack_bot.app.S3FileHandler.read", return_value=[])
+    mock_file_handler_read = mocker.patch("slack_bot.app.S3FileHandler.iter_runs", return_value=iter([]))
     mock_file_handler_write = mocker.patch("slack_bot.app.S3FileHandler.write")
+    mocker.patch("slack_bot.app.S3FileHandler.read_state", return_value=None)
+    mocker.patch("slack_bot.app.S3FileHandler.write_state")
 
     # when
     handler("", "")
@@ -58,6 +85,392 @@ def test_handler(mocker):
     assert mock_send_message.call_count == 3
 
 
+def test_app_import_does_not_load_heavy_modules():
+    # given
+    code = "import sys, slack_bot.app; print(sorted({'boto3', 'numpy', 'slack_sdk', 'asyncio'} & set(sys.modules)))"
+
+    # when
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+
+    # then
+    assert result.stdout.strip() == "[]"
+
+
+@freeze_time("2021-01-02")
+def test_handler_reuses_clients_on_warm_invocations(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"S3_BUCKET": "cubicl-bot", "S3_PREFIX": "runs", "SLACK_TOKEN": "xxx"})
+    mocker.patch("slack_bot.app.get_users", return_value=copy.deepcopy(TEST_USERS))
+    mocker.patch("slack_bot.app.send_message")
+    mocker.patch("slack_bot.app.S3FileHandler.iter_runs", side_effect=lambda since=None: iter([]))
+    mocker.patch("slack_bot.app.S3FileHandler.write")
+    mocker.patch("slack_bot.app.S3FileHandler.read_state", return_value=None)
+    mocker.patch("slack_bot.app.S3FileHandler.write_state")
+    mock_create_s3_client = mocker.patch("slack_bot.app.create_s3_client")
+    mock_web_client = mocker.patch("slack_sdk.WebClient")
+    get_s3_client.cache_clear()
+    get_slack_client.cache_clear()
+
+    # when
+    handler("", "")
+    handler("", "")
+
+    # then
+    mock_create_s3_client.assert_called_once()
+    mock_web_client.assert_called_once_with(token="xxx")
+    get_s3_client.cache_clear()
+    get_slack_client.cache_clear()
+
+
+@freeze_time("2021-01-02")
+def test_handler_writes_profile_when_requested(mocker, tmp_path):
+    # given
+    import pstats
+
+    mocker.patch.dict(os.environ, {"S3_PREFIX": "runs", "PROFILING": "false"})
+    mocker.patch("slack_bot.app.get_file_handler")
+    mock_process_users = mocker.patch(
+        "slack_bot.app.process_users", side_effect=lambda *args, **kwargs: filter_users_based_on_previous_runs(
+            [f"U{i}" for i in range(100)], [{"date": "2020-12-26", "pair": ["U1", "U2"]}]
+        )
+    )
+    profile_file_handler = InMemoryFileHandler()
+    mocker.patch("slack_bot.app.get_profile_file_handler", return_value=profile_file_handler)
+    mock_profiled = mocker.spy(app, "profiled")
+
+    # when
+    handler({}, None)
+    unprofiled_calls = mock_profiled.call_count
+    handler({"profile": True}, None)
+
+    # then
+    assert unprofiled_calls == 0
+    assert mock_process_users.call_count == 2
+    assert sorted(profile_file_handler.blobs) == [
+        "profiles/2021-01-02_00-00-00.allocations.json",
+        "profiles/2021-01-02_00-00-00.prof",
+    ]
+    profile_path = tmp_path / "run.prof"
+    profile_path.write_bytes(profile_file_handler.read_blob("profiles/2021-01-02_00-00-00.prof"))
+    stats = pstats.Stats(str(profile_path))
+    assert any(function == "filter_users_based_on_previous_runs" for _, _, function in stats.stats)
+    allocations = json.loads(profile_file_handler.read_blob("profiles/2021-01-02_00-00-00.allocations.json"))
+    assert allocations["peak"] > 0
+    assert allocations["allocations"][0]["size"] > 0
+
+
+@freeze_time("2021-01-02")
+def test_process_users_emits_metrics(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"USERS": json.dumps({f"user{i}": user for i, user in enumerate(TEST_USERS)})})
+    mocker.patch("slack_bot.app.get_token", return_value="xxx")
+    mocker.patch("slack_sdk.WebClient.users_info", side_effect=lambda user: {"user": _slack_user(user)})
+    mocker.patch("slack_sdk.WebClient.conversations_open", return_value={"channel": {"id": "dummy"}})
+    mocker.patch("slack_sdk.WebClient.chat_postMessage")
+    file_handler = mocker.Mock(spec=S3FileHandler)
+    file_handler.read_history.return_value = []
+    file_handler.read_state.return_value = None
+    file_handler.last_read_stats = ReadStats(objects=2, bytes=1024, retries=1)
+    records = []
+
+    # when
+    process_users(file_handler, Metrics(sink=records.append, dimensions={"Roster": "runs"}))
+
+    # then
+    assert len(records) == 1
+    record = records[0]
+    definition = record["_aws"]["CloudWatchMetrics"][0]
+    assert definition["Namespace"] == "CoffeeBreakSlackBot"
+    assert definition["Dimensions"] == [["Roster"]]
+    assert record["Roster"] == "runs"
+    for phase in ["RosterFetch", "AbsenceFiltering", "HistoryRead", "Selection", "Dispatch", "HistoryWrite"]:
+        assert {"Name": f"{phase}Time", "Unit": "Milliseconds"} in definition["Metrics"]
+    assert record["RosterSize"] == 9
+    assert record["Pairs"] == 3
+    assert record["DeliveredPairs"] == 3
+    assert record["FailedPairs"] == 0
+    assert record["SlackCalls.users.info"] == 9
+    assert record["SlackCalls.conversations.open"] == 3
+    assert record["SlackCalls.chat.postMessage"] == 3
+    assert record["S3Objects"] == 2
+    assert record["S3Bytes"] == 1024
+    assert record["Retries"] == 1
+
+
+@freeze_time("2021-01-02")
+def test_process_rosters_shares_profiles_and_reports_per_roster(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"S3_BUCKET": "cubicl-bot", "SLACK_TOKEN": "xxx"})
+    mock_users_info = mocker.patch(
+        "slack_sdk.WebClient.users_info", side_effect=lambda user: {"user": _slack_user(user, real_name=user)}
+    )
+    mocker.patch("slack_sdk.WebClient.conversations_open", return_value={"channel": {"id": "dummy"}})
+    mock_chat_post_message = mocker.patch("slack_sdk.WebClient.chat_postMessage")
+    mocker.patch("slack_bot.app.create_s3_client")
+
+    def read(self):
+        if self.prefix == "user_history/broken":
+            raise RuntimeError("broken history")
+        return []
+
+    mocker.patch("slack_bot.app.S3FileHandler.read_history", new=lambda self, since=None: read(self))
+    mock_write = mocker.patch("slack_bot.app.S3FileHandler.write")
+    mocker.patch("slack_bot.app.S3FileHandler.read_state", return_value=None)
+    mocker.patch("slack_bot.app.S3FileHandler.write_state")
+    rosters = [
+        {"name": "team-a", "users": {"a": "U1", "b": "U2", "c": "U3", "d": "U4"}, "prefix": "user_history/a"},
+        {"name": "team-b", "users": ["U3", "U4", "U5", "U6"], "prefix": "user_history/b", "language": "de"},
+        {"name": "team-c", "users": ["U1", "U7"], "prefix": "user_history/broken"},
+    ]
+    records = []
+
+    # when
+    results = process_rosters(rosters, metrics_sink=records.append)
+
+    # then
+    assert mock_users_info.call_count == 7
+    assert results["team-a"].pairs == 1
+    assert results["team-a"].delivered == 1
+    assert results["team-b"].delivered == 1
+    assert results["team-c"].error == "broken history"
+    assert mock_write.call_count == 2
+    texts = sorted(call.kwargs["text"] for call in mock_chat_post_message.call_args_list)
+    assert sum("ihr wurdet" in text for text in texts) == 1
+    assert sum("you were selected" in text for text in texts) == 1
+    assert sorted(record["Roster"] for record in records) == ["all", "team-a", "team-b", "team-c"]
+
+
+def test_process_rosters_fails_after_other_rosters_when_one_reaches_the_deadline(mocker):
+    # given
+    mocker.patch("slack_bot.app.get_token", return_value="xxx")
+    mocker.patch("slack_bot.app.get_file_handler", side_effect=lambda prefix: InMemoryFileHandler())
+
+    def process(file_handler, metrics, users, language, profiles, deadline):
+        if users == ["U3", "U4"]:
+            raise DispatchIncomplete("1 pairs of round 2021-W01 are not sent yet")
+        return [app.DispatchResult(("U1", "U2"), True)]
+
+    mock_process_users = mocker.patch("slack_bot.app.process_users", side_effect=process)
+    mocker.patch("slack_bot.app.Roster.load")
+    rosters = [
+        {"name": "team-a", "users": ["U1", "U2"], "prefix": "user_history/a"},
+        {"name": "team-b", "users": ["U3", "U4"], "prefix": "user_history/b"},
+    ]
+    deadline = time.monotonic() + 30
+
+    # when
+    with pytest.raises(DispatchIncomplete, match="team-b"):
+        process_rosters(rosters, metrics_sink=None, deadline=deadline)
+
+    # then
+    assert mock_process_users.call_count == 2
+    assert all(call.kwargs["deadline"] == deadline for call in mock_process_users.call_args_list)
+
+
+@freeze_time("2021-01-04", tick=True)
+def test_process_users_resumes_from_checkpoint(mocker, tmp_path):
+    # given
+    users = [f"U{i}" for i in range(1, 13)]
+    mocker.patch("slack_bot.app.get_token", return_value="xxx")
+    mocker.patch("slack_bot.app.CHECKPOINT_BATCH_SIZE", 2)
+    mock_get_users = mocker.patch("slack_bot.app.get_users", return_value=users)
+    mock_send_message = mocker.patch("slack_bot.app.send_message", side_effect=lambda *args: time.sleep(0.15))
+    file_handler = SQLiteFileHandler(str(tmp_path / "history.db"))
+
+    # when
+    with pytest.raises(DispatchIncomplete):
+        process_users(file_handler, deadline=time.monotonic() + 0.2)
+    first_invocation_pairs = [call.args[0] for call in mock_send_message.call_args_list]
+    checkpoint = file_handler.read_state("checkpoint")
+
+    process_users(file_handler)
+    second_invocation_pairs = [call.args[0] for call in mock_send_message.call_args_list[2:]]
+
+    process_users(file_handler)
+
+    # then
+    assert len(first_invocation_pairs) == 2
+    assert checkpoint["round"] == "2021-W01"
+    assert len(checkpoint["pairs"]) == 3
+    assert checkpoint["delivered"] == first_invocation_pairs
+    assert second_invocation_pairs == [checkpoint["pairs"][2]]
+    mock_get_users.assert_called_once()
+    assert mock_send_message.call_count == 3
+    assert [run["pair"] for run in file_handler.read()] == checkpoint["pairs"]
+    assert file_handler.read_state("checkpoint")["completed"] is True
+
+
+def test_process_users_records_notified_pairs_of_incomplete_round(mocker):
+    # given
+    users = [f"U{i}" for i in range(10, 22)]
+    mocker.patch("slack_bot.app.get_token", return_value="xxx")
+    mocker.patch("slack_bot.app.CHECKPOINT_BATCH_SIZE", 2)
+    mocker.patch("slack_bot.app.get_users", return_value=users)
+    mock_send_message = mocker.patch("slack_bot.app.send_message", side_effect=lambda *args: time.sleep(0.15))
+    file_handler = InMemoryFileHandler()
+    with freeze_time("2021-01-04", tick=True), pytest.raises(DispatchIncomplete):
+        process_users(file_handler, deadline=time.monotonic() + 0.2)
+    notified_pairs = [call.args[0] for call in mock_send_message.call_args_list]
+
+    # when
+    with freeze_time("2021-01-11"):
+        process_users(file_handler)
+
+    # then
+    runs = file_handler.read()
+    assert len(notified_pairs) == 2
+    assert [run["pair"] for run in runs if run["date"] == "2021-01-04"] == notified_pairs
+    assert file_handler.read_state("checkpoint")["round"] == "2021-W02"
+    assert [run["pair"] for run in runs if run["date"] == "2021-01-11"] == file_handler.read_state("checkpoint")["pairs"]
+
+
+@freeze_time("2021-01-04")
+def test_process_users_fans_out_dispatch_to_workers(mocker):
+    # given
+    users = [f"U{i}" for i in range(1, 17)]
+    mocker.patch.dict(os.environ, {"SLACK_TOKEN": "xxx", "LANGUAGE": "en"})
+    mocker.patch("slack_bot.app.get_users", return_value=users)
+    mocker.patch(
+        "slack_sdk.WebClient.users_info", side_effect=lambda user: {"user": _slack_user(user, real_name=f"Name{user}")}
+    )
+    mocker.patch("slack_sdk.WebClient.conversations_open", side_effect=lambda users: {"channel": {"id": users[0]}})
+    mock_chat_post_message = mocker.patch("slack_sdk.WebClient.chat_postMessage")
+    queue = InMemoryQueue(max_receive_count=2)
+    mocker.patch("slack_bot.app.get_dispatch_queue", return_value=queue)
+    file_handler = InMemoryFileHandler()
+
+    # when
+    results = process_users(file_handler, language="de")
+    jobs = [json.loads(message["body"]) for message in queue.messages]
+    mock_chat_post_message.assert_not_called()
+    failing_channel = jobs[0]["pair"][0]
+    mock_chat_post_message.side_effect = lambda channel, text: _raise_if(channel == failing_channel)
+    queue.drain(worker_handler, batch_size=3)
+
+    # then
+    assert len(results) == 4
+    assert [job["pair"] for job in jobs] == [list(result.pair) for result in results]
+    assert jobs[0]["round"] == "2021-W01"
+    assert jobs[0]["names"] == [f"Name{user}" for user in jobs[0]["pair"]]
+    assert [run["pair"] for run in file_handler.read()] == [job["pair"] for job in jobs]
+    assert file_handler.read_state("checkpoint")["completed"] is True
+    # three jobs sent, the failing one was tried twice and dead-lettered
+    assert mock_chat_post_message.call_count == 5
+    assert all("ihr wurdet" in call.kwargs["text"] for call in mock_chat_post_message.call_args_list)
+    assert [json.loads(message["body"])["pair"] for message in queue.dead_letters] == [jobs[0]["pair"]]
+
+
+@freeze_time("2021-01-03 22:00:00")
+def test_plan_handler_plans_next_round(mocker, tmp_path):
+    # given
+    mocker.patch.dict(os.environ, {"SLACK_TOKEN": "xxx", "S3_PREFIX": "user_history", "HISTORY_DIR": str(tmp_path)})
+    mocker.patch("slack_bot.app.get_users", return_value=["U1", "U2", "U3", "U4"])
+    mock_send_message = mocker.patch("slack_bot.app.send_message")
+
+    # when
+    response = app.plan_handler(None, None)
+
+    # then
+    plan = app.get_file_handler("user_history").read_state("plan")
+    assert response == {"round": "2021-W01", "pairs": len(plan["pairs"])}
+    assert plan["version"] == app.PLAN_VERSION
+    assert plan["round"] == "2021-W01"
+    assert plan["created"] == "2021-01-03T22:00:00"
+    assert plan["pairs"]
+    assert plan["latest_run"] == {"date": "1970-01-01", "pairs": []}
+    mock_send_message.assert_not_called()
+
+
+@freeze_time("2021-01-04")
+def test_process_users_dispatches_planned_pairs_of_available_users(mocker):
+    # given
+    absent_users = {"U3", "U5", "U10"}
+    roster = {f"U{i}": f"U{i}" for i in range(1, 11) if i != 8}
+    mocker.patch.dict(os.environ, {"SLACK_TOKEN": "xxx", "USERS": json.dumps(roster)})
+    mocker.patch(
+        "slack_sdk.WebClient.users_info",
+        side_effect=lambda user: {"user": _slack_user(user, status_emoji=":palm_tree:" if user in absent_users else "")},
+    )
+    # the leftover users keep their order, so pairing neighbours would pair U4 and U6 again
+    mocker.patch("slack_bot.app.random.shuffle")
+    mock_select_user_pairs = mocker.patch("slack_bot.app.select_user_pairs")
+    mock_send_message = mocker.patch("slack_bot.app.send_message")
+    file_handler = InMemoryFileHandler()
+    file_handler.write_state("plan", {
+        "version": app.PLAN_VERSION,
+        "round": "2021-W01",
+        "created": "2021-01-03T22:00:00",
+        "pairs": [["U1", "U2"], ["U3", "U4"], ["U5", "U6"], ["U7", "U8"], ["U9", "U10"]],
+        "latest_run": {"date": "2020-12-28", "pairs": [["U4", "U6"]]},
+    })
+    metrics = Metrics(sink=None)
+
+    # when
+    process_users(file_handler, metrics)
+
+    # then
+    mock_select_user_pairs.assert_not_called()
+    sent_pairs = [call.args[0] for call in mock_send_message.call_args_list]
+    assert sent_pairs[0] == ["U1", "U2"]
+    # U8 left the roster, the users left without partner are not paired as in the latest run
+    assert sorted(user for pair in sent_pairs[1:] for user in pair) == ["U4", "U6", "U7", "U9"]
+    assert ["U4", "U6"] not in sent_pairs
+    assert [run["pair"] for run in file_handler.read()] == sent_pairs
+    assert metrics.values["AbsentPlannedUsers"] == 3
+    assert metrics.values["LeftPlannedUsers"] == 1
+
+
+@freeze_time("2021-01-04")
+@pytest.mark.parametrize(
+    "plan",
+    [
+        None,
+        {"version": app.PLAN_VERSION, "round": "2020-W53", "created": "2020-12-27T22:00:00", "pairs": [["U1", "U2"]]},
+        {"version": app.PLAN_VERSION + 1, "round": "2021-W01", "created": "2021-01-03T22:00:00", "pairs": []},
+    ],
+)
+def test_process_users_selects_pairs_without_valid_plan(mocker, plan):
+    # given
+    mocker.patch("slack_bot.app.get_token", return_value="xxx")
+    mock_select_user_pairs = mocker.patch("slack_bot.app.select_user_pairs", return_value=[("U3", "U4")])
+    mock_send_message = mocker.patch("slack_bot.app.send_message")
+    file_handler = InMemoryFileHandler()
+    if plan is not None:
+        file_handler.write_state("plan", plan)
+
+    # when
+    process_users(file_handler)
+
+    # then
+    mock_select_user_pairs.assert_called_once()
+    assert [call.args[0] for call in mock_send_message.call_args_list] == [["U3", "U4"]]
+
+
+def _raise_if(condition: bool):
+    if condition:
+        raise RuntimeError("channel_not_found")
+
+
+@mock_sqs
+def test_sqs_queue_sends_jobs_in_batches():
+    # given
+    sqs = boto3.client("sqs", region_name="us-east-1")
+    queue_url = sqs.create_queue(QueueName="dispatch")["QueueUrl"]
+    jobs = [{"round": "2021-W01", "pair": [f"U{i}", f"V{i}"], "names": ["A", "B"], "language": None} for i in range(15)]
+
+    # when
+    SQSQueue(queue_url, sqs=sqs).send(jobs)
+
+    # then
+    received = []
+    while True:
+        messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get("Messages", [])
+        if not messages:
+            break
+        received.extend(json.loads(message["Body"]) for message in messages)
+    assert sorted(received, key=lambda job: job["pair"]) == sorted(jobs, key=lambda job: job["pair"])
+
+
 def test_send_message(mocker):
     # given
     mock_conversations_open = mocker.patch(
@@ -189,6 +602,17 @@ def test_get_message(mocker, language: str, expected_message: str):
                 },
                 False,
         ),
+        (
+                "BOT_USER_ID",
+                {
+                    "user": {
+                        "deleted": False,
+                        "is_bot": True,
+                        "profile": {"status_emoji": "", "status_expiration": 0},
+                    }
+                },
+                False,
+        ),
         (
                 "STANDARD_USER_ID",
                 {
@@ -223,6 +647,257 @@ def test_is_included_user(mocker, user: str, user_info: dict, expected_value: bo
     assert is_included is expected_value
 
 
+def test_dispatch_messages_sync_continues_after_failure(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"DISPATCH_CONCURRENCY": "1"})
+    mock_send_message = mocker.patch(
+        "slack_bot.app.send_message", side_effect=[None, Exception("channel_not_found"), None]
+    )
+
+    # when
+    results = dispatch_messages([("U1", "U2"), ("U3", "U4"), ("U5", "U6")], WebClient())
+
+    # then
+    assert mock_send_message.call_count == 3
+    assert [result.delivered for result in results] == [True, False, True]
+    assert results[1].error == "channel_not_found"
+
+
+def test_dispatch_messages_async_bounded_and_isolated(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"DISPATCH_CONCURRENCY": "2"})
+    mocker.patch("slack_bot.app.get_user_name", return_value="Name")
+    running = []
+    max_running = []
+
+    async def conversations_open(self, users):
+        running.append(users)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(users)
+        if users == ["U3", "U4"]:
+            raise Exception("cannot_dm_bot")
+        return {"channel": {"id": "-".join(users)}}
+
+    mocker.patch(
+        "slack_sdk.web.async_client.AsyncWebClient.conversations_open", new=conversations_open
+    )
+    mock_chat_post_message = mocker.patch(
+        "slack_sdk.web.async_client.AsyncWebClient.chat_postMessage", new_callable=mocker.AsyncMock
+    )
+    user_pairs = [("U1", "U2"), ("U3", "U4"), ("U5", "U6"), ("U7", "U8")]
+
+    # when
+    results = dispatch_messages(user_pairs, WebClient(token="xxx"))
+
+    # then
+    assert max(max_running) == 2
+    assert [result.pair for result in results] == user_pairs
+    assert [result.delivered for result in results] == [True, False, True, True]
+    assert mock_chat_post_message.call_count == 3
+
+
+def _slack_user(user_id: str, real_name: str = "First Last", status_emoji: str = "") -> dict:
+    return {
+        "id": user_id,
+        "deleted": False,
+        "profile": {"real_name": real_name, "status_emoji": status_emoji, "status_expiration": 0},
+    }
+
+
+def test_roster_loads_large_rosters_with_users_list(mocker):
+    # given
+    user_ids = [f"U{i}" for i in range(60)]
+    pages = [
+        {"members": [_slack_user(user_id) for user_id in user_ids[:40]], "response_metadata": {"next_cursor": "next"}},
+        {"members": [_slack_user(user_id) for user_id in user_ids[40:]] + [_slack_user("OTHER")],
+         "response_metadata": {"next_cursor": ""}},
+    ]
+    mock_users_list = mocker.patch("slack_sdk.WebClient.users_list", side_effect=pages)
+    mock_users_info = mocker.patch("slack_sdk.WebClient.users_info")
+    roster = Roster(WebClient())
+
+    # when
+    roster.load(user_ids)
+
+    # then
+    assert mock_users_list.call_count == 2
+    assert mock_users_list.call_args_list[1].kwargs["cursor"] == "next"
+    mock_users_info.assert_not_called()
+    assert set(roster.profiles) == set(user_ids)
+
+
+def test_roster_loads_small_rosters_with_users_info(mocker):
+    # given
+    mock_users_list = mocker.patch("slack_sdk.WebClient.users_list")
+    mock_users_info = mocker.patch(
+        "slack_sdk.WebClient.users_info",
+        side_effect=lambda user: {"user": _slack_user(user)},
+    )
+    roster = Roster(WebClient())
+
+    # when
+    roster.load(["U1", "U2", "U1"])
+
+    # then
+    mock_users_list.assert_not_called()
+    assert mock_users_info.call_count == 2
+    assert set(roster.profiles) == {"U1", "U2"}
+
+
+def test_roster_profiles_are_shared_by_absence_check_and_name_resolution(mocker):
+    # given
+    mock_users_info = mocker.patch(
+        "slack_sdk.WebClient.users_info",
+        side_effect=lambda user: {"user": _slack_user(user, real_name="Jane Doe", status_emoji=":palm_tree:")},
+    )
+    roster = Roster(WebClient())
+    roster.load(["U1"])
+
+    # when
+    is_included = is_included_user("U1", roster)
+    user_name = get_user_name("U1", roster)
+
+    # then
+    assert is_included is False
+    assert user_name == "Jane"
+    mock_users_info.assert_called_once()
+
+
+def test_get_channel_members_streams_pages_and_caches_membership(mocker):
+    # given
+    num_members = {"C1": 3, "C2": 2}
+    pages = {
+        ("C1", None): {"members": ["U1", "U2"], "response_metadata": {"next_cursor": "next"}},
+        ("C1", "next"): {"members": ["U3"], "response_metadata": {"next_cursor": ""}},
+        ("C2", None): {"members": ["U3", "U4"]},
+    }
+    mock_conversations_info = mocker.patch(
+        "slack_sdk.WebClient.conversations_info",
+        side_effect=lambda channel, include_num_members: {"channel": {"num_members": num_members[channel]}},
+    )
+    mock_conversations_members = mocker.patch(
+        "slack_sdk.WebClient.conversations_members",
+        side_effect=lambda channel, limit, cursor: pages[(channel, cursor)],
+    )
+    file_handler = InMemoryFileHandler()
+
+    # when
+    first_members = get_channel_members(WebClient(), ["C1", "C2"], file_handler)
+    first_pages = mock_conversations_members.call_count
+    cached_members = get_channel_members(WebClient(), ["C1", "C2"], file_handler)
+    cached_pages = mock_conversations_members.call_count - first_pages
+    num_members["C2"] = 3
+    pages[("C2", None)] = {"members": ["U3", "U4", "U5"]}
+    changed_members = get_channel_members(WebClient(), ["C1", "C2"], file_handler)
+
+    # then
+    assert first_members == ["U1", "U2", "U3", "U4"]
+    assert first_pages == 3
+    assert cached_members == first_members
+    assert cached_pages == 0
+    assert changed_members == ["U1", "U2", "U3", "U4", "U5"]
+    assert mock_conversations_members.call_count == 4
+    assert mock_conversations_info.call_count == 6
+
+
+USER_CHANGE_EVENTS = os.path.join(os.path.dirname(__file__), "fixtures", "user_change_events.jsonl")
+
+
+@freeze_time("2022-09-09 10:00:00")
+def test_replay_user_events_keeps_latest_profiles():
+    # given
+    file_handler = InMemoryFileHandler()
+
+    # when
+    changed = replay_user_events(file_handler, USER_CHANGE_EVENTS)
+    profiles = ProfileCache(file_handler).read()
+
+    # then
+    assert changed == 4
+    assert set(profiles) == {"U1", "U2", "U3"}
+    assert profiles["U1"]["profile"]["status_emoji"] == ""
+    assert is_included_user("U1", Roster(None, profiles)) is True
+    assert is_included_user("U3", Roster(None, profiles)) is False
+
+
+@freeze_time("2022-09-09 10:00:00")
+def test_roster_loads_only_users_missing_from_profile_cache(mocker):
+    # given
+    file_handler = InMemoryFileHandler()
+    replay_user_events(file_handler, USER_CHANGE_EVENTS)
+    profile_cache = ProfileCache(file_handler)
+    mock_users_info = mocker.patch(
+        "slack_sdk.WebClient.users_info", side_effect=lambda user: {"user": _slack_user(user, real_name="Maggie")}
+    )
+    roster = Roster(WebClient(), profile_cache=profile_cache)
+
+    # when
+    roster.load(["U1", "U2", "U4"])
+
+    # then
+    mock_users_info.assert_called_once_with(user="U4")
+    assert set(profile_cache.read()) == {"U1", "U2", "U3", "U4"}
+    assert set(Roster(None, profile_cache=ProfileCache(file_handler, max_age_days=0)).profiles) == {"U4"}
+
+
+@freeze_time("2022-09-09 10:00:00")
+def test_process_users_reads_profile_cache(mocker, tmp_path):
+    # given
+    mocker.patch.dict(os.environ, {
+        "SLACK_TOKEN": "xxx",
+        "PROFILE_CACHE": "true",
+        "PROFILE_CACHE_PREFIX": "profiles",
+        "HISTORY_DATABASE": str(tmp_path / "history.db"),
+    })
+    ProfileCache(SQLiteFileHandler(str(tmp_path / "history.db"), "profiles")).update(
+        [_slack_user(user_id, real_name=user_id) for user_id in ["U1", "U2", "U3", "U4"]]
+    )
+    mock_users_info = mocker.patch("slack_sdk.WebClient.users_info")
+    mocker.patch("slack_sdk.WebClient.conversations_open", return_value={"channel": {"id": "dummy"}})
+    mocker.patch("slack_sdk.WebClient.chat_postMessage")
+
+    # when
+    results = process_users(SQLiteFileHandler(str(tmp_path / "history.db"), "team"), users=["U1", "U2", "U3", "U4"])
+
+    # then
+    mock_users_info.assert_not_called()
+    assert len(results) == 1
+    assert results[0].delivered
+
+
+def test_events_handler(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"SLACK_SIGNING_SECRET": "secret", "PROFILE_CACHE": "true"})
+    file_handler = InMemoryFileHandler()
+    mocker.patch("slack_bot.app.get_file_handler", return_value=file_handler)
+
+    def request(payload: dict, secret: str = "secret") -> dict:
+        from slack_sdk.signature import SignatureVerifier
+
+        body = json.dumps(payload)
+        timestamp = str(int(time.time()))
+        signature = SignatureVerifier(secret).generate_signature(timestamp=timestamp, body=body)
+        headers = {"X-Slack-Request-Timestamp": timestamp, "X-Slack-Signature": signature}
+        return {"body": body, "headers": headers}
+
+    with open(USER_CHANGE_EVENTS) as f:
+        user_change = json.loads(f.readline())
+
+    # when
+    verification = events_handler(request({"type": "url_verification", "challenge": "abc"}), None)
+    forged = events_handler(request(user_change, secret="other"), None)
+    forged_profiles = ProfileCache(file_handler, max_age_days=10000).read()
+    accepted = events_handler(request(user_change), None)
+
+    # then
+    assert verification == {"statusCode": 200, "body": "abc"}
+    assert forged == {"statusCode": 401}
+    assert forged_profiles == {}
+    assert accepted == {"statusCode": 200}
+    assert ProfileCache(file_handler, max_age_days=10000).read()["U1"]["profile"]["status_emoji"] == ":palm_tree:"
+
+
 @mock_s3
 def test_read_from_s3():
     # given
@@ -240,4 +915,454 @@ def test_read_from_s3():
         s3_client.put_object(Body=json.dumps(sample_run), Bucket=bucket, Key="runs/test.jsonl")
         file_handler = S3FileHandler(bucket=bucket, prefix="runs")
         result = file_handler.read()
-        assert result == sample_run
\ No newline at end of file
+        assert result == sample_run
+
+
+@mock_s3
+def test_read_from_s3_compacted(mocker):
+    # given
+    bucket = 'test-bucket'
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=bucket)
+    s3_client.put_object(Body=json.dumps([{'date': '2023-07-02', 'pair': ['U1', 'U2']}]), Bucket=bucket,
+                         Key="runs/2023-07-02_09-00-00.json")
+    s3_client.put_object(Body=json.dumps([{'date': '2023-07-09', 'pair': ['U3', 'U4']}]), Bucket=bucket,
+                         Key="runs/2023-07-09_09-00-00.json")
+    file_handler = S3FileHandler(bucket=bucket, prefix="runs", compact=True)
+    file_handler.read()
+    with freeze_time("2023-07-16 09:00:00"):
+        file_handler.write([{'date': '2023-07-16', 'pair': ['U5', 'U6']}])
+    s3_client.put_object(Body=json.dumps([{'date': '2023-07-23', 'pair': ['U7', 'U8']}]), Bucket=bucket,
+                         Key="runs/2023-07-23_09-00-00.json")
+    s3_client.delete_object(Bucket=bucket, Key="runs/2023-07-02_09-00-00.json")
+
+    # when
+    file_handler = S3FileHandler(bucket=bucket, prefix="runs", compact=True)
+    spy_get_object = mocker.spy(file_handler.s3, "get_object")
+    result = file_handler.read()
+
+    # then
+    # only the snapshot and the run written after it are fetched, expired runs are dropped
+    assert [call.kwargs["Key"] for call in spy_get_object.call_args_list] == [
+        "runs/_snapshot.json",
+        "runs/2023-07-23_09-00-00.json",
+    ]
+    assert result == [
+        {'date': '2023-07-09', 'pair': ['U3', 'U4']},
+        {'date': '2023-07-16', 'pair': ['U5', 'U6']},
+        {'date': '2023-07-23', 'pair': ['U7', 'U8']},
+    ]
+    assert S3FileHandler(bucket=bucket, prefix="runs").read() == result
+
+
+@mock_s3
+def test_read_history_from_s3_streams_runs(mocker):
+    # given
+    bucket = 'test-bucket'
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=bucket)
+    for day in ["2023-06-25", "2023-07-02"]:
+        s3_client.put_object(Body=json.dumps([{'date': day, 'pair': ['U1', 'U2']}]), Bucket=bucket,
+                             Key=f"runs/{day}_09-00-00.json")
+    file_handler = S3FileHandler(bucket=bucket, prefix="runs")
+    spy_read = mocker.spy(file_handler, "read")
+
+    # when
+    history = file_handler.read_history()
+
+    # then
+    # the full history is interned while it is read, not parsed into a list first
+    spy_read.assert_not_called()
+    assert history.to_runs() == [
+        {'date': '2023-06-25', 'pair': ['U1', 'U2']},
+        {'date': '2023-07-02', 'pair': ['U1', 'U2']},
+    ]
+
+
+@mock_s3
+def test_read_from_s3_all_pages():
+    # given
+    bucket = 'test-bucket'
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=bucket)
+    runs = [{'date': '2023-07-02', 'pair': [f'U{i}', f'V{i}']} for i in range(1001)]
+    for i, run in enumerate(runs):
+        s3_client.put_object(Body=json.dumps([run]), Bucket=bucket, Key=f"runs/{i:04d}.json")
+    file_handler = S3FileHandler(bucket=bucket, prefix="runs", max_workers=4)
+
+    # when
+    result = file_handler.read()
+
+    # then
+    assert result == runs
+    assert file_handler.last_read_stats.objects == 1001
+    assert file_handler.last_read_stats.bytes == sum(len(json.dumps([run])) for run in runs)
+    assert len(file_handler.last_read_stats.object_timings) == 1001
+
+
+@mock_s3
+def test_read_from_s3_uses_disk_cache(mocker, tmp_path):
+    # given
+    bucket = 'test-bucket'
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=bucket)
+    for day in ["2023-06-25", "2023-07-02"]:
+        s3_client.put_object(Body=json.dumps([{'date': day, 'pair': ['U1', 'U2']}]), Bucket=bucket,
+                             Key=f"runs/{day}_09-00-00.json")
+    cache = DiskCache(str(tmp_path / "cache"))
+    S3FileHandler(bucket=bucket, prefix="runs", cache=cache).read()
+    s3_client.put_object(Body=json.dumps([{'date': '2023-07-02', 'pair': ['U3', 'U4']}]), Bucket=bucket,
+                         Key="runs/2023-07-02_09-00-00.json")
+    with freeze_time("2023-07-09 09:00:00"):
+        S3FileHandler(bucket=bucket, prefix="runs").write([{'date': '2023-07-09', 'pair': ['U5', 'U6']}])
+
+    # when
+    file_handler = S3FileHandler(bucket=bucket, prefix="runs", cache=DiskCache(str(tmp_path / "cache")))
+    spy_get_object = mocker.spy(file_handler.s3, "get_object")
+    result = file_handler.read()
+
+    # then
+    # the unchanged object comes from the cache, the changed and the new one from S3
+    assert [call.kwargs["Key"] for call in spy_get_object.call_args_list] == [
+        "runs/2023-07-02_09-00-00.json",
+        "runs/2023-07-09_09-00-00.json.gz",
+    ]
+    assert file_handler.last_read_stats.cache_hits == 1
+    assert result == [
+        {'date': '2023-06-25', 'pair': ['U1', 'U2']},
+        {'date': '2023-07-02', 'pair': ['U3', 'U4']},
+        {'date': '2023-07-09', 'pair': ['U5', 'U6']},
+    ]
+    written = s3_client.get_object(Bucket=bucket, Key="runs/2023-07-09_09-00-00.json.gz")["Body"].read()
+    assert written[:2] == b"\x1f\x8b"
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    # given
+    cache = DiskCache(str(tmp_path), max_bytes=250)
+    runs = [{'date': '2023-07-02', 'pair': ['U1', 'U2']}] * 2
+    cache.put("runs/a.json", "1", runs)
+    cache.put("runs/b.json", "1", runs)
+    os.utime(cache._path("runs/a.json", "1"), (time.time() - 60, time.time() - 60))
+    os.utime(cache._path("runs/b.json", "1"), (time.time() - 30, time.time() - 30))
+    cache.get("runs/a.json", "1")
+
+    # when
+    cache.put("runs/c.json", "1", runs)
+
+    # then
+    assert cache.get("runs/a.json", "1") == runs
+    assert cache.get("runs/b.json", "1") is None
+    assert cache.get("runs/c.json", "1") == runs
+    assert cache.get("runs/a.json", "2") is None
+
+
+@mock_s3
+def test_iter_runs_from_s3_skips_objects_before_window(mocker):
+    # given
+    bucket = 'test-bucket'
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=bucket)
+    for day in ["2022-07-03", "2023-06-25", "2023-07-02"]:
+        s3_client.put_object(Body=json.dumps([{'date': day, 'pair': ['U1', 'U2']}]), Bucket=bucket,
+                             Key=f"runs/{day}_09-00-00.json")
+    file_handler = S3FileHandler(bucket=bucket, prefix="runs")
+    spy_get_object = mocker.spy(file_handler.s3, "get_object")
+
+    # when
+    runs = file_handler.iter_runs(since=date(2023, 6, 25))
+
+    # then
+    assert next(runs) == {'date': '2023-06-25', 'pair': ['U1', 'U2']}
+    assert list(runs) == [{'date': '2023-07-02', 'pair': ['U1', 'U2']}]
+    assert [call.kwargs["Key"] for call in spy_get_object.call_args_list] == [
+        "runs/2023-06-25_09-00-00.json",
+        "runs/2023-07-02_09-00-00.json",
+    ]
+    assert len(file_handler.read_history(since=date(2023, 6, 25))) == 2
+
+
+@mock_s3
+def test_s3_snapshot_drops_objects_before_window(mocker):
+    # given
+    mocker.patch.dict(os.environ, {"HISTORY_LOOKBACK_DAYS": "30"})
+    bucket = 'test-bucket'
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=bucket)
+    for day in ["2023-05-28", "2023-06-25", "2023-07-02"]:
+        s3_client.put_object(Body=json.dumps([{'date': day, 'pair': ['U1', 'U2']}]), Bucket=bucket,
+                             Key=f"runs/{day}_09-00-00.json")
+    with freeze_time("2023-06-04 09:00:00"):
+        # the snapshot of an earlier run still contains the oldest object
+        S3FileHandler(bucket=bucket, prefix="runs", compact=True).write([{'date': '2023-06-04', 'pair': ['U3', 'U4']}])
+
+    # when
+    with freeze_time("2023-07-09 09:00:00"):
+        file_handler = S3FileHandler(bucket=bucket, prefix="runs", compact=True)
+        runs = list(file_handler.iter_runs(since=app.get_history_since()))
+        file_handler.write([{'date': '2023-07-09', 'pair': ['U5', 'U6']}])
+
+    # then
+    assert [run["date"] for run in runs] == ["2023-06-25", "2023-07-02"]
+    snapshot = json.loads(gzip.decompress(s3_client.get_object(Bucket=bucket, Key="runs/_snapshot.json")["Body"].read()))
+    assert sorted(snapshot["objects"]) == [
+        "runs/2023-06-25_09-00-00.json",
+        "runs/2023-07-02_09-00-00.json",
+        "runs/2023-07-09_09-00-00.json.gz",
+    ]
+
+
+SQLITE_RUNS = [
+    {'date': '2023-06-25', 'pair': ['U1', 'U2']},
+    {'date': '2023-06-25', 'pair': ['U3', 'U4']},
+    {'date': '2023-07-02', 'pair': ['U1', 'U3']},
+    {'date': '2023-07-02', 'pair': ['U5', 'U2']},
+]
+
+
+def test_sqlite_file_handler_queries(tmp_path):
+    # given
+    file_handler = SQLiteFileHandler(str(tmp_path / "history.db"), prefix="runs")
+    other_roster = SQLiteFileHandler(str(tmp_path / "history.db"), prefix="other")
+
+    # when
+    file_handler.write(SQLITE_RUNS)
+    other_roster.write([{'date': '2023-07-09', 'pair': ['U1', 'U2']}])
+
+    # then
+    assert file_handler.read() == SQLITE_RUNS
+    assert list(file_handler.iter_runs(since=date(2023, 7, 1))) == SQLITE_RUNS[2:]
+    assert file_handler.last_run_per_user() == {
+        "U1": ("2023-07-02", 2),
+        "U2": ("2023-07-02", 2),
+        "U3": ("2023-07-02", 2),
+        "U4": ("2023-06-25", 1),
+        "U5": ("2023-07-02", 1),
+    }
+    assert file_handler.pairs_on("2023-07-02") == {("U1", "U3"), ("U2", "U5")}
+    assert file_handler.pair_counts(["U1", "U2", "U3"]) == {("U1", "U2"): 1, ("U1", "U3"): 1}
+    assert other_roster.read() == [{'date': '2023-07-09', 'pair': ['U1', 'U2']}]
+
+
+def test_sqlite_history_index_selects_like_full_history(tmp_path):
+    # given
+    file_handler = SQLiteFileHandler(str(tmp_path / "history.db"))
+    file_handler.write(SQLITE_RUNS)
+    users = ["U1", "U2", "U3", "U4", "U5", "U6", "U7", "U8"]
+
+    # when
+    random.seed(0)
+    from_index = filter_users_based_on_previous_runs(users, file_handler.history_index())
+    random.seed(0)
+    from_runs = filter_users_based_on_previous_runs(users, SQLITE_RUNS)
+
+    # then
+    assert from_index == from_runs
+    assert len(file_handler.history_index()) == 4
+
+
+def test_jsonl_file_handler_reads_and_writes(mocker, tmp_path):
+    # given
+    spy_fsync = mocker.spy(os, "fsync")
+    file_handler = JSONLFileHandler(str(tmp_path), prefix="user_history/runs")
+    other_roster = JSONLFileHandler(str(tmp_path), prefix="user_history/other")
+
+    # when
+    file_handler.write(SQLITE_RUNS[:2])
+    file_handler.write(SQLITE_RUNS[2:])
+    other_roster.write([{'date': '2023-07-09', 'pair': ['U1', 'U2']}])
+    file_handler.write_state("checkpoint", {"round": "2023-W27"})
+    file_handler.write_blob("profiles/run.prof", b"profile")
+    reopened = JSONLFileHandler(str(tmp_path), prefix="user_history/runs")
+
+    # then
+    assert reopened.read() == SQLITE_RUNS
+    assert list(reopened.iter_runs(since=date(2023, 7, 1))) == SQLITE_RUNS[2:]
+    assert list(reopened.iter_runs(since=date(2023, 7, 3))) == []
+    assert len(reopened.read_history(since=date(2023, 7, 1))) == 2
+    assert reopened.read_state("checkpoint") == {"round": "2023-W27"}
+    assert reopened.read_state("members") is None
+    assert reopened.read_blob("profiles/run.prof") == b"profile"
+    assert other_roster.read() == [{'date': '2023-07-09', 'pair': ['U1', 'U2']}]
+    # every append of runs is synced before the index is updated
+    assert spy_fsync.call_count >= 3
+
+
+def test_jsonl_file_handler_seeks_to_lookback_window(tmp_path):
+    # given
+    file_handler = JSONLFileHandler(str(tmp_path))
+    file_handler.write(SQLITE_RUNS[:2])
+    file_handler.write(SQLITE_RUNS[2:])
+    with open(file_handler.path, "r+b") as history:
+        # runs before the window are never parsed, so garbage in them goes unnoticed
+        history.write(b"x" * (len(json.dumps(SQLITE_RUNS[0])) - 1))
+
+    # when
+    runs = list(file_handler.iter_runs(since=date(2023, 7, 1)))
+
+    # then
+    assert runs == SQLITE_RUNS[2:]
+    with pytest.raises(json.JSONDecodeError):
+        file_handler.read()
+
+
+def test_jsonl_file_handler_indexes_runs_appended_without_index(tmp_path):
+    # given
+    file_handler = JSONLFileHandler(str(tmp_path))
+    file_handler.write(SQLITE_RUNS[:2])
+    with open(file_handler.path, "ab") as history:
+        # e.g. a write that was interrupted before its index update
+        history.write(json.dumps(SQLITE_RUNS[2]).encode("utf-8") + b"\n")
+
+    # when
+    stale_index_runs = list(file_handler.iter_runs(since=date(2023, 7, 1)))
+    os.remove(file_handler.index_path)
+    file_handler.write(SQLITE_RUNS[3:])
+
+    # then
+    assert stale_index_runs == [SQLITE_RUNS[2]]
+    assert file_handler.read() == SQLITE_RUNS
+    with open(file_handler.index_path) as index:
+        assert json.load(index)["dates"] == {"2023-06-25": 0, "2023-07-02": 2 * (len(json.dumps(SQLITE_RUNS[0])) + 1)}
+
+
+@mock_s3
+@pytest.mark.parametrize("handler_type", ["s3", "s3_compacted", "sqlite", "jsonl", "memory"])
+def test_file_handler_removes_runs(tmp_path, handler_type):
+    # given
+    bucket = 'test-bucket'
+    boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=bucket)
+    file_handler = {
+        "s3": lambda: S3FileHandler(bucket=bucket, prefix="runs"),
+        "s3_compacted": lambda: S3FileHandler(bucket=bucket, prefix="runs", compact=True),
+        "sqlite": lambda: SQLiteFileHandler(str(tmp_path / "history.db")),
+        "jsonl": lambda: JSONLFileHandler(str(tmp_path)),
+        "memory": lambda: InMemoryFileHandler(),
+    }[handler_type]()
+    with freeze_time("2023-06-25 09:00:00"):
+        file_handler.write(SQLITE_RUNS[:2])
+    with freeze_time("2023-07-02 09:00:00"):
+        file_handler.write(SQLITE_RUNS[2:])
+        file_handler.read()
+
+        # when
+        file_handler.remove_runs([SQLITE_RUNS[1], SQLITE_RUNS[2], SQLITE_RUNS[3]])
+
+        # then
+        assert file_handler.read() == SQLITE_RUNS[:1]
+        assert list(file_handler.iter_runs(since=date(2023, 7, 1))) == []
+
+
+def test_select_user_pairs_uses_history_index_of_any_handler(mocker):
+    # given
+    class IndexedFileHandler(InMemoryFileHandler):
+        def history_index(self, since=None):
+            return History.from_runs(self.read())
+
+    file_handler = IndexedFileHandler([{'date': '2023-07-02', 'pair': ['U1', 'U2']}])
+    spy_history_index = mocker.spy(file_handler, "history_index")
+    spy_read_history = mocker.spy(file_handler, "read_history")
+    mocker.patch("slack_bot.app.get_users", return_value=["U1", "U2", "U3", "U4"])
+
+    # when
+    pairs = select_user_pairs(None, file_handler, Metrics(sink=None))
+
+    # then
+    spy_history_index.assert_called_once()
+    spy_read_history.assert_not_called()
+    assert ("U1", "U2") not in pairs
+
+
+@pytest.mark.parametrize("pipelined,expected_overlap", [("true", True), ("false", False)])
+def test_select_user_pairs_reads_history_while_fetching_roster(mocker, pipelined, expected_overlap):
+    # given
+    mocker.patch.dict(os.environ, {"PIPELINED_RUN": pipelined})
+    roster_fetch_started = threading.Event()
+    history_read_started = threading.Event()
+    overlaps = []
+
+    class SlowFileHandler(InMemoryFileHandler):
+        def read_history(self, since=None):
+            history_read_started.set()
+            overlaps.append(roster_fetch_started.wait(timeout=0.5))
+            return super().read_history(since)
+
+    def slow_get_users(client, metrics=None, users=None):
+        roster_fetch_started.set()
+        overlaps.append(history_read_started.wait(timeout=0.5))
+        return ["U1", "U2", "U3", "U4"]
+
+    mocker.patch("slack_bot.app.get_users", side_effect=slow_get_users)
+    file_handler = SlowFileHandler([{"date": "2023-07-02", "pair": ["U1", "U2"]}])
+    metrics = Metrics(sink=None)
+
+    # when
+    pairs = select_user_pairs(None, file_handler, metrics)
+
+    # then
+    # run one after the other, the first phase ends before the second one starts
+    assert all(overlaps) is expected_overlap
+    assert pairs
+    assert ("U1", "U2") not in pairs
+    assert metrics.values["HistoryRuns"] == 1
+
+
+@freeze_time("2021-01-04")
+def test_process_users_pipelined_sends_while_checkpoint_is_written(mocker):
+    # given
+    users = [f"U{i}" for i in range(1, 13)]
+    mocker.patch.dict(os.environ, {"PIPELINED_RUN": "true"})
+    mocker.patch("slack_bot.app.get_token", return_value="xxx")
+    mocker.patch("slack_bot.app.CHECKPOINT_BATCH_SIZE", 2)
+    mocker.patch("slack_bot.app.get_users", return_value=users)
+    writes_in_flight = threading.Event()
+    sends_during_write = []
+
+    class SlowStateFileHandler(InMemoryFileHandler):
+        def __init__(self):
+            super().__init__()
+            self.saved_checkpoints = []
+
+        def write_state(self, name, data):
+            writes_in_flight.set()
+            time.sleep(0.1)
+            self.saved_checkpoints.append(copy.deepcopy(data))
+            super().write_state(name, data)
+            writes_in_flight.clear()
+
+    mock_send_message = mocker.patch(
+        "slack_bot.app.send_message", side_effect=lambda *args: sends_during_write.append(writes_in_flight.is_set())
+    )
+    file_handler = SlowStateFileHandler()
+
+    # when
+    process_users(file_handler)
+
+    # then
+    pairs = file_handler.saved_checkpoints[0]["pairs"]
+    assert mock_send_message.call_count == 3
+    assert any(sends_during_write)
+    # every saved checkpoint is a snapshot of the progress at the time of its batch
+    assert [len(checkpoint["delivered"]) for checkpoint in file_handler.saved_checkpoints] == [0, 2, 3, 3]
+    assert file_handler.read_state("checkpoint") == {
+        "round": "2021-W01", "date": "2021-01-04", "pairs": pairs, "delivered": pairs, "failed": [], "completed": True,
+    }
+    assert [run["pair"] for run in file_handler.read()] == pairs
+
+
+@mock_s3
+def test_sqlite_file_handler_imports_s3_history(tmp_path):
+    # given
+    bucket = 'test-bucket'
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket=bucket)
+    s3_client.put_object(Body=json.dumps(SQLITE_RUNS[:2]), Bucket=bucket, Key="runs/2023-06-25_09-00-00.json")
+    s3_client.put_object(Body=json.dumps(SQLITE_RUNS[2:]), Bucket=bucket, Key="runs/2023-07-02_09-00-00.json")
+    file_handler = SQLiteFileHandler(str(tmp_path / "history.db"), prefix="runs")
+
+    # when
+    imported = file_handler.import_history(S3FileHandler(bucket=bucket, prefix="runs"))
+
+    # then
+    assert imported == 4
+    assert file_handler.read() == SQLITE_RUNS